@@ -0,0 +1,2 @@
+'''Benchmarks for the hackernews app. Run each one from the Hacker_News directory with
+python -m benchmarks.<name>'''
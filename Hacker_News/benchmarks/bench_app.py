@@ -0,0 +1,222 @@
+'''Latency (p50/p99), SQL queries per call and peak python memory of the main routes
+and ingest jobs, against a throwaway sqlite database seeded with a configurable number
+of posts, users and votes and a local stub of the hacker news api. Results are written
+as JSON so runs on different commits can be compared with --compare'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+import data
+from hackernews import create_app, db, page_cache
+from hackernews.config import database_settings
+from hackernews.instrumentation import count_queries
+from hackernews.migrations import upgrade_schema
+from hackernews.models import Post, Role, User, UserRoles, Vote
+from hackernews.ranking import recompute_ranks
+from tests.hn_stub import HNStub, make_story
+
+# like the tests, the benchmark must never touch the real database
+_DIRECTORY = tempfile.mkdtemp(prefix='hackernews-bench-')
+app = create_app({
+    **database_settings({'DATABASE_URL': f"sqlite:///{os.path.join(_DIRECTORY, 'site.db')}"}),
+    'PAGE_CACHE_PATH': os.path.join(_DIRECTORY, 'page_cache.db'),
+    'METRICS_PATH': os.path.join(_DIRECTORY, 'metrics.db'),
+    'NEWSFEED_SNAPSHOT_PATH': os.path.join(_DIRECTORY, 'newsfeed.json'),
+})
+
+FIRST_POST = 10000000
+SEED_BATCH = 1000
+TOPICS = ('rust', 'sqlite', 'flask', 'gunicorn')
+
+def seed(posts, users, votes, rng):
+    '''fills the empty database: posts, users (the first one an admin) and votes on
+    random posts, then the counters and ranks they imply'''
+    with app.app_context():
+        upgrade_schema()
+        now = int(time.time())
+        for start in range(0, posts, SEED_BATCH):
+            db.session.execute(insert(Post), [{'id': FIRST_POST + i,
+                    'author': f'author{i % 997}', 'title': f'Story {i} about {rng.choice(TOPICS)}',
+                    'url': f'https://example.com/{i}', 'posttype': 'story',
+                    'time': now - rng.randrange(30 * 86400), 'score': rng.randrange(500),
+                    'descendants': 0} for i in range(start, min(start + SEED_BATCH, posts))])
+        db.session.execute(insert(User), [{'id': f'bench{i}', 'username': f'Bench {i}',
+                'email': f'bench{i}@example.com'} for i in range(users)])
+        admin = Role.query.filter_by(name='admin').first()
+        db.session.add(UserRoles(user_id='bench0', role_id=admin.id))
+        pairs = {(rng.randrange(users), rng.randrange(posts))
+                for _ in range(min(votes, users * posts))}
+        rows = [{'user_id': f'bench{user}', 'post_id': FIRST_POST + post,
+                'value': rng.choice((Vote.LIKE, Vote.DISLIKE))} for user, post in pairs]
+        for start in range(0, len(rows), SEED_BATCH):
+            db.session.execute(insert(Vote), rows[start:start + SEED_BATCH])
+        Post.recount_votes()
+        db.session.commit()
+        recompute_ranks()
+
+def logged_in_client(user_id):
+    '''a test client whose session belongs to user_id'''
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user'] = {'userinfo': {'name': user_id, 'email': f'{user_id}@example.com',
+                'sub': user_id, 'picture': ''}}
+    return client
+
+def measure(func, iterations):
+    '''runs func(i) iterations times; returns the timings in ms, the SQL statements per
+    call and the peak traced memory of one further call in KiB'''
+    timings = []
+    with count_queries() as statements:
+        for i in range(iterations):
+            start = time.perf_counter()
+            func(i)
+            timings.append((time.perf_counter() - start) * 1000)
+    # tracing slows python down, so memory is measured on a separate call
+    tracemalloc.start()
+    func(iterations)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings.sort()
+    return {'iterations': iterations, 'p50_ms': round(statistics.median(timings), 3),
+            'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3),
+            'mean_ms': round(statistics.fmean(timings), 3),
+            'queries': round(len(statements) / iterations, 2), 'peak_kib': round(peak / 1024, 1)}
+
+def checked(response):
+    '''fails the run on an error response instead of timing it'''
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.path} answered {response.status_code}')
+    return response
+
+def route_scenarios(args, rng):
+    '''{name: callable} of the route scenarios'''
+    anonymous = app.test_client()
+    member = logged_in_client('bench1')
+    admin = logged_in_client('bench0')
+    post_ids = [FIRST_POST + rng.randrange(args.posts) for _ in range(args.iterations + 1)]
+    cursor = None
+    for _ in range(19):
+        response = anonymous.get('/home', query_string={'cursor': cursor} if cursor else {})
+        found = re.search(rb'cursor=([\w-]+)">Next', response.data)
+        cursor = found.group(1).decode() if found else cursor
+    def home_uncached(_):
+        page_cache.invalidate()
+        checked(anonymous.get('/home'))
+    def home_deep(_):
+        page_cache.invalidate()
+        checked(anonymous.get('/home', query_string={'cursor': cursor}))
+    return {
+        'home anonymous, cache miss': home_uncached,
+        'home anonymous, cache hit': lambda _: checked(anonymous.get('/home')),
+        'home anonymous, page 20': home_deep,
+        'home logged in': lambda _: checked(member.get('/home')),
+        'newsfeed': lambda _: checked(anonymous.get('/newsfeed')),
+        'item page': lambda i: checked(member.get(f'/item/{post_ids[i]}')),
+        'search': lambda _: checked(anonymous.get('/search', query_string={'q': 'sqlite'})),
+        'like toggle': lambda i: checked(member.post(f'/like-post/{post_ids[i]}')),
+        'admin posts': lambda _: checked(admin.get('/admin_post')),
+        'admin users': lambda _: checked(admin.get('/admin_user')),
+    }
+
+def ingest_scenarios(args, stub):
+    '''{name: callable} of the ingest jobs, each run against the stub api'''
+    next_id = [FIRST_POST + args.posts]
+    def fetch(_):
+        stories = [make_story(next_id[0] + i) for i in range(args.stories)]
+        next_id[0] += args.stories
+        stub.add(*stories)
+        stub.top = [story['id'] for story in stories]
+        with contextlib.redirect_stdout(io.StringIO()):
+            data.fetch_and_store_stories(depth=args.stories, base_url=stub.url)
+    def sync(i):
+        changed = [make_story(FIRST_POST + (i * args.stories + n) % args.posts, score=i + 2)
+                for n in range(args.stories)]
+        stub.add(*changed)
+        stub.updates = {'items': [story['id'] for story in changed], 'profiles': []}
+        with contextlib.redirect_stdout(io.StringIO()):
+            data.sync_stories(base_url=stub.url)
+    return {f'ingest {args.stories} new stories': fetch,
+            f'sync {args.stories} changed stories': sync}
+
+def current_commit():
+    '''the git commit being measured, or None outside a checkout'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, threshold):
+    '''prints the change against a previous results file; returns the names of the
+    scenarios whose p50 grew by more than threshold'''
+    with open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)['scenarios']
+    slower = []
+    print(f"\n{'scenario':>34} {'p50 change':>11} {'queries':>13}")
+    for name, result in results['scenarios'].items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        ratio = result['p50_ms'] / before['p50_ms'] if before['p50_ms'] else 1.0
+        if ratio > threshold:
+            slower.append(name)
+        print(f"{name:>34} {(ratio - 1) * 100:>+10.0f}% "
+                f"{before['queries']:>6g} -> {result['queries']:<5g}")
+    return slower
+
+def main(argv=None):
+    '''seeds the database, runs every scenario, prints a table and writes the JSON'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--votes', type=int, default=20000)
+    parser.add_argument('--stories', type=int, default=30, help='stories per ingest run')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', help='only run scenarios whose name contains this')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='a previous results file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+            help='with --compare, exit with an error if a p50 grew by more than this factor')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    seed(args.posts, args.users, args.votes, rng)
+    results = {'commit': current_commit(), 'python': platform.python_version(),
+            'sizes': {'posts': args.posts, 'users': args.users, 'votes': args.votes,
+                'stories': args.stories},
+            'scenarios': {}}
+    print(f"{'scenario':>34} {'p50 (ms)':>9} {'p99 (ms)':>9} {'queries':>8} {'peak KiB':>9}")
+    # the ingest jobs run inside an app context, like data.py does
+    with HNStub() as stub, app.app_context():
+        scenarios = {**route_scenarios(args, rng), **ingest_scenarios(args, stub)}
+        for name, func in scenarios.items():
+            if args.only and args.only not in name:
+                continue
+            result = measure(func, args.iterations)
+            results['scenarios'][name] = result
+            print(f"{name:>34} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+                    f"{result['queries']:>8g} {result['peak_kib']:>9.1f}")
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+    print(f"\nwrote {args.output}")
+    if args.compare:
+        slower = compare(results, args.compare, args.threshold)
+        if slower:
+            print(f"slower than {args.threshold}x: {', '.join(slower)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
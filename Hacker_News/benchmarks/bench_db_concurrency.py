@@ -0,0 +1,111 @@
+'''Reader throughput and "database is locked" errors while another process bulk
+upserts posts, with sqlite in the old rollback journal (DELETE) and in WAL mode'''
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+
+from hackernews.config import apply_sqlite_pragmas
+from hackernews.models import Post
+
+BATCH = 500
+
+def make_engine(path, pragmas):
+    '''an engine on path that applies pragmas to every connection'''
+    engine = create_engine(f'sqlite:///{path}')
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record): # pylint: disable=unused-argument
+        apply_sqlite_pragmas(dbapi_connection, pragmas)
+    return engine
+
+def story(item_id, round_number):
+    '''a post row whose score changes every round'''
+    return {'id': item_id, 'author': 'bench', 'title': f'story {item_id}',
+            'url': 'https://example.com/', 'posttype': 'story', 'time': item_id,
+            'score': round_number, 'descendants': 0, 'popularity': 0}
+
+def writer(path, pragmas, posts, stop):
+    '''upserts every post in batches of BATCH, over and over, until stop is set'''
+    engine = make_engine(path, pragmas)
+    round_number = 0
+    while not stop.is_set():
+        round_number += 1
+        for start in range(0, posts, BATCH):
+            rows = [story(i, round_number) for i in range(start + 1, min(start + BATCH, posts) + 1)]
+            stmt = insert(Post.__table__).values(rows)
+            stmt = stmt.on_conflict_do_update(index_elements=['id'],
+                    set_={'score': stmt.excluded.score})
+            try:
+                with engine.begin() as conn:
+                    conn.execute(stmt)
+            except OperationalError:
+                pass
+
+def reader(path, pragmas, duration, results):
+    '''runs the home page query for duration seconds, counting reads and lock errors'''
+    engine = make_engine(path, pragmas)
+    query = (select(Post.id, Post.title, Post.score)
+            .order_by(Post.rank.desc(), Post.id.desc()).limit(6))
+    reads = errors = 0
+    deadline = time.monotonic() + duration
+    with engine.connect() as conn:
+        while time.monotonic() < deadline:
+            try:
+                conn.execute(query).all()
+                conn.commit()
+                reads += 1
+            except OperationalError:
+                conn.rollback()
+                errors += 1
+    results.put((reads, errors))
+
+def run(journal_mode, args):
+    '''returns (reads per second, lock errors) for one journal mode'''
+    pragmas = {'journal_mode': journal_mode, 'busy_timeout': args.busy_timeout,
+            'synchronous': 'NORMAL' if journal_mode == 'WAL' else 'FULL'}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        engine = make_engine(path, pragmas)
+        Post.metadata.create_all(engine, tables=[Post.__table__])
+        with engine.begin() as conn:
+            conn.execute(insert(Post.__table__), [story(i, 0) for i in range(1, args.posts + 1)])
+        engine.dispose()
+
+        context = multiprocessing.get_context('spawn')
+        stop = context.Event()
+        results = context.Queue()
+        write = context.Process(target=writer, args=(path, pragmas, args.posts, stop))
+        write.start()
+        readers = [context.Process(target=reader, args=(path, pragmas, args.duration, results))
+                for _ in range(args.readers)]
+        for process in readers:
+            process.start()
+        totals = [results.get() for _ in readers]
+        for process in readers:
+            process.join()
+        stop.set()
+        write.join()
+    return sum(reads for reads, _ in totals) / args.duration, sum(e for _, e in totals)
+
+def main(argv=None):
+    '''runs the benchmark for both journal modes and prints a table'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per mode')
+    parser.add_argument('--busy-timeout', type=int, default=0,
+            help='busy_timeout in ms; 0 shows the raw lock errors')
+    args = parser.parse_args(argv)
+
+    print(f"{'journal':>8} {'reads/s':>10} {'lock errors':>12}")
+    for journal_mode in ('DELETE', 'WAL'):
+        throughput, errors = run(journal_mode, args)
+        print(f"{journal_mode:>8} {throughput:>10.0f} {errors:>12}")
+
+if __name__ == '__main__':
+    main()
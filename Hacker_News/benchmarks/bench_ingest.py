@@ -0,0 +1,50 @@
+'''Wall-clock time to fetch 50 and 500 items from a stub api with the old serial
+fetching (one connection per request) and the pooled, concurrent HNClient'''
+import argparse
+import time
+
+import requests
+
+from hackernews.ingest import HNClient
+from tests.hn_stub import HNStub, make_story
+
+def serial_fetch(base_url, item_ids):
+    '''the fetch loop data.py used before HNClient: no session, one request at a time'''
+    items = []
+    for item_id in item_ids:
+        response = requests.get(f"{base_url}/item/{item_id}.json", timeout=10)
+        if response.status_code == 200:
+            items.append(response.json())
+    return items
+
+def pooled_fetch(base_url, item_ids, workers):
+    '''fetches with the shared session and a bounded pool of threads'''
+    with HNClient(base_url=base_url, workers=workers) as client:
+        return client.items(item_ids)
+
+def timed(func, *args):
+    '''returns (seconds, result) for a single call'''
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def main(argv=None):
+    '''runs the benchmark and prints a table'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.02,
+            help='seconds the stub sleeps per request')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500])
+    args = parser.parse_args(argv)
+
+    ids = list(range(1, max(args.sizes) + 1))
+    with HNStub([make_story(i) for i in ids], latency=args.latency) as stub:
+        print(f"{'items':>6} {'serial (s)':>11} {'pooled (s)':>11} {'speedup':>8}")
+        for size in args.sizes:
+            serial, serial_items = timed(serial_fetch, stub.url, ids[:size])
+            pooled, pooled_items = timed(pooled_fetch, stub.url, ids[:size], args.workers)
+            assert len(serial_items) == len(pooled_items) == size
+            print(f"{size:>6} {serial:>11.3f} {pooled:>11.3f} {serial / pooled:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
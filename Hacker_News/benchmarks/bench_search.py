@@ -0,0 +1,111 @@
+'''Search latency over a large synthetic post table: the post_search FTS5 index ranked
+with bm25 against the LIKE scan it replaces, plus the cost the index triggers add to
+bulk inserts'''
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects.sqlite import insert
+
+from hackernews.models import Post
+from hackernews.search import SEARCH_DDL, WEIGHTS
+
+BATCH = 500
+VOCABULARY = 20000
+SITES = ('github.com', 'example.com', 'nytimes.com', 'arxiv.org', 'blog.rust-lang.org',
+        'lwn.net', 'medium.com', 'bbc.co.uk')
+
+FTS_QUERY = text('SELECT post.id, post.title FROM post JOIN (SELECT rowid AS post_id, '
+        f'bm25(post_search, {", ".join(map(str, WEIGHTS))}) AS relevance FROM post_search '
+        'WHERE post_search MATCH :query) AS matches ON matches.post_id = post.id '
+        'WHERE NOT post.hidden ORDER BY matches.relevance, matches.post_id LIMIT 11')
+LIKE_QUERY = text('SELECT id, title FROM post WHERE NOT hidden AND (title LIKE :like '
+        'OR author LIKE :like OR url LIKE :like) ORDER BY time DESC, id DESC LIMIT 11')
+
+def vocabulary(seed):
+    '''VOCABULARY made up words and their cumulative zipf weights, most frequent
+    first, so titles share words the way real ones do'''
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+            for _ in range(VOCABULARY)]
+    return words, list(itertools.accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+
+def story(rng, item_id, words):
+    '''a post row with a random title of eight words'''
+    return {'id': item_id, 'author': f'user{rng.randrange(5000)}',
+            'title': ' '.join(rng.choices(words[0], cum_weights=words[1], k=8)).capitalize(),
+            'url': f'https://{rng.choice(SITES)}/{item_id}', 'posttype': 'story',
+            'time': 1700000000 + item_id, 'score': rng.randrange(500), 'descendants': 0,
+            'popularity': 0, 'hidden': False}
+
+def populate(engine, posts, indexed, seed):
+    '''inserts posts rows in batches of BATCH, returning the seconds it took'''
+    rng = random.Random(seed)
+    words = vocabulary(seed)
+    Post.metadata.create_all(engine, tables=[Post.__table__])
+    if indexed:
+        with engine.begin() as conn:
+            for statement in SEARCH_DDL:
+                conn.execute(text(statement))
+    start = time.perf_counter()
+    for first in range(1, posts + 1, BATCH):
+        with engine.begin() as conn:
+            conn.execute(insert(Post.__table__),
+                    [story(rng, i, words) for i in range(first, min(first + BATCH, posts + 1))])
+    return time.perf_counter() - start
+
+def latencies(engine, statement, params, repeat):
+    '''milliseconds of every run of statement with each of params, repeat times'''
+    timings = []
+    with engine.connect() as conn:
+        for _ in range(repeat):
+            for values in params:
+                start = time.perf_counter()
+                conn.execute(statement, values).all()
+                timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def report(name, timings):
+    '''prints the p50 and p99 of timings'''
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:>22} {statistics.median(timings):>9.2f} {p99:>9.2f}")
+
+def main(argv=None):
+    '''builds the table with and without the index and prints insert and query times'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    # words from the middle of the vocabulary match a few dozen to a few hundred posts
+    rng = random.Random(args.seed)
+    words = vocabulary(args.seed)[0]
+    terms = [rng.sample(words[100:2000], 2) for _ in range(20)]
+    with tempfile.TemporaryDirectory() as directory:
+        plain = create_engine(f"sqlite:///{os.path.join(directory, 'plain.db')}")
+        indexed = create_engine(f"sqlite:///{os.path.join(directory, 'indexed.db')}")
+        plain_seconds = populate(plain, args.posts, False, args.seed)
+        indexed_seconds = populate(indexed, args.posts, True, args.seed)
+        print(f"inserting {args.posts} posts: {plain_seconds:.2f}s without the index, "
+                f"{indexed_seconds:.2f}s with it")
+        print(f"{'query':>22} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        report('LIKE, one word', latencies(plain, LIKE_QUERY,
+                [{'like': f'%{first}%'} for first, _ in terms], args.repeat))
+        report('FTS5 bm25, one word', latencies(indexed, FTS_QUERY,
+                [{'query': f'"{first}"*'} for first, _ in terms], args.repeat))
+        report('FTS5 bm25, two words', latencies(indexed, FTS_QUERY,
+                [{'query': f'"{first}" "{second}"*'} for first, second in terms], args.repeat))
+        report('FTS5 bm25, site', latencies(indexed, FTS_QUERY,
+                [{'query': '"lwn" "net"*'}], args.repeat * 20))
+        plain.dispose()
+        indexed.dispose()
+
+if __name__ == '__main__':
+    main()
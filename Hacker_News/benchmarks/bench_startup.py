@@ -0,0 +1,51 @@
+'''Startup cost of each way the code is run: the import time and module count of a web
+worker (run.py builds the website), of the cron job (data.py builds the ingest app) and
+the time pytest takes to collect the test suite. Every run is a fresh interpreter, as a
+gunicorn worker or a cron job is'''
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# each script prints the milliseconds it took and how many modules it loaded
+TARGETS = {
+    'web worker (import run)': 'import run',
+    'cron job (data.py)': 'import data; data.create_ingest_app()',
+}
+PROBE = ('import sys, time; start = time.perf_counter(); {code}; '
+        'print((time.perf_counter() - start) * 1000, len(sys.modules), '
+        '"authlib" in sys.modules)')
+
+def time_import(code, runs):
+    '''median import time in ms, module count and whether authlib was loaded'''
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(code=code)],
+                capture_output=True, text=True, check=True).stdout.split()
+        timings.append(float(out[0]))
+    return statistics.median(timings), int(out[1]), out[2] == 'True'
+
+def time_collection(runs):
+    '''median wall time in ms of pytest --collect-only'''
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'pytest', '--collect-only', '-q'],
+                capture_output=True, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def main(argv=None):
+    '''times every target and prints a table'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+    print(f"{'target':>28} {'median (ms)':>12} {'modules':>8} {'authlib':>8}")
+    for name, code in TARGETS.items():
+        median, modules, authlib = time_import(code, args.runs)
+        print(f"{name:>28} {median:>12.0f} {modules:>8} {'yes' if authlib else 'no':>8}")
+    print(f"{'test collection (pytest)':>28} {time_collection(args.runs):>12.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,116 @@
 '''This module gets the 50 newest stories from the hacker news api and adds it to
 the Post databse'''
+import argparse
 import datetime
 import sys
-import requests
-from hackernews import app, db
-from hackernews.models import Post, Role
+from hackernews import create_ingest_app, db, page_cache, metrics_store
+from hackernews.feed import write_snapshot
+from hackernews.ingest import (HNClient, HN_API_URL, DEFAULT_DEPTH, DEFAULT_WORKERS, is_story,
+        sync_updates, upsert_posts)
+from hackernews.migrations import upgrade_schema
+from hackernews.threads import DEFAULT_MAX_COMMENTS, DEFAULT_MAX_DEPTH, refresh_threads
+from hackernews.models import Post, PostArchive
+from hackernews.ranking import recompute_ranks
 
-def fetch_and_store_stories():
-    URL = "https://hacker-news.firebaseio.com/v0/topstories.json"
-    response = requests.get(URL, timeout=10)
-    if response.status_code != 200:
-        sys.exit()
-    html = response.json()
-    with app.app_context():
-        #db.drop_all()
-        db.create_all()
-        roles_to_create = ['member', 'admin']
-        for role_name in roles_to_create:
-            existing_role = Role.query.filter_by(name=role_name).first()
-            if not existing_role:
-                new_role = Role(name=role_name)
-                db.session.add(new_role)
-        COUNT = 0
-        for i in range(50):
-            response = requests.get(f"https://hacker-news.firebaseio.com/v0/item/{html[i]}.json",
-                    timeout=10)
-            if response.status_code == 200:
-                post = response.json()
-            if post.get('type') != 'story' or post.get('url') is None:
-                continue
-            p = Post(author=post.get('by'), descendants=post.get('descendants'), id=post['id'],
-                    kids=post.get('kids'), score=post.get('score'), posttype=post.get('type'),
-                    title=post.get('title'), time=post.get('time'), url=post.get('url'), popularity=0)
-            exists = db.session.query(Post).filter_by(id=post['id']).count()
-            if not exists:
-                db.session.add(p)
-                db.session.commit()
-                COUNT+=1
+def setup_database():
+    '''Creates or upgrades missing tables and columns and the default roles'''
+    #db.drop_all()
+    upgrade_schema()
+
+def fetch_and_store_stories(depth=DEFAULT_DEPTH, workers=DEFAULT_WORKERS, base_url=HN_API_URL,
+        refresh=False):
+    '''Fetches the top `depth` stories with `workers` concurrent requests and stores
+    the ones that are not already in the database. With refresh, stories that are
+    already stored are fetched as well and their score, descendants and kids updated.
+    Returns the number of new stories. Needs an app context'''
+    with metrics_store.job('fetch') as run, HNClient(base_url=base_url, workers=workers) as client:
+        top_ids = client.top_stories()
+        if top_ids is None:
+            sys.exit()
+        candidate_ids = top_ids[:depth]
+        setup_database()
+        stored = {row.id for row in
+                db.session.query(Post.id).filter(Post.id.in_(candidate_ids))}
+        # archived stories stay archived even while they are still on the front page
+        archived = {row.id for row in
+                db.session.query(PostArchive.id).filter(PostArchive.id.in_(candidate_ids))}
+        to_fetch = [item_id for item_id in candidate_ids if item_id not in archived
+                and (refresh or item_id not in stored)]
+        stories = [item for item in client.items(to_fetch) if is_story(item)]
+        upsert_posts(stories)
+        COUNT = sum(1 for story in stories if story['id'] not in stored)
+        run['items'] = COUNT
+        if stories:
+            recompute_ranks()
+            write_snapshot()
+        if COUNT:
+            page_cache.invalidate()
     ct = datetime.datetime.now()
     print(f"Datestamp: {ct}, Saved {COUNT} new stories")
     return COUNT
 
+def sync_stories(workers=DEFAULT_WORKERS, base_url=HN_API_URL):
+    '''Refreshes score, descendants and kids of stored stories that changed on hacker
+    news since the last run. Returns a SyncResult. Needs an app context'''
+    with metrics_store.job('sync') as run, HNClient(base_url=base_url, workers=workers) as client:
+        setup_database()
+        result = sync_updates(client)
+        run['items'] = result.refreshed
+        if result.refreshed:
+            recompute_ranks()
+            write_snapshot()
+            page_cache.invalidate()
+    ct = datetime.datetime.now()
+    print(f"Datestamp: {ct}, Fetched {result.fetched} changed stories, "
+            f"refreshed {result.refreshed}{' (front page caught up)' if result.full else ''}")
+    return result
+
+def crawl_threads(workers=DEFAULT_WORKERS, base_url=HN_API_URL, max_depth=DEFAULT_MAX_DEPTH,
+        max_comments=DEFAULT_MAX_COMMENTS):
+    '''Crawls the comment threads of the newest stored stories whose comment count
+    changed since their last crawl, and drops their cached thread pages. Returns the
+    ThreadResult of every crawled thread. Needs an app context'''
+    with metrics_store.job('threads') as run, HNClient(base_url=base_url, workers=workers) \
+            as client:
+        setup_database()
+        results = refresh_threads(client, max_depth=max_depth, max_comments=max_comments)
+        run['items'] = sum(result.written for result in results)
+    for result in results:
+        page_cache.invalidate_tag(result.post_id)
+    ct = datetime.datetime.now()
+    print(f"Datestamp: {ct}, Crawled {len(results)} threads, "
+            f"wrote {sum(result.written for result in results)} comments")
+    return results
+
+def parse_args(argv=None):
+    '''Command line options for the cron job'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH,
+            help='how many of the top stories to consider')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+            help='how many items to fetch concurrently')
+    parser.add_argument('--refresh', action='store_true',
+            help='also refresh score, descendants and kids of stories already stored')
+    parser.add_argument('--sync', action='store_true',
+            help='only refresh stored stories listed in the updates feed')
+    parser.add_argument('--threads', action='store_true',
+            help='only crawl the comment threads of stories with new comments')
+    parser.add_argument('--max-depth', type=int, default=DEFAULT_MAX_DEPTH,
+            help='how many levels of replies to crawl')
+    parser.add_argument('--max-comments', type=int, default=DEFAULT_MAX_COMMENTS,
+            help='how many comments to crawl per thread')
+    parser.add_argument('--api-url', default=HN_API_URL, help='base url of the hacker news api')
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    fetch_and_store_stories()
+    args = parse_args()
+    # the cron job only needs the models and the database, not the website
+    with create_ingest_app().app_context():
+        if args.sync:
+            sync_stories(workers=args.workers, base_url=args.api_url)
+        elif args.threads:
+            crawl_threads(workers=args.workers, base_url=args.api_url, max_depth=args.max_depth,
+                    max_comments=args.max_comments)
+        else:
+            fetch_and_store_stories(depth=args.depth, workers=args.workers,
+                    base_url=args.api_url, refresh=args.refresh)
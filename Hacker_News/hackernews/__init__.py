@@ -1,31 +1,98 @@
-'''Initializes hackernews app'''
+'''Initializes hackernews: the database, the shared caches and the app factories.
+create_app builds the website; create_ingest_app only sets up the models and the
+database engine, so the cron jobs and CLI commands start without the web stack'''
+import atexit
+import os
 from os import environ as env
 
-from authlib.integrations.flask_client import OAuth
 from dotenv import find_dotenv, load_dotenv
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from hackernews.cache import PageCache
+from hackernews.config import configure_engine, database_settings
+from hackernews.metrics import MetricsStore
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
     load_dotenv(ENV_FILE)
 
-app = Flask(__name__)
-app.secret_key = env.get("APP_SECRET_KEY")
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-        'sqlite:////home/olives/Hacker_News/hackernews/instance/site.db'
-)
-db = SQLAlchemy(app)
+INSTANCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
 
-oauth = OAuth(app)
+db = SQLAlchemy()
+# shared by every app of the process; the factories point them at the configured files
+page_cache = PageCache(os.path.join(INSTANCE_PATH, 'page_cache.db'))
+metrics_store = MetricsStore(os.path.join(INSTANCE_PATH, 'metrics.db'))
+atexit.register(page_cache.flush)
+atexit.register(metrics_store.flush)
 
-oauth.register(
-    "auth0",
-    client_id=env.get("AUTH0_CLIENT_ID"),
-    client_secret=env.get("AUTH0_CLIENT_SECRET"),
-    client_kwargs={
-        "scope": "openid profile email",
-    },
-    server_metadata_url=f'https://{env.get("AUTH0_DOMAIN")}/.well-known/openid-configuration'
-)
-from hackernews import routes # pylint: disable=wrong-import-position
+def default_config(environ=None):
+    '''the settings read from environ, by default the environment (or .env)'''
+    environ = env if environ is None else environ
+    config = database_settings(environ)
+    config.update({
+        'SECRET_KEY': environ.get("APP_SECRET_KEY"),
+        'AUTH0_CLIENT_ID': environ.get("AUTH0_CLIENT_ID"),
+        'AUTH0_CLIENT_SECRET': environ.get("AUTH0_CLIENT_SECRET"),
+        'AUTH0_DOMAIN': environ.get("AUTH0_DOMAIN"),
+        'NEWSFEED_SNAPSHOT_PATH': os.path.join(INSTANCE_PATH, 'newsfeed.json'),
+        'EXPORT_TOKEN': environ.get("EXPORT_TOKEN"),
+        'PAGE_CACHE_PATH': os.path.join(INSTANCE_PATH, 'page_cache.db'),
+        'PAGE_CACHE_TTL': int(environ.get('PAGE_CACHE_TTL', 30)),
+        'PAGE_CACHE_SIZE': int(environ.get('PAGE_CACHE_SIZE', 256)),
+        'PAGE_CACHE_FLUSH_INTERVAL': float(environ.get('PAGE_CACHE_FLUSH_INTERVAL', 5)),
+        'METRICS_PATH': os.path.join(INSTANCE_PATH, 'metrics.db'),
+        'METRICS_FLUSH_INTERVAL': float(environ.get('METRICS_FLUSH_INTERVAL', 5)),
+        'QUERY_BUDGET': int(environ.get('QUERY_BUDGET', 10)),
+        'SERVER_TIMING': environ.get('SERVER_TIMING', '1') not in ('0', 'false'),
+        'RANK_GRAVITY': float(environ.get('RANK_GRAVITY', 1.8)),
+        'RANK_LIKE_WEIGHT': float(environ.get('RANK_LIKE_WEIGHT', 1)),
+        'RANK_DISLIKE_WEIGHT': float(environ.get('RANK_DISLIKE_WEIGHT', 1)),
+        'LIVE_POLL_INTERVAL': float(environ.get('LIVE_POLL_INTERVAL', 0.5)),
+        'LIVE_MAX_STREAMS': int(environ.get('LIVE_MAX_STREAMS', 12)),
+        'LIVE_STREAM_SECONDS': float(environ.get('LIVE_STREAM_SECONDS', 300)),
+        'LIVE_CHANGES_KEPT': int(environ.get('LIVE_CHANGES_KEPT', 10000)),
+        'RETENTION_MAX_AGE_DAYS': float(environ.get('RETENTION_MAX_AGE_DAYS', 30)),
+        'RETENTION_UNVOTED_ONLY': environ.get('RETENTION_UNVOTED_ONLY', '') in ('1', 'true'),
+        'RETENTION_BELOW_RANK': (float(environ['RETENTION_BELOW_RANK'])
+                if environ.get('RETENTION_BELOW_RANK') else None),
+    })
+    return config
+
+def create_ingest_app(config=None):
+    '''An app with only the database, the shared caches and the CLI commands: what
+    data.py and the cron jobs need. config overrides the settings from the environment'''
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config['SQLITE_PRAGMAS'])
+    page_cache.path = app.config['PAGE_CACHE_PATH']
+    page_cache.ttl = app.config['PAGE_CACHE_TTL']
+    page_cache.max_entries = app.config['PAGE_CACHE_SIZE']
+    page_cache.flush_interval = app.config['PAGE_CACHE_FLUSH_INTERVAL']
+    metrics_store.path = app.config['METRICS_PATH']
+    metrics_store.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+    # pylint: disable=import-outside-toplevel
+    from hackernews.export import export_posts_command
+    from hackernews.migrations import recount_votes_command, upgrade_db_command
+    from hackernews.ranking import compare_ranking_command, recompute_ranks_command
+    from hackernews.retention import archive_posts_command
+    for command in (export_posts_command, upgrade_db_command, recount_votes_command,
+            recompute_ranks_command, compare_ranking_command, archive_posts_command):
+        app.cli.add_command(command)
+    return app
+
+def create_app(config=None):
+    '''The website: the ingest app plus the blueprints, request instrumentation,
+    fingerprinted static files and response compression'''
+    app = create_ingest_app(config)
+    # pylint: disable=import-outside-toplevel
+    from hackernews import admin, assets, auth, compression, instrumentation, routes
+    app.register_blueprint(routes.bp)
+    app.register_blueprint(auth.bp)
+    app.register_blueprint(admin.bp)
+    instrumentation.init_app(app)
+    assets.init_app(app)
+    compression.init_app(app)
+    return app
@@ -0,0 +1,143 @@
+'''Admin dashboards, moderation and the machine endpoints (export and metrics)'''
+import datetime
+from sqlalchemy import delete, update
+from flask import (Blueprint, Response, abort, jsonify, redirect, render_template, request,
+        stream_with_context, url_for)
+from hackernews import db, metrics_store, page_cache
+from hackernews.auth import admin_or_token_required, admin_required
+from hackernews.export import export_lines, parse_fields
+from hackernews.feed import write_snapshot
+from hackernews.instrumentation import query_budget
+from hackernews.models import User, Post
+from hackernews.pagination import approximate_count, keyset_paginate, prefix_range
+from hackernews.roles import bump_role_version
+from hackernews.votes import retract_user_votes
+
+bp = Blueprint('admin', __name__)
+
+# keyset orderings, each backed by a composite index
+ADMIN_ORDER = (Post.time, Post.id)
+USER_ORDERS = {'username': (User.username, User.id), 'email': (User.email,)}
+USERS_PER_PAGE = 20
+
+@bp.route('/export.ndjson', methods=['GET'])
+@admin_or_token_required
+def export_posts():
+    '''Streams every post with its vote counts as NDJSON. Takes since_id or
+    since_time watermarks, a limit and a comma separated list of fields'''
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    lines = export_lines(fields, since_id=request.args.get('since_id', type=int),
+            since_time=request.args.get('since_time', type=int),
+            limit=request.args.get('limit', type=int))
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+@bp.route('/admin_post')
+@admin_required
+@query_budget(3)
+def admin_dashboard():
+    '''Admin dashboard to view and delete all posts'''
+    posts = []
+    all_posts = keyset_paginate(db.session.query(Post), ADMIN_ORDER,
+            cursor=request.args.get('cursor'), per_page=5)
+    total = approximate_count(Post)
+    for i in all_posts.items:
+        entry = {
+                    'by': i.author,
+                    'descendants': i.descendants,
+                    'id': i.id,
+                    'score': i.score,
+                    'title': i.title,
+                    'type': i.posttype,
+                    'time': datetime.datetime.fromtimestamp(i.time),
+                    'url': i.url,
+                    'likes': i.likes_count,
+                    'dislikes': i.dislikes_count,
+                    'hidden': i.hidden
+                }
+        posts.append(entry)
+    return render_template('admin_posts.html',title='Admin', posts=posts, total=total,
+            cursor=request.args.get('cursor'), next_cursor=all_posts.next_cursor,
+            prev_cursor=all_posts.prev_cursor)
+
+@bp.route('/admin_user')
+@admin_required
+@query_budget(3)
+def admin_user_dashboard():
+    '''Admin dashboard to view and delete users, a page at a time, optionally only the
+    users whose username or email starts with the q parameter'''
+    field = request.args.get('field')
+    if field not in USER_ORDERS:
+        field = 'username'
+    prefix = request.args.get('q', '').strip()
+    order = USER_ORDERS[field]
+    query = db.session.query(User)
+    if prefix:
+        query = query.filter(*prefix_range(order[0], prefix))
+    page = keyset_paginate(query, order, cursor=request.args.get('cursor'),
+            per_page=USERS_PER_PAGE, descending=False)
+    return render_template('admin_users.html', title='Admin', users=page.items, q=prefix,
+            field=field, next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+@bp.route('/admin_cache')
+@admin_required
+def admin_cache_stats():
+    '''Hit/miss statistics of the shared page cache'''
+    return jsonify(page_cache.stats())
+
+@bp.route('/metrics')
+@admin_or_token_required
+def metrics():
+    '''Request, database, page cache and job metrics of every worker in the Prometheus
+    text format; scrapers authenticate with the EXPORT_TOKEN bearer token'''
+    metrics_store.flush()
+    stats = page_cache.stats()
+    extra = {('hackernews_page_cache_hits_total', ''): stats['hits'],
+            ('hackernews_page_cache_misses_total', ''): stats['misses'],
+            ('hackernews_page_cache_entries', ''): stats['entries'],
+            ('hackernews_page_cache_hit_ratio', ''): stats['hit_ratio']}
+    return Response(metrics_store.render(extra), mimetype='text/plain; version=0.0.4')
+
+@bp.route("/delete-user/<user_id>", methods=['GET'])
+@admin_required
+def delete_user(user_id):
+    '''Request that handles the admin deleting the user. The votes and role grants go
+    with the user through ON DELETE CASCADE, so none of them are loaded'''
+    retract_user_votes(user_id)
+    db.session.execute(delete(User).where(User.id == user_id))
+    bump_role_version()
+    db.session.commit()
+    page_cache.invalidate()
+    return redirect(url_for('admin.admin_user_dashboard'))
+
+@bp.route("/delete-post/<post_id>", methods=['GET'])
+@admin_required
+def delete_post(post_id):
+    '''Request that handles the admin deleting a post'''
+    post_to_delete = db.session.get(Post, post_id)
+    db.session.delete(post_to_delete)
+    db.session.commit()
+    write_snapshot()
+    page_cache.invalidate()
+    return redirect(url_for('admin.admin_dashboard'))
+
+@bp.route("/admin_post/bulk", methods=['POST'])
+@admin_required
+def bulk_moderate_posts():
+    '''Deletes, hides or unhides every selected post in one transaction'''
+    action = request.form.get('action')
+    post_ids = [int(i) for i in request.form.getlist('post_id') if i.isdigit()]
+    if action not in ('delete', 'hide', 'unhide'):
+        return abort(400)
+    if post_ids:
+        if action == 'delete':
+            db.session.execute(delete(Post).where(Post.id.in_(post_ids)))
+        else:
+            db.session.execute(update(Post).where(Post.id.in_(post_ids))
+                    .values(hidden=action == 'hide'))
+        db.session.commit()
+        write_snapshot()
+        page_cache.invalidate()
+    return redirect(url_for('admin.admin_dashboard', cursor=request.form.get('cursor') or None))
@@ -0,0 +1,51 @@
+'''Fingerprinted static files: url_for('static', ...) adds a hash of the file's content
+as ?v=..., so a changed file gets a new URL and a versioned URL can be cached for a year'''
+import hashlib
+import os
+from flask import current_app, request
+
+CACHE_FOREVER = 365 * 24 * 3600
+
+_hashes = {}
+
+def file_hash(path):
+    '''the first 12 hex digits of the md5 of the file at path, hashed again only when the
+    file changes'''
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    digest = _hashes.get(key)
+    if digest is None:
+        with open(path, 'rb') as file:
+            digest = hashlib.md5(file.read(), usedforsecurity=False).hexdigest()[:12]
+        _hashes[key] = digest
+    return digest
+
+def add_version(endpoint, values):
+    '''adds v=<hash> to every url_for('static', filename=...)'''
+    if endpoint != 'static' or 'v' in values:
+        return
+    try:
+        values['v'] = file_hash(os.path.join(current_app.static_folder, values['filename']))
+    except OSError:
+        pass
+
+def cache_versioned(response):
+    '''lets browsers keep a static file for a year when it was asked for by its current
+    hash'''
+    if request.endpoint != 'static' or response.status_code != 200:
+        return response
+    filename = (request.view_args or {}).get('filename', '')
+    try:
+        current = file_hash(os.path.join(current_app.static_folder, filename))
+    except OSError:
+        return response
+    if request.args.get('v') == current:
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_FOREVER
+        response.cache_control.immutable = True
+    return response
+
+def init_app(app):
+    '''fingerprints the static files of app'''
+    app.url_defaults(add_version)
+    app.after_request(cache_versioned)
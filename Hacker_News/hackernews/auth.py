@@ -0,0 +1,150 @@
+'''Login through Auth0, the account pages and the decorators guarding the other views.
+The Auth0 client (and authlib with it) is only set up on the first login'''
+from urllib.parse import quote_plus, urlencode
+
+import secrets
+import threading
+from functools import wraps
+from flask import (Blueprint, abort, current_app, redirect, render_template, request, session,
+        url_for)
+from hackernews import db
+from hackernews.models import User, Role
+from hackernews.roles import user_roles
+
+bp = Blueprint('auth', __name__)
+
+_client_lock = threading.Lock()
+
+def auth0():
+    '''the app's Auth0 client, registered on first use'''
+    client = current_app.extensions.get('auth0')
+    if client is None:
+        # pylint: disable=import-outside-toplevel
+        from authlib.integrations.flask_client import OAuth
+        with _client_lock:
+            client = current_app.extensions.get('auth0')
+            if client is None:
+                client = OAuth(current_app).register(
+                    "auth0",
+                    client_id=current_app.config["AUTH0_CLIENT_ID"],
+                    client_secret=current_app.config["AUTH0_CLIENT_SECRET"],
+                    client_kwargs={
+                        "scope": "openid profile email",
+                    },
+                    server_metadata_url=(f'https://{current_app.config["AUTH0_DOMAIN"]}'
+                            '/.well-known/openid-configuration')
+                )
+                current_app.extensions['auth0'] = client
+    return client
+
+def is_authenticated(func):
+    '''Checks if user is logged in'''
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        if not session:
+            session['next'] = request.url
+            # Redirect to login page if access token is not found
+            return redirect(url_for('auth.login'))
+        # Further validation can be performed using Auth0's token validation methods
+        return func(*args, **kwargs)
+    return decorated_function
+
+def admin_required(func):
+    '''Checks if user has admin role, using the per-process role cache'''
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        if not session:
+            return redirect(url_for('auth.login'))
+        userid = session.get('user').get('userinfo').get('sub')
+        if 'admin' not in user_roles(userid):
+            return abort(403)
+        return func(*args, **kwargs)
+    return decorated_function
+
+def admin_or_token_required(func):
+    '''Lets machine clients in with the EXPORT_TOKEN bearer token, and everyone else
+    through admin_required'''
+    admin_func = admin_required(func)
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        token = current_app.config.get('EXPORT_TOKEN')
+        given = request.headers.get('Authorization', '')
+        if token and secrets.compare_digest(given.encode(), f'Bearer {token}'.encode()):
+            return func(*args, **kwargs)
+        return admin_func(*args, **kwargs)
+    return decorated_function
+
+@bp.route("/login")
+def login():
+    '''Calls Auth0 to handle login, which redirects to callback'''
+    return auth0().authorize_redirect(
+        redirect_uri=url_for("auth.callback", _external=True)
+    )
+
+@bp.route("/callback", methods=["GET", "POST"])
+def callback():
+    '''Redirect from Auth0. Collects session information after login'''
+    token = auth0().authorize_access_token()
+    session["user"] = token
+    profile = token.get('userinfo')
+    if profile:
+        user_id = profile.get('sub')
+        existing_user = db.session.query(User).filter_by(id=user_id).first()
+        #print(existing_user, file=open('/home/olives/Hacker_News/hackernews/output.txt', 'a'))
+        if not existing_user:
+            curr_user = User(id=user_id, username=profile.get('name'),
+                    email=profile.get('email'), image_file=profile.get('picture'))
+            db.session.add(curr_user)
+            db.session.flush()
+
+            member_role = Role.query.filter_by(name='member').first()
+            if member_role:
+                curr_user.roles.append(member_role)
+            db.session.commit()
+        roles = db.session.query(User).filter_by(id=user_id).first().roles
+        role_names = [role.name for role in roles]
+        session['roles'] = role_names
+
+    if "next" in session:
+        next_url = session['next']
+        session.pop('next', None)
+        return redirect(next_url)
+
+    return redirect("/")
+
+@bp.route("/logout")
+def logout():
+    '''Logout functionality handled by Auth0'''
+    session.clear()
+    return redirect(
+        "https://" + current_app.config["AUTH0_DOMAIN"]
+        + "/v2/logout?"
+        + urlencode(
+            {
+                "returnTo": url_for("main.home", _external=True),
+                "client_id": current_app.config["AUTH0_CLIENT_ID"],
+            },
+            quote_via=quote_plus,
+        )
+    )
+
+@bp.route("/account")
+@is_authenticated
+def account():
+    '''Renders the user profile page, only if logged in'''
+    return render_template('account.html', title='Account')
+
+@bp.route('/get_admin')
+@is_authenticated
+def get_admin():
+    '''assign current user an admin role'''
+    userid = session.get('user').get('userinfo').get('sub')
+    u = db.session.query(User).filter_by(id=userid).first()
+    if u:
+        role = db.session.query(Role).filter_by(name='admin').first()
+        if role:
+            role_names = [role.name for role in u.roles]
+            if 'admin' not in role_names:
+                u.roles.append(role)
+                db.session.commit()
+    return redirect(url_for('main.home'))
@@ -0,0 +1,189 @@
+'''Cache of rendered pages shared by every gunicorn worker through a small sqlite file.
+Entries expire after a TTL, the least recently used ones are evicted past a size
+limit, and writers invalidate either everything or the pages showing one post.
+Lookups only read the file: hit/miss counts and access times are kept in memory and
+written at most every flush_interval seconds, and a file that can not be read or
+written is treated as a miss'''
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS page (key TEXT PRIMARY KEY, generation INTEGER NOT NULL, '
+    'body TEXT NOT NULL, tags TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_page_accessed ON page (accessed)',
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+    "INSERT OR IGNORE INTO meta (name, value) VALUES "
+    "('generation', 0), ('hits', 0), ('misses', 0)",
+)
+
+class PageCache: # pylint: disable=too-many-instance-attributes
+    '''Rendered HTML keyed by a string. Reads return (body, generation); a page rendered
+    after a miss is only stored if no invalidation happened in between'''
+    def __init__(self, path, ttl=30, max_entries=256, flush_interval=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._accessed = {}
+        self._flushed = time.monotonic()
+        self._invalidation_pending = False
+
+    def _db(self):
+        '''one autocommit connection per thread, created on first use'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # the cache can always be rebuilt, so it never needs to be fsynced
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def _take_pending(self):
+        '''the counts and access times held in memory, handed over to be written'''
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            accessed, self._accessed = self._accessed, {}
+            self._flushed = time.monotonic()
+        return counts, accessed
+
+    def _restore_pending(self, counts, accessed):
+        '''keeps counts and access times that could not be written for the next flush'''
+        with self._lock:
+            self._counts.update(counts)
+            for key, when in accessed.items():
+                self._accessed[key] = max(when, self._accessed.get(key, when))
+
+    @staticmethod
+    def _write_pending(conn, counts, accessed):
+        '''adds counts to the shared counters and moves the access times forward, inside
+        the caller's transaction'''
+        conn.executemany('UPDATE meta SET value = value + ? WHERE name = ?',
+                [(value, name) for name, value in counts.items()])
+        conn.executemany('UPDATE page SET accessed = max(accessed, ?) WHERE key = ?',
+                [(when, key) for key, when in accessed.items()])
+
+    def flush(self):
+        '''writes the hit/miss counts and access times of this process in one
+        transaction; if the file is locked or broken they are kept for the next flush'''
+        counts, accessed = self._take_pending()
+        if not counts and not accessed:
+            return
+        conn = None
+        try:
+            conn = self._db()
+            conn.execute('BEGIN IMMEDIATE')
+            self._write_pending(conn, counts, accessed)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self._restore_pending(counts, accessed)
+
+    def maybe_flush(self):
+        '''flushes if the last flush of this process is flush_interval seconds old'''
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def lookup(self, key):
+        '''returns (body, generation); body is None on a miss. generation is None if the
+        cache file could not be read or an invalidation is still pending, and then
+        nothing is stored'''
+        now = time.time()
+        if self._invalidation_pending:
+            # pages in the file may be stale until the invalidation goes through
+            self.invalidate()
+        generation, body = None, None
+        if not self._invalidation_pending:
+            try:
+                generation, body = self._db().execute('SELECT meta.value, page.body '
+                        'FROM meta LEFT JOIN page ON page.key = ? AND page.generation = '
+                        "meta.value AND page.created > ? WHERE meta.name = 'generation'",
+                        (key, now - self.ttl)).fetchone()
+            except sqlite3.Error:
+                generation, body = None, None
+        with self._lock:
+            self._counts['hits' if body is not None else 'misses'] += 1
+            if body is not None:
+                self._accessed[key] = now
+        self.maybe_flush()
+        return body, generation
+
+    def store(self, key, body, generation, tags=()):
+        '''stores body if the cache was not invalidated since generation was read, then
+        evicts the least recently used entries past max_entries. The access times and
+        counts held in memory are written in the same transaction. Does nothing if the
+        file is locked or broken'''
+        if self.ttl <= 0 or generation is None:
+            return
+        now = time.time()
+        tag_text = ',' + ','.join(str(tag) for tag in tags) + ','
+        counts, accessed = self._take_pending()
+        conn = None
+        try:
+            conn = self._db()
+            conn.execute('BEGIN IMMEDIATE')
+            self._write_pending(conn, counts, accessed)
+            conn.execute('INSERT OR REPLACE INTO page (key, generation, body, tags, created, '
+                    'accessed) SELECT ?, ?, ?, ?, ?, ? FROM meta '
+                    "WHERE name = 'generation' AND value = ?",
+                    (key, generation, body, tag_text, now, now, generation))
+            conn.execute('DELETE FROM page WHERE key IN (SELECT key FROM page '
+                    'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self._restore_pending(counts, accessed)
+
+    def invalidate(self):
+        '''drops every page, including ones being rendered right now. If the file can
+        not be written, this process serves no cached pages until a later lookup manages
+        to drop them'''
+        conn = None
+        try:
+            conn = self._db()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+            conn.execute('DELETE FROM page')
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            if not self._invalidation_pending:
+                logger.exception('invalidating the page cache at %s failed', self.path)
+            self._invalidation_pending = True
+            return
+        self._invalidation_pending = False
+
+    def invalidate_tag(self, tag):
+        '''drops the pages stored with tag, e.g. every page showing one post; falls back
+        to invalidate() if that fails'''
+        try:
+            self._db().execute('DELETE FROM page WHERE tags LIKE ?', (f'%,{tag},%',))
+        except sqlite3.Error:
+            logger.exception('dropping pages tagged %s from %s failed', tag, self.path)
+            self.invalidate()
+
+    def stats(self):
+        '''hit/miss counters and size, summed over every worker; this process's counts
+        are written first'''
+        self.flush()
+        conn = self._db()
+        stats = dict(conn.execute('SELECT name, value FROM meta'))
+        stats['entries'], = conn.execute('SELECT count(*) FROM page').fetchone()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
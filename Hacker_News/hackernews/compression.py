@@ -0,0 +1,39 @@
+'''Compresses HTML and JSON responses for clients that accept it: with brotli when the
+brotli package is installed and the client takes it, with gzip otherwise'''
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError: # brotli is optional, gzip is always offered
+    brotli = None
+
+COMPRESSIBLE = ('text/html', 'application/json')
+# below this many bytes the headers cost more than compression saves
+MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def compress_response(response):
+    '''encodes the body of a finished HTML or JSON response. Streams, files and bodies
+    that are already encoded, like the newsfeed snapshot, are left alone'''
+    if (response.mimetype not in COMPRESSIBLE or response.is_streamed
+            or response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(
+            ['br', 'gzip'] if brotli is not None else ['gzip'])
+    body = response.get_data()
+    if encoding is None or len(body) < MIN_SIZE:
+        return response
+    if encoding == 'br':
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_app(app):
+    '''compresses the responses of app'''
+    app.after_request(compress_response)
@@ -0,0 +1,68 @@
+'''Database settings, read from the environment (or .env) so the web workers, the
+cron jobs and the tests can point at different databases and tune them'''
+from sqlalchemy import event
+
+DEFAULT_DATABASE_URI = 'sqlite:////home/olives/Hacker_News/hackernews/instance/site.db'
+
+# WAL lets the gunicorn workers keep reading while data.py writes, NORMAL is durable
+# in WAL mode without an fsync per commit, busy_timeout makes a writer wait for
+# the lock instead of failing with "database is locked", and foreign_keys makes
+# sqlite honour ON DELETE CASCADE
+SQLITE_DEFAULTS = {
+    'SQLITE_FOREIGN_KEYS': 'ON',
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_BUSY_TIMEOUT': '5000',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_MMAP_SIZE': str(256 * 1024 * 1024),
+}
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': '5',
+    'DB_MAX_OVERFLOW': '10',
+    'DB_POOL_RECYCLE': '1800',
+}
+
+def database_uri(environ):
+    '''DATABASE_URL, accepting the postgres:// scheme some hosts hand out'''
+    uri = environ.get('DATABASE_URL') or DEFAULT_DATABASE_URI
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+def database_settings(environ):
+    '''Flask config for the database: URI, engine/pool options and sqlite pragmas'''
+    def setting(name):
+        return environ.get(name) or {**SQLITE_DEFAULTS, **POOL_DEFAULTS}[name]
+    uri = database_uri(environ)
+    engine_options = {'pool_recycle': int(setting('DB_POOL_RECYCLE'))}
+    # in-memory sqlite uses a single connection pool that takes no size
+    if ':memory:' not in uri and uri != 'sqlite://':
+        engine_options['pool_size'] = int(setting('DB_POOL_SIZE'))
+        engine_options['max_overflow'] = int(setting('DB_MAX_OVERFLOW'))
+    if not uri.startswith('sqlite'):
+        engine_options['pool_pre_ping'] = True
+    return {
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options,
+        'SQLITE_PRAGMAS': {
+            'foreign_keys': setting('SQLITE_FOREIGN_KEYS'),
+            'journal_mode': setting('SQLITE_JOURNAL_MODE'),
+            'busy_timeout': int(setting('SQLITE_BUSY_TIMEOUT')),
+            'synchronous': setting('SQLITE_SYNCHRONOUS'),
+            'mmap_size': int(setting('SQLITE_MMAP_SIZE')),
+        },
+    }
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    '''runs PRAGMA name=value on a new sqlite connection'''
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+def configure_engine(engine, pragmas):
+    '''applies pragmas to every connection the engine opens, if it is sqlite'''
+    if engine.dialect.name != 'sqlite':
+        return
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record): # pylint: disable=unused-argument
+        apply_sqlite_pragmas(dbapi_connection, pragmas)
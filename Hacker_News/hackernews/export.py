@@ -0,0 +1,74 @@
+'''Streaming NDJSON export of every stored post and its vote counts'''
+import json
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from hackernews import db
+from hackernews.models import Post
+
+EXPORT_COLUMNS = {
+    'id': Post.id,
+    'by': Post.author,
+    'title': Post.title,
+    'url': Post.url,
+    'type': Post.posttype,
+    'time': Post.time,
+    'score': Post.score,
+    'descendants': Post.descendants,
+    'kids': None, # gathered from the comment table once per batch
+    'likes': Post.likes_count,
+    'dislikes': Post.dislikes_count,
+    'popularity': Post.popularity,
+}
+DEFAULT_FIELDS = tuple(name for name in EXPORT_COLUMNS if name != 'kids')
+BATCH_SIZE = 1000
+
+def parse_fields(text):
+    '''comma separated field names, or the defaults; raises ValueError on unknown names'''
+    if not text:
+        return DEFAULT_FIELDS
+    fields = tuple(name.strip() for name in text.split(',') if name.strip())
+    unknown = [name for name in fields if name not in EXPORT_COLUMNS]
+    if unknown or not fields:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return fields
+
+def export_lines(fields=DEFAULT_FIELDS, since_id=None, since_time=None, limit=None):
+    '''Yields one json line per post. Rows come from a streaming cursor in batches of
+    BATCH_SIZE, so memory stays flat however many posts are exported, and kids are
+    read with one IN query per batch. With since_time posts are ordered by (time, id),
+    otherwise by id, so the last line is the watermark for the next export'''
+    columns = [name for name in fields if name != 'kids']
+    stmt = select(Post.id, *[EXPORT_COLUMNS[name] for name in columns])
+    if since_id is not None:
+        stmt = stmt.where(Post.id > since_id)
+    if since_time is not None:
+        stmt = stmt.where(Post.time > since_time).order_by(Post.time, Post.id)
+    else:
+        stmt = stmt.order_by(Post.id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    rows = db.session.execute(stmt.execution_options(yield_per=BATCH_SIZE))
+    for batch in rows.partitions():
+        kids = Post.kids_of([row[0] for row in batch]) if 'kids' in fields else {}
+        for post_id, *values in batch:
+            line = dict(zip(columns, values))
+            if 'kids' in fields:
+                line['kids'] = kids[post_id]
+            yield json.dumps({name: line[name] for name in fields},
+                    separators=(',', ':')) + '\n'
+
+@click.command('export-posts')
+@with_appcontext
+@click.option('--fields', default='', help='comma separated fields to export')
+@click.option('--since-id', type=int, help='only posts with a larger id')
+@click.option('--since-time', type=int, help='only posts posted after this unix time')
+@click.option('--limit', type=int, help='export at most this many posts')
+def export_posts_command(fields, since_id, since_time, limit):
+    '''Writes posts as NDJSON to stdout'''
+    try:
+        fields = parse_fields(fields)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--fields') from error
+    for line in export_lines(fields, since_id=since_id, since_time=since_time, limit=limit):
+        click.echo(line, nl=False)
@@ -0,0 +1,74 @@
+'''Pre-serialized snapshot of the /newsfeed json. Ingestion rewrites the snapshot file
+when it commits; each worker reloads and compresses it once when the file changes,
+so a request only picks a ready-made body'''
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import namedtuple
+from flask import current_app
+from hackernews import db
+from hackernews.models import Post
+
+try:
+    import brotli
+except ImportError: # brotli is optional, gzip is always offered
+    brotli = None
+
+FEED_SIZE = 30
+
+Snapshot = namedtuple('Snapshot', ['bodies', 'etag', 'last_modified'])
+
+_loaded = {}
+
+def feed_items():
+    '''the 30 most recent posts, shaped like the hacker news api'''
+    posts = db.session.query(Post).filter(Post.hidden.is_(False)) \
+            .order_by(Post.time.desc()).limit(FEED_SIZE).all()
+    kids = Post.kids_of([i.id for i in posts])
+    return [{
+                'by': i.author,
+                'descendants': i.descendants,
+                'id': i.id,
+                'kids': kids[i.id],
+                'score': i.score,
+                'title': i.title,
+                'type': i.posttype,
+                'time': i.time,
+                'url': i.url
+            } for i in posts]
+
+def write_snapshot(path=None):
+    '''Serializes the feed and atomically replaces the snapshot file. Needs an app context'''
+    path = path or current_app.config['NEWSFEED_SNAPSHOT_PATH']
+    body = json.dumps({"news_items": feed_items()}, sort_keys=True,
+            separators=(',', ':')).encode()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(handle, 'wb') as file:
+        file.write(body)
+    os.replace(tmp_path, path)
+
+def load_snapshot(path=None):
+    '''Returns the current Snapshot, reloading it only when the file changed and
+    writing it first if it does not exist yet'''
+    path = path or current_app.config['NEWSFEED_SNAPSHOT_PATH']
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        write_snapshot(path)
+        stat = os.stat(path)
+    cached = _loaded.get(path)
+    version = (stat.st_ino, stat.st_mtime_ns)
+    if cached and cached[0] == version:
+        return cached[1]
+    with open(path, 'rb') as file:
+        body = file.read()
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+    snapshot = Snapshot(bodies=bodies, etag=hashlib.sha1(body).hexdigest(),
+            last_modified=int(stat.st_mtime))
+    _loaded[path] = (version, snapshot)
+    return snapshot
@@ -0,0 +1,201 @@
+'''Concurrent, connection-pooled client for the hacker news firebase api'''
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, delete, or_, update
+from hackernews import db
+from hackernews.models import AppState, Comment, Post, dialect_insert
+
+HN_API_URL = "https://hacker-news.firebaseio.com/v0"
+DEFAULT_DEPTH = 50
+DEFAULT_WORKERS = 8
+UPSERT_BATCH = 500
+REFRESHED_COLUMNS = ('score', 'descendants')
+SYNC_MAXITEM = 'sync.maxitem'
+SYNC_TIME = 'sync.time'
+# how far back the updates feed is trusted to reach; a sync later than this after the
+# last one may have missed changes, so it refreshes every stored front page story
+SYNC_WINDOW = 600
+
+# full is True when the last sync was too long ago and the front page was refreshed
+SyncResult = namedtuple('SyncResult', ['fetched', 'refreshed', 'maxitem', 'full'])
+
+class HNClient:
+    '''Fetches items from the hacker news api over a shared keep-alive session.
+    Items are fetched concurrently by a bounded pool of worker threads.'''
+    def __init__(self, base_url=HN_API_URL, workers=DEFAULT_WORKERS, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''closes every pooled connection'''
+        self.session.close()
+
+    def get_json(self, path):
+        '''returns the decoded json at path, or None if the request failed'''
+        try:
+            response = self.session.get(f"{self.base_url}/{path}.json", timeout=self.timeout)
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    def top_stories(self):
+        '''returns the ids of the current top stories'''
+        return self.get_json('topstories')
+
+    def item(self, item_id):
+        '''returns a single item, or None if it could not be fetched'''
+        return self.get_json(f'item/{item_id}')
+
+    def max_item(self):
+        '''returns the largest item id handed out so far, or None if the request failed'''
+        return self.get_json('maxitem')
+
+    def updates(self):
+        '''returns the ids of items that changed recently, or None if the feed could not
+        be fetched'''
+        changes = self.get_json('updates')
+        if not isinstance(changes, dict):
+            return None
+        return changes.get('items', [])
+
+    def items(self, item_ids):
+        '''fetches every id in item_ids concurrently, keeping the order of item_ids
+        and dropping items that could not be fetched'''
+        item_ids = list(item_ids)
+        if not item_ids:
+            return []
+        if self.workers == 1 or len(item_ids) == 1:
+            results = [self.item(item_id) for item_id in item_ids]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(item_ids))) as pool:
+                results = list(pool.map(self.item, item_ids))
+        return [item for item in results if item]
+
+def is_story(item):
+    '''only stories that link to a url are shown on the site'''
+    return item.get('type') == 'story' and item.get('url') is not None
+
+def post_row(item):
+    '''maps an api item onto the columns of the post table'''
+    return {
+        'author': item.get('by'),
+        'descendants': item.get('descendants'),
+        'id': item['id'],
+        'score': item.get('score'),
+        'posttype': item.get('type'),
+        'title': item.get('title'),
+        'time': item.get('time'),
+        'url': item.get('url'),
+        'popularity': 0,
+    }
+
+def upsert_posts(items):
+    '''Writes items to the post table in one transaction using multi-row
+    INSERT ... ON CONFLICT statements. New ids are inserted, and rows that already
+    exist only get their score, descendants and kids refreshed, so likes and
+    popularity are kept. Returns the number of rows written'''
+    rows = [post_row(item) for item in items]
+    for start in range(0, len(rows), UPSERT_BATCH):
+        stmt = dialect_insert(Post.__table__).values(rows[start:start + UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+                index_elements=[Post.__table__.c.id],
+                set_={column: stmt.excluded[column] for column in REFRESHED_COLUMNS})
+        db.session.execute(stmt)
+    store_kids(items)
+    db.session.commit()
+    return len(rows)
+
+def store_kids(items):
+    '''Brings the comment table in line with the kids of items, which must be stored
+    posts: the stored kids are read with one IN query per batch, and only posts whose
+    kids changed get their rows upserted and their dropped kids deleted. Returns the
+    ids of those posts; the caller commits'''
+    fresh = {item['id']: item.get('kids') or [] for item in items}
+    post_ids = list(fresh)
+    stored = {}
+    for start in range(0, len(post_ids), UPSERT_BATCH):
+        stored.update(Post.kids_of(post_ids[start:start + UPSERT_BATCH]))
+    changed = [post_id for post_id in post_ids if stored[post_id] != fresh[post_id]]
+    dropped = [kid for post_id in changed for kid in set(stored[post_id]) - set(fresh[post_id])]
+    rows = [{'id': kid, 'post_id': post_id, 'position': position, 'path': Comment.path_for(kid)}
+            for post_id in changed for position, kid in enumerate(fresh[post_id])]
+    delete_comments(dropped)
+    for start in range(0, len(rows), UPSERT_BATCH):
+        stmt = dialect_insert(Comment.__table__).values(rows[start:start + UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+                index_elements=[Comment.__table__.c.id],
+                set_={'post_id': stmt.excluded.post_id, 'position': stmt.excluded.position})
+        db.session.execute(stmt)
+    return changed
+
+def delete_comments(comment_ids):
+    '''deletes comments and every reply below them; the caller commits'''
+    for start in range(0, len(comment_ids), UPSERT_BATCH):
+        batch = comment_ids[start:start + UPSERT_BATCH]
+        subtrees = db.session.query(Comment.post_id, Comment.path).filter(Comment.id.in_(batch))
+        db.session.execute(delete(Comment).where(or_(Comment.id.in_(batch), *[
+                and_(Comment.post_id == post_id, Comment.path.startswith(path + '/'))
+                for post_id, path in subtrees])))
+
+def refresh_posts(items):
+    '''Updates score, descendants and kids of stored posts whose values differ from
+    items, with one executemany UPDATE. Posts that are no longer stored are left
+    alone. Returns the number of posts that changed; the caller commits'''
+    items = {item['id']: item for item in items}
+    if not items:
+        return 0
+    stored = db.session.query(Post.id, *[getattr(Post, c) for c in REFRESHED_COLUMNS]) \
+            .filter(Post.id.in_(items)).all()
+    changes = []
+    for row in stored:
+        fresh = post_row(items[row.id])
+        if any(getattr(row, column) != fresh[column] for column in REFRESHED_COLUMNS):
+            changes.append({'id': row.id, **{c: fresh[c] for c in REFRESHED_COLUMNS}})
+    if changes:
+        db.session.execute(update(Post), changes)
+    kids_changed = store_kids([items[row.id] for row in stored])
+    return len({change['id'] for change in changes} | set(kids_changed))
+
+def sync_updates(client, now=None):
+    '''Refreshes the stored posts listed in the api's updates feed and moves the
+    persisted sync cursor (the last maxitem seen and when) forward. Only posts that
+    are stored are fetched, so one run costs a handful of requests. If there is no
+    cursor yet, or it is older than SYNC_WINDOW, the feed may not reach back to it, so
+    the stored stories on the api's front page are refreshed as well. The cursor only
+    moves when the feed was read'''
+    now = int(now or time.time())
+    last_sync = AppState.get(SYNC_TIME)
+    full = last_sync is None or now - int(last_sync) > SYNC_WINDOW
+    maxitem = client.max_item()
+    updates = client.updates()
+    changed = list(updates or [])
+    if full:
+        changed += client.top_stories() or []
+    stored = [row.id for row in db.session.query(Post.id).filter(Post.id.in_(set(changed)))]
+    items = [item for item in client.items(stored) if is_story(item)]
+    refreshed = refresh_posts(items)
+    # without the feed nothing is known about this run's window, so the cursor stays
+    # put and the next run catches up once the feed is back
+    if updates is not None:
+        if maxitem is not None:
+            AppState.set(SYNC_MAXITEM, maxitem)
+        AppState.set(SYNC_TIME, now)
+    db.session.commit()
+    return SyncResult(fetched=len(items), refreshed=refreshed, maxitem=maxitem, full=full)
@@ -0,0 +1,122 @@
+'''Per-request instrumentation: the SQL statements a request runs, the time spent in
+the database and in templates, reported in a Server-Timing header and checked against
+a query budget so a route that starts querying per row shows up in the logs'''
+import time
+from contextlib import contextmanager
+from flask import (before_render_template, current_app, has_request_context, request,
+        template_rendered)
+from sqlalchemy import event
+from hackernews import db, metrics_store
+
+TIMING_KEY = 'hackernews.timing'
+
+class RequestTiming:
+    '''counters of one request, kept in its WSGI environ so they survive app contexts
+    pushed while it is handled (each with a fresh flask.g)'''
+    __slots__ = ('start', 'queries', 'db_time', 'render_time', 'render_start')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_start = None
+
+    def server_timing(self):
+        '''the Server-Timing header value, durations in milliseconds'''
+        total = (time.perf_counter() - self.start) * 1000
+        return (f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries", '
+                f'render;dur={self.render_time * 1000:.1f}, total;dur={total:.1f}')
+
+def current_timing():
+    '''the RequestTiming of the request being handled, or None outside of one'''
+    if not has_request_context():
+        return None
+    return request.environ.get(TIMING_KEY)
+
+def query_budget(limit):
+    '''sets how many statements a view may run before a warning is logged, instead
+    of QUERY_BUDGET; put it below @bp.route and any other decorators'''
+    def decorate(func):
+        func.query_budget = limit
+        return func
+    return decorate
+
+@contextmanager
+def count_queries(engine=None):
+    '''list of every SQL statement run on engine (by default the one of the current
+    app) in the block'''
+    if engine is None:
+        engine = db.engine
+    statements = []
+    def record(conn, cursor, statement, *args): # pylint: disable=unused-argument
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+def _query_started(conn, cursor, statement, *args): # pylint: disable=unused-argument
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _query_finished(conn, cursor, statement, *args): # pylint: disable=unused-argument
+    started = conn.info['query_start'].pop()
+    timing = current_timing()
+    if timing is not None:
+        timing.queries += 1
+        timing.db_time += time.perf_counter() - started
+
+def _render_started(sender, template, context, **extra): # pylint: disable=unused-argument
+    timing = current_timing()
+    if timing is not None:
+        timing.render_start = time.perf_counter()
+
+def _render_finished(sender, template, context, **extra): # pylint: disable=unused-argument
+    timing = current_timing()
+    if timing is not None and timing.render_start is not None:
+        timing.render_time += time.perf_counter() - timing.render_start
+        timing.render_start = None
+
+def start_timing():
+    '''starts counting for the request'''
+    request.environ[TIMING_KEY] = RequestTiming()
+
+def record_request(timing, status):
+    '''adds the request to the shared metrics, labelled by the endpoint it matched'''
+    route = request.endpoint or 'unmatched'
+    metrics_store.inc('hackernews_requests_total',
+            (('route', route), ('method', request.method), ('status', status)))
+    if status >= 500:
+        metrics_store.inc('hackernews_request_errors_total', (('route', route),))
+    metrics_store.observe('hackernews_request_duration_seconds',
+            time.perf_counter() - timing.start, (('route', route),))
+    metrics_store.inc('hackernews_db_queries_total', (('route', route),), timing.queries)
+    metrics_store.inc('hackernews_db_seconds_total', (('route', route),), timing.db_time)
+    metrics_store.maybe_flush()
+
+def report_timing(response):
+    '''adds the Server-Timing header, records the request's metrics and warns about
+    routes over their query budget'''
+    timing = current_timing()
+    if timing is None:
+        return response
+    if current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = timing.server_timing()
+    record_request(timing, response.status_code)
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', current_app.config['QUERY_BUDGET'])
+    if budget is not None and timing.queries > budget:
+        current_app.logger.warning('%s %s ran %d queries, over its budget of %d',
+                request.method, request.path, timing.queries, budget)
+    return response
+
+def init_app(app):
+    '''times the queries, templates and requests of app'''
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _query_started)
+        event.listen(db.engine, 'after_cursor_execute', _query_finished)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    app.before_request(start_timing)
+    app.after_request(report_timing)
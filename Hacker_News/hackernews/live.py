@@ -0,0 +1,205 @@
+'''Live like/dislike counts for the pages visitors have open. Every vote also writes a
+vote_change row; one thread per worker follows that table and hands the newest counts
+to the streams of that worker that show the post. A stream keeps only the latest
+counts per post until its client takes them, so a burst of votes on a post becomes one
+update and a slow client holds at most one entry per post it shows'''
+import json
+import threading
+import time
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import OperationalError
+from hackernews import db
+from hackernews.models import Post, VoteChange
+
+POLL_BATCH = 1000
+# seqs re-read behind the newest one seen: on postgresql a row can commit after rows
+# with a higher seq, and the poller must not have moved past it for good
+LAG_WINDOW = 100
+PRUNE_INTERVAL = 60
+MAX_POSTS = 30 # posts one stream may follow
+HEARTBEAT = 15 # seconds between keep-alive comments
+RETRY = 3000 # milliseconds the browser waits before reconnecting
+POLL_RETRY = 10000 # the same for a browser told to poll because the worker is full
+
+class Subscription:
+    '''The posts one stream shows and their counts waiting to be sent'''
+    def __init__(self, post_ids):
+        self.post_ids = frozenset(post_ids)
+        self.closed = False
+        self._pending = {}
+        self._changed = threading.Condition()
+
+    def push(self, post_id, likes, dislikes):
+        '''replaces the waiting counts of post_id; never blocks on the client'''
+        with self._changed:
+            self._pending[post_id] = (likes, dislikes)
+            self._changed.notify()
+
+    def take(self, timeout):
+        '''{post_id: (likes, dislikes)} that changed, waiting up to timeout seconds for
+        the first one; empty if nothing changed'''
+        with self._changed:
+            if not self._pending:
+                self._changed.wait(timeout)
+            pending, self._pending = self._pending, {}
+        return pending
+
+class LiveCounts:
+    '''In-process pub/sub of vote counts, fed by one thread that polls vote_change
+    while at least one stream is open'''
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._by_post = {}
+        self._streams = 0
+        self._thread = None
+        self._seen = set()
+        self.last_seq = None
+
+    def subscribe(self, post_ids, limit):
+        '''a Subscription for post_ids, or None if limit streams are already open'''
+        subscription = Subscription(post_ids)
+        with self._lock:
+            if self._streams >= limit:
+                return None
+            self._streams += 1
+            for post_id in subscription.post_ids:
+                self._by_post.setdefault(post_id, set()).add(subscription)
+            self._lock.notify()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        '''stops sending to subscription; safe to call twice'''
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._streams -= 1
+            for post_id in subscription.post_ids:
+                subscribers = self._by_post.get(post_id, set())
+                subscribers.discard(subscription)
+                if not subscribers:
+                    self._by_post.pop(post_id, None)
+
+    def publish(self, changes):
+        '''hands (post_id, likes, dislikes) changes, oldest first, to the streams showing
+        the posts; only the last change of each post is kept'''
+        latest = {post_id: (likes, dislikes) for post_id, likes, dislikes in changes}
+        with self._lock:
+            targets = [(subscription, post_id, counts) for post_id, counts in latest.items()
+                    for subscription in self._by_post.get(post_id, ())]
+        for subscription, post_id, (likes, dislikes) in targets:
+            subscription.push(post_id, likes, dislikes)
+
+    def follow_from(self, seq):
+        '''makes the next poll start after change seq, unless streams are already being
+        fed; a new stream reads its first counts together with seq'''
+        with self._lock:
+            if self.last_seq is None:
+                self.last_seq = seq
+
+    def poll(self, lag=None):
+        '''reads the changes committed since the last poll and publishes them. Where
+        seqs can commit out of order the last lag seqs (LAG_WINDOW by default) are read
+        again and only the rows not published yet are sent'''
+        if self.last_seq is None:
+            return 0
+        if lag is None:
+            lag = 0 if db.engine.dialect.name == 'sqlite' else LAG_WINDOW
+        rows = db.session.execute(select(VoteChange.seq, VoteChange.post_id, VoteChange.likes,
+                VoteChange.dislikes).where(VoteChange.seq > self.last_seq - lag)
+                .order_by(VoteChange.seq).limit(POLL_BATCH + lag)).all()
+        db.session.rollback()
+        rows = [row for row in rows if row.seq not in self._seen]
+        if rows:
+            self.last_seq = max(self.last_seq, rows[-1].seq)
+            if lag:
+                self._seen = {seq for seq in self._seen if seq > self.last_seq - lag}
+                self._seen.update(row.seq for row in rows)
+            self.publish([(row.post_id, row.likes, row.dislikes) for row in rows])
+        return len(rows)
+
+    def prune(self, keep):
+        '''drops all but the newest keep changes'''
+        if self.last_seq is None:
+            return
+        try:
+            prune_changes(keep)
+        except OperationalError:
+            # another writer holds the lock; the next prune catches up
+            db.session.rollback()
+
+    def start(self, app):
+        '''starts the polling thread of this process for app, once'''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), daemon=True,
+                    name='live-counts')
+            self._thread.start()
+
+    def _run(self, app):
+        '''polls while streams are open and sleeps while none are'''
+        pruned = time.monotonic()
+        while True:
+            with self._lock:
+                while not self._streams:
+                    # changes made while nobody listened are not sent to anyone
+                    self.last_seq = None
+                    self._seen = set()
+                    self._lock.wait()
+            with app.app_context():
+                try:
+                    self.poll()
+                    if time.monotonic() - pruned >= PRUNE_INTERVAL:
+                        self.prune(app.config['LIVE_CHANGES_KEPT'])
+                        pruned = time.monotonic()
+                except Exception: # pylint: disable=broad-exception-caught
+                    app.logger.exception('polling vote changes failed')
+                finally:
+                    db.session.remove()
+            time.sleep(app.config['LIVE_POLL_INTERVAL'])
+
+live_counts = LiveCounts()
+
+def prune_changes(keep):
+    '''deletes all but the newest keep vote changes and commits; returns how many went.
+    The workers prune while they have streams open and the retention job prunes the
+    rest of the time'''
+    newest = db.session.scalar(select(func.max(VoteChange.seq)))
+    if newest is None:
+        return 0
+    pruned = db.session.execute(delete(VoteChange).where(VoteChange.seq <= newest - keep))
+    db.session.commit()
+    return pruned.rowcount
+
+def current_counts(post_ids):
+    '''(seq, {post_id: (likes, dislikes)}): the last change and the counts of the posts
+    that exist. seq is read first, so a change is either after seq or in the counts'''
+    seq = db.session.scalar(select(func.max(VoteChange.seq))) or 0
+    counts = {row.id: (row.likes_count, row.dislikes_count) for row in db.session.execute(
+            select(Post.id, Post.likes_count, Post.dislikes_count)
+            .where(Post.id.in_(post_ids)))}
+    return seq, counts
+
+def format_event(counts):
+    '''a server-sent "counts" event listing {post_id, likes, dislikes} per post'''
+    data = json.dumps([{'post_id': post_id, 'likes': likes, 'dislikes': dislikes}
+            for post_id, (likes, dislikes) in sorted(counts.items())], separators=(',', ':'))
+    return f'event: counts\ndata: {data}\n\n'
+
+def poll_events(initial, retry):
+    '''The whole body of a short response for a worker that can not hold another
+    stream: the current counts once, then the browser asks again after retry
+    milliseconds'''
+    return f'retry: {retry}\n' + format_event(initial)
+
+def stream_events(subscription, initial, duration, heartbeat, retry):
+    '''The body of one stream: the counts the page may have missed, then every change
+    until duration seconds have passed, with a comment every heartbeat seconds so dead
+    connections are noticed. The client reconnects after retry milliseconds'''
+    yield f'retry: {retry}\n'
+    yield format_event(initial)
+    deadline = time.monotonic() + duration
+    while (remaining := deadline - time.monotonic()) > 0:
+        changes = subscription.take(min(heartbeat, remaining))
+        yield format_event(changes) if changes else ': keep-alive\n\n'
@@ -0,0 +1,195 @@
+'''Operational metrics shared by every gunicorn worker and the cron jobs through a small
+sqlite file, exposed in the Prometheus text format. Requests only add to counters held
+in memory; each process writes its counters to the file at most every flush_interval
+seconds in one transaction, so the hot path never waits on the disk'''
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS sample (name TEXT NOT NULL, labels TEXT NOT NULL, '
+    'value REAL NOT NULL, PRIMARY KEY (name, labels))',
+)
+# upper bounds of the request latency histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# family name: (type, help), in the order they are exposed
+FAMILIES = {
+    'hackernews_requests_total': ('counter', 'Requests by route, method and status.'),
+    'hackernews_request_errors_total': ('counter', 'Responses with a 5xx status by route.'),
+    'hackernews_request_duration_seconds': ('histogram', 'Request latency by route.'),
+    'hackernews_db_queries_total': ('counter', 'SQL statements run by requests, by route.'),
+    'hackernews_db_seconds_total': ('counter', 'Time requests spent in SQL, by route.'),
+    'hackernews_page_cache_hits_total': ('counter', 'Page cache lookups that found a page.'),
+    'hackernews_page_cache_misses_total': ('counter', 'Page cache lookups that missed.'),
+    'hackernews_page_cache_entries': ('gauge', 'Pages in the page cache.'),
+    'hackernews_page_cache_hit_ratio': ('gauge', 'Share of page cache lookups that hit.'),
+    'hackernews_job_runs_total': ('counter', 'Runs of the ingest and maintenance jobs.'),
+    'hackernews_job_failures_total': ('counter', 'Job runs that raised an error.'),
+    'hackernews_job_items_total': ('counter', 'Items a job stored, refreshed or removed.'),
+    'hackernews_job_seconds_total': ('counter', 'Time spent in job runs.'),
+    'hackernews_job_last_run_timestamp_seconds': ('gauge', 'When a job last finished.'),
+}
+HISTOGRAM_SUFFIXES = ('_bucket', '_sum', '_count')
+
+def format_labels(labels):
+    '''the text between the braces of a sample, e.g. route="home",method="GET"'''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+
+def format_value(value):
+    '''a sample value the way Prometheus writes it'''
+    return str(int(value)) if value == int(value) else repr(value)
+
+class MetricsStore:
+    '''Counters, gauges and histograms keyed by name and labels, summed over every
+    process that writes to the file at path'''
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending = defaultdict(float)
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+        self._local = threading.local()
+
+    def _db(self):
+        '''one autocommit connection per thread, created on first use'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # losing the last seconds of counters in a crash is fine, so no fsync
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def inc(self, name, labels=(), value=1.0):
+        '''adds value to a counter in memory'''
+        key = (name, format_labels(labels))
+        with self._lock:
+            self._pending[key] += value
+
+    def observe(self, name, value, labels=()):
+        '''records value in a histogram: every bucket it fits in, the sum and the count'''
+        labels = tuple(labels)
+        text = format_labels(labels)
+        with self._lock:
+            for bound in BUCKETS:
+                if value <= bound:
+                    self._pending[(f'{name}_bucket', f'{text},le="{bound}"'.lstrip(','))] += 1
+            self._pending[(f'{name}_bucket', f'{text},le="+Inf"'.lstrip(','))] += 1
+            self._pending[(f'{name}_sum', text)] += value
+            self._pending[(f'{name}_count', text)] += 1
+
+    def set(self, name, value, labels=()):
+        '''sets a gauge, written straight to the file; dropped if the file can not be
+        written'''
+        try:
+            self._db().execute('INSERT OR REPLACE INTO sample (name, labels, value) '
+                    'VALUES (?, ?, ?)', (name, format_labels(labels), value))
+        except (sqlite3.Error, OSError):
+            logger.exception('setting %s in %s failed', name, self.path)
+
+    def maybe_flush(self):
+        '''flushes if the last flush of this process is flush_interval seconds old'''
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''adds the counters held in memory to the file in one transaction. If the file
+        is locked for too long or can not be opened they are kept for the next flush'''
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            self._flushed = time.monotonic()
+        if not pending:
+            return
+        conn = None
+        try:
+            conn = self._db()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT INTO sample (name, labels, value) VALUES (?, ?, ?) '
+                    'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                    [(name, labels, value) for (name, labels), value in pending.items()])
+            conn.execute('COMMIT')
+        except (sqlite3.Error, OSError):
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] += value
+
+    def samples(self):
+        '''{(name, labels): value} of every sample in the file'''
+        return {(name, labels): value for name, labels, value in
+                self._db().execute('SELECT name, labels, value FROM sample')}
+
+    def render(self, extra=None):
+        '''the Prometheus text exposition of the file plus the extra samples, a dict
+        like the one samples returns'''
+        samples = self.samples()
+        samples.update(extra or {})
+        by_family = defaultdict(list)
+        for (name, labels), value in samples.items():
+            family = name
+            for suffix in HISTOGRAM_SUFFIXES:
+                if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+                    family = name[:-len(suffix)]
+            by_family[family].append((name, labels, value))
+        lines = []
+        for family, (kind, description) in FAMILIES.items():
+            if family not in by_family:
+                continue
+            lines.append(f'# HELP {family} {description}')
+            lines.append(f'# TYPE {family} {kind}')
+            for name, labels, value in sorted(by_family[family], key=_sample_order):
+                lines.append(f'{name}{{{labels}}} {format_value(value)}' if labels
+                        else f'{name} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def job(self, name):
+        '''Times a run of the job name and records it with the number of items it
+        handled, which the block sets: with store.job('fetch') as run: run['items'] = 3.
+        The counters are flushed at once since jobs are short lived processes; failing
+        to record them never changes how the job ends'''
+        run = {'items': 0}
+        start = time.monotonic()
+        labels = (('job', name),)
+        try:
+            yield run
+        except BaseException:
+            self.inc('hackernews_job_failures_total', labels)
+            raise
+        finally:
+            try:
+                self.inc('hackernews_job_runs_total', labels)
+                self.inc('hackernews_job_items_total', labels, run['items'])
+                self.inc('hackernews_job_seconds_total', labels, time.monotonic() - start)
+                self.flush()
+                self.set('hackernews_job_last_run_timestamp_seconds', time.time(), labels)
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception('recording the %s job failed', name)
+
+    def clear(self):
+        '''forgets every sample, in memory and in the file'''
+        with self._lock:
+            self._pending.clear()
+        self._db().execute('DELETE FROM sample')
+
+def _sample_order(sample):
+    '''orders histogram buckets by their bound and everything else by name and labels'''
+    name, labels, _ = sample
+    if name.endswith('_bucket') and 'le="' in labels:
+        base, bound = labels.rsplit('le="', 1)
+        bound = bound.rstrip('"')
+        return (name, base, float('inf') if bound == '+Inf' else float(bound))
+    return (name, labels, 0.0)
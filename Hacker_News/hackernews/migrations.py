@@ -0,0 +1,134 @@
+'''Upgrades databases created by older versions of the models in place.
+Run with: flask --app hackernews:create_ingest_app upgrade-db'''
+import pickle
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text, update
+from hackernews import db
+from hackernews.models import Comment, Post, Role, User, Vote, dialect_insert
+from hackernews.ranking import recompute_ranks
+from hackernews.search import create_search_index, rebuild_search_index
+
+LEGACY_VOTE_TABLES = {'like': Vote.LIKE, 'dislike': Vote.DISLIKE}
+DEFAULT_ROLES = ('member', 'admin')
+MIGRATION_BATCH = 500
+
+def add_missing_columns(model, *names):
+    '''ALTER TABLE ... ADD COLUMN for every column in names the table does not have yet.
+    Returns the names that were added'''
+    table = model.__table__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    added = []
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = f'ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(db.engine.dialect)}'
+        if column.server_default is not None:
+            default = str(column.server_default.arg).replace("'", "''")
+            ddl += f" DEFAULT '{default}'"
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        db.session.execute(text(ddl))
+        added.append(name)
+    return added
+
+def create_missing_indexes(model):
+    '''CREATE INDEX for indexes declared on model after its table was created'''
+    for index in model.__table__.indexes:
+        index.create(db.session.connection(), checkfirst=True)
+
+def migrate_legacy_votes():
+    '''Copies rows of the old like and dislike tables into vote and drops them.
+    Returns True if there was anything to migrate'''
+    tables = set(inspect(db.engine).get_table_names())
+    migrated = False
+    for table, value in LEGACY_VOTE_TABLES.items():
+        if table not in tables:
+            continue
+        # rows of deleted users or posts are skipped, the foreign keys would reject them
+        db.session.execute(text(
+            f'INSERT INTO vote (user_id, post_id, value) SELECT author, post_id, {value} '
+            f'FROM "{table}" WHERE author IN (SELECT id FROM "user") '
+            'AND post_id IN (SELECT id FROM post) ON CONFLICT DO NOTHING'))
+        db.session.execute(text(f'DROP TABLE "{table}"'))
+        migrated = True
+    return migrated
+
+def migrate_pickled_kids():
+    '''Moves the pickled lists of the old post.kids column into the comment table,
+    MIGRATION_BATCH posts at a time, and drops the column. Returns True if there
+    was anything to migrate'''
+    columns = {column['name'] for column in inspect(db.engine).get_columns('post')}
+    if 'kids' not in columns:
+        return False
+    last_id = None
+    while True:
+        query = 'SELECT id, kids FROM post WHERE kids IS NOT NULL'
+        if last_id is not None:
+            query += ' AND id > :last_id'
+        batch = db.session.execute(text(query + ' ORDER BY id LIMIT :size'),
+                {'last_id': last_id, 'size': MIGRATION_BATCH}).all()
+        if not batch:
+            break
+        rows = [{'id': kid, 'post_id': post_id, 'position': position,
+                'path': Comment.path_for(kid)} for post_id, kids in batch
+                for position, kid in enumerate(pickle.loads(kids) or [])]
+        for start in range(0, len(rows), MIGRATION_BATCH):
+            stmt = dialect_insert(Comment.__table__).values(rows[start:start + MIGRATION_BATCH])
+            db.session.execute(stmt.on_conflict_do_nothing())
+        last_id = batch[-1][0]
+    db.session.execute(text('ALTER TABLE post DROP COLUMN kids'))
+    return True
+
+def backfill_comment_paths():
+    '''gives comments stored before threads were crawled their top level path'''
+    rows = [{'id': comment_id, 'path': Comment.path_for(comment_id)}
+            for comment_id, in db.session.query(Comment.id).filter(Comment.path == '')]
+    for start in range(0, len(rows), MIGRATION_BATCH):
+        db.session.execute(update(Comment), rows[start:start + MIGRATION_BATCH])
+
+def seed_roles():
+    '''creates the roles the app hands out if they are missing'''
+    existing = {role.name for role in Role.query.filter(Role.name.in_(DEFAULT_ROLES))}
+    db.session.add_all([Role(name=name) for name in DEFAULT_ROLES if name not in existing])
+
+def upgrade_schema():
+    '''Creates missing tables, columns and default roles and backfills the data
+    new columns need'''
+    db.create_all()
+    added = add_missing_columns(Post, 'likes_count', 'dislikes_count')
+    add_missing_columns(Post, 'crawled_descendants', 'hidden')
+    ranked = add_missing_columns(Post, 'rank')
+    unindexed = create_search_index()
+    create_missing_indexes(Post)
+    create_missing_indexes(User)
+    if add_missing_columns(Comment, 'parent_id', 'author', 'text', 'time', 'deleted', 'path',
+            'depth'):
+        backfill_comment_paths()
+    create_missing_indexes(Comment)
+    migrate_pickled_kids()
+    migrated = migrate_legacy_votes()
+    if added or migrated:
+        Post.recount_votes()
+    seed_roles()
+    db.session.commit()
+    if ranked:
+        recompute_ranks()
+    if unindexed:
+        rebuild_search_index()
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    '''Upgrades the database schema in place'''
+    upgrade_schema()
+    print('Database is up to date')
+
+@click.command('recount-votes')
+@with_appcontext
+def recount_votes_command():
+    '''Recomputes the like and dislike counters of every post from the vote table'''
+    Post.recount_votes()
+    db.session.commit()
+    print('Vote counters recomputed')
@@ -1,41 +1,139 @@
 '''SQLite db models'''
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
 from hackernews import db
 
+def dialect_insert(table):
+    '''INSERT for the dialect in use, so ON CONFLICT upserts are available'''
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
 class User(db.Model):
     '''Model for a user'''
+    __table_args__ = (
+        db.Index('ix_user_username_id', 'username', 'id'),
+    )
     id = db.Column(db.String, primary_key=True)
     username = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     image_file =  db.Column(db.String(120), nullable=False, default='default.jpg')
-    likes = db.relationship('Like', backref='user', cascade='all, delete-orphan')
-    dislikes = db.relationship('Dislike', backref='user', cascade='all, delete-orphan')
-    roles = db.relationship('Role', secondary='user_roles')
+    # the database deletes votes and role grants with the user (ON DELETE CASCADE)
+    votes = db.relationship('Vote', backref='user', cascade='all, delete-orphan',
+            passive_deletes=True)
+    roles = db.relationship('Role', secondary='user_roles', passive_deletes=True)
     def __repr__(self):
         return f"User('{self.username}', '{self.email}', '{self.image_file}')"
 
 class Post(db.Model):
     '''Model for a post'''
+    __table_args__ = (
+        db.Index('ix_post_popularity_time_id', 'popularity', 'time', 'id'),
+        db.Index('ix_post_time_id', 'time', 'id'),
+        db.Index('ix_post_rank_id', 'rank', 'id'),
+    )
     author = db.Column(db.String(100), nullable=False)
     descendants = db.Column(db.Integer)
     id = db.Column(db.Integer, primary_key=True)
-    kids = db.Column(db.PickleType)
     score = db.Column(db.Integer)
     title = db.Column(db.String(100), nullable=False)
     posttype = db.Column(db.String(100))
     time = db.Column(db.Integer)
     url = db.Column(db.String, nullable=False)
-    likes = db.relationship('Like', backref='post', cascade='all, delete-orphan')
-    dislikes = db.relationship('Dislike', backref='post', cascade='all, delete-orphan')
+    votes = db.relationship('Vote', backref='post', cascade='all, delete-orphan',
+            passive_deletes=True)
+    comments = db.relationship('Comment', order_by='Comment.position',
+            cascade='all, delete-orphan', passive_deletes=True)
+    crawled_descendants = db.Column(db.Integer)
+    hidden = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    # time-decayed score the home page is ordered by, see hackernews/ranking.py
+    rank = db.Column(db.Float, nullable=False, default=0, server_default='0')
     popularity = db.Column(db.Integer, default=0)
-    def increase_popularity(self):
-        '''increase the popularity of a post by 1 (likes + dislikes)'''
-        self.popularity += 1
-        db.session.commit()
-    def decrease_popularity(self):
-        '''decrease the popularity of a post by 1 (likes+dislikes)'''
-        if self.popularity > 0:
-            self.popularity -= 1
-            db.session.commit()
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    dislikes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    @property
+    def kids(self):
+        '''ids of the post's top level comments in hacker news order; loaded on first access'''
+        return [comment.id for comment in self.comments if comment.parent_id is None]
+    @kids.setter
+    def kids(self, kid_ids):
+        existing = {comment.id: comment for comment in self.comments}
+        kids = []
+        for position, kid_id in enumerate(kid_ids or []):
+            comment = existing.get(kid_id) or Comment(id=kid_id, path=Comment.path_for(kid_id))
+            comment.position = position
+            kids.append(comment)
+        # replies stay as long as the top level comment they belong to does
+        kept = {comment.path for comment in kids}
+        replies = [comment for comment in self.comments
+                if comment.parent_id is not None and comment.path.split('/')[0] in kept]
+        self.comments = kids + replies
+    @staticmethod
+    def kids_of(post_ids):
+        '''returns {post_id: [comment ids]} for post_ids with a single IN query'''
+        kids = {post_id: [] for post_id in post_ids}
+        rows = db.session.query(Comment.post_id, Comment.id) \
+                .filter(Comment.post_id.in_(kids), Comment.parent_id.is_(None)) \
+                .order_by(Comment.post_id, Comment.position)
+        for post_id, comment_id in rows:
+            kids[post_id].append(comment_id)
+        return kids
+    @staticmethod
+    def recount_votes(post_ids=None):
+        '''recomputes likes_count and dislikes_count from the vote table, for every
+        post or only post_ids; committed with the caller's transaction'''
+        def count(value):
+            return select(func.count()).where(Vote.post_id == Post.id, Vote.value == value) \
+                    .scalar_subquery()
+        stmt = update(Post).values(likes_count=count(Vote.LIKE),
+                dislikes_count=count(Vote.DISLIKE))
+        if post_ids is not None:
+            stmt = stmt.where(Post.id.in_(post_ids))
+        db.session.execute(stmt)
+
+class PostArchive(db.Model):
+    '''What is kept of a post after the retention job removed it: the story itself and
+    its final counters, without comments or individual votes'''
+    __tablename__ = 'post_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    author = db.Column(db.String(100), nullable=False)
+    title = db.Column(db.String(100), nullable=False)
+    url = db.Column(db.String, nullable=False)
+    time = db.Column(db.Integer)
+    score = db.Column(db.Integer)
+    descendants = db.Column(db.Integer)
+    popularity = db.Column(db.Integer)
+    likes_count = db.Column(db.Integer, nullable=False, default=0)
+    dislikes_count = db.Column(db.Integer, nullable=False, default=0)
+    archived_at = db.Column(db.Integer, nullable=False)
+    def __repr__(self):
+        return f"PostArchive('{self.id}', '{self.title}')"
+
+class Comment(db.Model):
+    '''A comment on a post. Top level comments (the post's kids) have no parent_id;
+    path is the materialized path of zero padded ids from the top level comment down,
+    so a whole thread is one range scan of ix_comment_post_path with parents first'''
+    __table_args__ = (
+        db.Index('ix_comment_post_position', 'post_id', 'position'),
+        db.Index('ix_comment_post_path', 'post_id', 'path'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete="CASCADE"), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    parent_id = db.Column(db.Integer)
+    author = db.Column(db.String(100))
+    text = db.Column(db.Text)
+    time = db.Column(db.Integer)
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    path = db.Column(db.String, nullable=False, default='', server_default='')
+    depth = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    @staticmethod
+    def path_for(comment_id, parent_path=None):
+        '''the materialized path of a comment under parent_path, or at the top level'''
+        segment = f'{comment_id:010d}'
+        return f'{parent_path}/{segment}' if parent_path else segment
+    def __repr__(self):
+        return f"Comment('{self.id}', '{self.post_id}', '{self.path}')"
 
 class Role(db.Model):
     '''Model for a user Role'''
@@ -54,18 +152,43 @@ class UserRoles(db.Model):
     def __repr__(self):
         return f"UserRole('{self.user_id}', '{self.role_id}')"
 
-class Like(db.Model):
-    '''Model for all likes'''
-    id = db.Column(db.Integer, primary_key=True)
-    author = db.Column(db.Integer, db.ForeignKey('user.id', ondelete="CASCADE"), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete="CASCADE"), nullable=False)
+class Vote(db.Model):
+    '''A user's like (1) or dislike (-1) of a post, at most one per user and post'''
+    LIKE = 1
+    DISLIKE = -1
+    user_id = db.Column(db.String, db.ForeignKey('user.id', ondelete="CASCADE"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete="CASCADE"), primary_key=True,
+            index=True)
+    value = db.Column(db.SmallInteger, nullable=False)
     def __repr__(self):
-        return f"Like('{self.author}', '{self.post_id}')"
+        return f"Vote('{self.user_id}', '{self.post_id}', '{self.value}')"
 
-class Dislike(db.Model):
-    '''Model for all dislikes'''
-    id = db.Column(db.Integer, primary_key=True)
-    author = db.Column(db.Integer, db.ForeignKey('user.id', ondelete="CASCADE"), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete="CASCADE"), nullable=False)
+class VoteChange(db.Model):
+    '''The like and dislike counts of a post after a vote. seq follows commit order on
+    sqlite, but postgresql hands it out before commit, so the workers following the
+    table to push live counts re-read a trailing window of it (see live.py). Only the
+    newest rows are kept'''
+    __tablename__ = 'vote_change'
+    seq = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, nullable=False)
+    likes = db.Column(db.Integer, nullable=False)
+    dislikes = db.Column(db.Integer, nullable=False)
+    def __repr__(self):
+        return f"VoteChange('{self.seq}', '{self.post_id}', '{self.likes}', '{self.dislikes}')"
+
+class AppState(db.Model):
+    '''Key/value table for cursors and counters that must survive restarts'''
+    __tablename__ = 'app_state'
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.String, nullable=False)
+    @staticmethod
+    def get(key, default=None):
+        '''returns the stored value for key, or default'''
+        state = db.session.get(AppState, key)
+        return state.value if state else default
+    @staticmethod
+    def set(key, value):
+        '''stores value under key; committed with the caller's transaction'''
+        db.session.merge(AppState(key=key, value=str(value)))
     def __repr__(self):
-        return f"Dislike('{self.author}', '{self.post_id}')"
+        return f"AppState('{self.key}', '{self.value}')"
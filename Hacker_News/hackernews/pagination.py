@@ -0,0 +1,78 @@
+'''Keyset (cursor) pagination, so deep pages cost the same as the first one'''
+import base64
+import binascii
+import json
+import sys
+import time
+from collections import namedtuple
+from sqlalchemy import func, select, tuple_
+from hackernews import db
+
+COUNT_TTL = 60
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor', 'prev_cursor'])
+
+_counts = {}
+
+def encode_cursor(direction, values):
+    '''opaque, url safe token for the position just after (or before) values'''
+    raw = json.dumps([direction, *values], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def decode_cursor(token, size):
+    '''returns (direction, values) for a token made by encode_cursor, or None if the
+    token is missing or malformed, including values that are not numbers or strings'''
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, *values = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if direction not in ('after', 'before') or len(values) != size:
+        return None
+    if not all(value is None or isinstance(value, (int, float, str)) for value in values):
+        return None
+    return direction, values
+
+def keyset_paginate(query, columns, cursor=None, per_page=5, descending=True):
+    '''Returns a KeysetPage of query ordered by columns, all descending unless
+    descending is False. columns must end with a unique column (the primary key) and
+    should match a composite index so every page is a single index range scan. cursor
+    is a token from a previous page'''
+    key = tuple_(*columns)
+    position = decode_cursor(cursor, len(columns))
+    backwards = position is not None and position[0] == 'before'
+    if position is not None:
+        values = tuple_(*position[1])
+        query = query.filter(key > values if backwards == descending else key < values)
+    order = [column.desc() if backwards != descending else column.asc() for column in columns]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    def values_of(row):
+        return [getattr(row, column.key) for column in columns]
+    has_next = (more and not backwards) or (backwards and bool(rows))
+    has_prev = (more and backwards) or (position is not None and not backwards and bool(rows))
+    return KeysetPage(items=rows,
+            next_cursor=encode_cursor('after', values_of(rows[-1])) if has_next else None,
+            prev_cursor=encode_cursor('before', values_of(rows[0])) if has_prev else None)
+
+def prefix_range(column, prefix):
+    '''conditions matching values of column that start with prefix, written as a range
+    so an index on column can be scanned (LIKE can not use one on sqlite)'''
+    if not prefix or ord(prefix[-1]) == sys.maxunicode:
+        return (column >= prefix,)
+    return column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def approximate_count(model):
+    '''COUNT(*) of model's table, cached per process for COUNT_TTL seconds'''
+    name = model.__tablename__
+    cached = _counts.get(name)
+    now = time.monotonic()
+    if cached is None or now - cached[0] > COUNT_TTL:
+        cached = (now, db.session.scalar(select(func.count()).select_from(model)))
+        _counts[name] = cached
+    return cached[1]
@@ -0,0 +1,139 @@
+'''Time-decayed ranking of posts, stored in the indexed post.rank column so the home
+page is a range scan of ix_post_rank_id.
+
+    rank = (score + like_weight * likes - dislike_weight * dislikes - 1) / (age + 2) ** gravity
+
+age is in hours and measured at the rank epoch, the time of the last full recompute
+kept in app_state. Votes update one post's rank against the same epoch, so ranks stay
+comparable until the next recompute moves the epoch forward.
+Recompute with: flask --app hackernews:create_ingest_app recompute-ranks'''
+import sqlite3
+import time
+from collections import namedtuple
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import Float, case, cast, func, select, update
+from hackernews import db, page_cache
+from hackernews.models import AppState, Post
+
+RANK_EPOCH = 'rank.epoch'
+RANK_BATCH = 500
+
+RankFormula = namedtuple('RankFormula', ['gravity', 'like_weight', 'dislike_weight'])
+DEFAULT_FORMULA = RankFormula(gravity=1.8, like_weight=1.0, dislike_weight=1.0)
+
+def configured_formula():
+    '''the formula set by the RANK_* settings, or the default one outside an app (a
+    vote toggled on a bare session)'''
+    if not has_app_context():
+        return DEFAULT_FORMULA
+    return RankFormula(gravity=current_app.config['RANK_GRAVITY'],
+            like_weight=current_app.config['RANK_LIKE_WEIGHT'],
+            dislike_weight=current_app.config['RANK_DISLIKE_WEIGHT'])
+
+def rank_value(score, likes, dislikes, posted, reference, formula):
+    '''the rank of one post computed in python, for tooling and tests'''
+    points = (score or 0) + formula.like_weight * likes - formula.dislike_weight * dislikes - 1
+    age = max((reference - posted) / 3600, 0) if posted is not None else 0
+    return points / (age + 2) ** formula.gravity
+
+def rank_expression(score, likes, dislikes, posted, reference, formula=None):
+    '''the same formula as a SQL expression of columns (or expressions of them)'''
+    formula = formula or configured_formula()
+    points = func.coalesce(score, 0) + formula.like_weight * likes \
+            - formula.dislike_weight * dislikes - 1
+    age = case((posted.is_(None) | (posted > reference), 0.0),
+            else_=(reference - posted) / 3600.0)
+    return points / func.pow(age + 2, formula.gravity, type_=Float)
+
+def epoch_subquery():
+    '''the stored rank epoch, or now if ranks were never computed, as a SQL scalar'''
+    stored = select(cast(AppState.value, Float)).where(AppState.key == RANK_EPOCH) \
+            .scalar_subquery()
+    return func.coalesce(stored, time.time())
+
+def recompute_ranks(batch_size=RANK_BATCH, now=None, formula=None):
+    '''Moves the rank epoch to now and recomputes the rank of every post, committing
+    every batch_size posts so the write lock is never held for long. Returns the
+    number of posts ranked'''
+    now = now or time.time()
+    AppState.set(RANK_EPOCH, repr(now))
+    db.session.commit()
+    expression = rank_expression(Post.score, Post.likes_count, Post.dislikes_count, Post.time,
+            now, formula)
+    ranked = 0
+    last_id = None
+    while True:
+        ids = select(Post.id).order_by(Post.id).limit(batch_size)
+        if last_id is not None:
+            ids = ids.where(Post.id > last_id)
+        post_ids = db.session.scalars(ids).all()
+        if not post_ids:
+            break
+        db.session.execute(update(Post).where(Post.id.in_(post_ids)).values(rank=expression))
+        db.session.commit()
+        ranked += len(post_ids)
+        last_id = post_ids[-1]
+    return ranked
+
+@click.command('recompute-ranks')
+@with_appcontext
+def recompute_ranks_command():
+    '''Recomputes the rank of every post against the current time'''
+    ranked = recompute_ranks()
+    # cached pages list posts in the old order
+    page_cache.invalidate()
+    click.echo(f'Ranked {ranked} posts')
+
+def parse_formula(text):
+    '''"gravity:like_weight:dislike_weight", e.g. "1.8:1:1", or "popularity" for the
+    order the site used before ranks'''
+    if text == 'popularity':
+        return text
+    try:
+        gravity, like_weight, dislike_weight = (float(part) for part in text.split(':'))
+    except ValueError as error:
+        raise click.BadParameter(f'expected gravity:likes:dislikes, got {text}') from error
+    return RankFormula(gravity, like_weight, dislike_weight)
+
+def order_posts(posts, formula, reference):
+    '''post ids of a snapshot, best first, under formula'''
+    def key(post):
+        if formula == 'popularity':
+            return (post['popularity'] or 0, post['time'] or 0, post['id'])
+        return (rank_value(post['score'], post['likes_count'], post['dislikes_count'],
+                post['time'], reference, formula), post['id'])
+    return [post['id'] for post in sorted(posts, key=key, reverse=True)]
+
+@click.command('compare-ranking')
+@with_appcontext
+@click.argument('snapshot', type=click.Path(exists=True, dir_okay=False))
+@click.option('--formula', 'formulas', multiple=True,
+        help='gravity:likes:dislikes or "popularity"; the first one is the baseline')
+@click.option('--at', 'reference', type=float,
+        help='unix time to rank at, by default the newest post in the snapshot')
+@click.option('--top', default=30, help='how many posts make the front page')
+def compare_ranking_command(snapshot, formulas, reference, top):
+    '''Compares ranking formulas on a copy of the sqlite database, without touching it'''
+    formulas = [parse_formula(text) for text in formulas or ('1.8:1:1', 'popularity')]
+    conn = sqlite3.connect(f'file:{snapshot}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    posts = [dict(row) for row in conn.execute('SELECT id, score, likes_count, '
+            'dislikes_count, time, popularity FROM post WHERE NOT hidden')]
+    conn.close()
+    reference = reference or max((post['time'] or 0 for post in posts), default=time.time())
+    ages = {post['id']: max(reference - (post['time'] or reference), 0) / 3600 for post in posts}
+    baseline = None
+    click.echo(f"{'formula':>16} {'overlap@' + str(top):>11} {'mean shift':>11} "
+            f"{'median age (h)':>15}")
+    for formula in formulas:
+        order = order_posts(posts, formula, reference)
+        front = order[:top]
+        if baseline is None:
+            baseline = {post_id: position for position, post_id in enumerate(order)}
+        overlap = len(set(front) & {i for i, p in baseline.items() if p < top})
+        shift = sum(abs(baseline[i] - p) for p, i in enumerate(front)) / max(len(front), 1)
+        median = sorted(ages[i] for i in front)[len(front) // 2] if front else 0
+        name = formula if formula == 'popularity' else ':'.join(f'{v:g}' for v in formula)
+        click.echo(f'{name:>16} {overlap:>11} {shift:>11.1f} {median:>15.1f}')
@@ -0,0 +1,103 @@
+'''Retention job: moves posts that no longer earn their place on the site into the
+compact post_archive table, a small batch per transaction so the sqlite write lock is
+never held for long, and trims the vote_change table the live counts follow.
+Run with: flask --app hackernews:create_ingest_app archive-posts'''
+import time
+from collections import namedtuple
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, insert, select
+from hackernews import db, metrics_store, page_cache
+from hackernews.feed import write_snapshot
+from hackernews.live import prune_changes
+from hackernews.models import Post, PostArchive
+
+DEFAULT_BATCH = 200
+DEFAULT_PAUSE = 0.05
+ARCHIVED_COLUMNS = ('id', 'author', 'title', 'url', 'time', 'score', 'descendants',
+        'popularity', 'likes_count', 'dislikes_count')
+
+# a post is archived when it is older than max_age_days and, if they are set, has no
+# votes and a rank below below_rank
+RetentionPolicy = namedtuple('RetentionPolicy',
+        ['max_age_days', 'unvoted_only', 'below_rank'])
+ArchiveResult = namedtuple('ArchiveResult', ['archived', 'batches'])
+
+def configured_policy():
+    '''the policy set by the RETENTION_* settings'''
+    return RetentionPolicy(max_age_days=current_app.config['RETENTION_MAX_AGE_DAYS'],
+            unvoted_only=current_app.config['RETENTION_UNVOTED_ONLY'],
+            below_rank=current_app.config['RETENTION_BELOW_RANK'])
+
+def expired_posts(policy, now=None):
+    '''SELECT of the ids of posts the policy retires, oldest first, so every batch is a
+    range scan of ix_post_time_id'''
+    cutoff = (now or time.time()) - policy.max_age_days * 86400
+    stmt = select(Post.id).where(Post.time < cutoff)
+    if policy.unvoted_only:
+        stmt = stmt.where(Post.likes_count == 0, Post.dislikes_count == 0)
+    if policy.below_rank is not None:
+        stmt = stmt.where(Post.rank < policy.below_rank)
+    return stmt.order_by(Post.time, Post.id)
+
+def archive_batch(post_ids, now=None):
+    '''copies post_ids into post_archive and deletes them (their votes and comments go
+    through ON DELETE CASCADE); the caller commits'''
+    columns = [getattr(Post, name) for name in ARCHIVED_COLUMNS]
+    db.session.execute(insert(PostArchive).from_select(
+            [*ARCHIVED_COLUMNS, 'archived_at'],
+            select(*columns, db.literal(int(now or time.time())))
+            .where(Post.id.in_(post_ids))))
+    db.session.execute(delete(Post).where(Post.id.in_(post_ids)))
+
+def archive_posts(policy, batch_size=DEFAULT_BATCH, limit=None, pause=DEFAULT_PAUSE):
+    '''Archives the posts the policy retires, at most limit of them, committing every
+    batch_size posts and sleeping pause seconds between batches so the web workers and
+    the ingest job get the write lock in between. Returns an ArchiveResult'''
+    now = time.time()
+    archived = batches = 0
+    while limit is None or archived < limit:
+        size = batch_size if limit is None else min(batch_size, limit - archived)
+        post_ids = db.session.scalars(expired_posts(policy, now).limit(size)).all()
+        if not post_ids:
+            break
+        archive_batch(post_ids, now)
+        db.session.commit()
+        archived += len(post_ids)
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    if archived:
+        write_snapshot()
+        page_cache.invalidate()
+    return ArchiveResult(archived=archived, batches=batches)
+
+@click.command('archive-posts')
+@with_appcontext
+@click.option('--max-age-days', type=float, help='archive posts older than this')
+@click.option('--unvoted-only/--any-votes', default=None,
+        help='only archive posts nobody voted on')
+@click.option('--below-rank', type=float, help='only archive posts ranked below this')
+@click.option('--batch-size', type=int, default=DEFAULT_BATCH, help='posts per transaction')
+@click.option('--limit', type=int, help='archive at most this many posts')
+@click.option('--dry-run', is_flag=True, help='only count the posts that would be archived')
+def archive_posts_command(max_age_days, unvoted_only, below_rank, batch_size, limit,
+        dry_run):
+    '''Archives old posts according to the retention policy'''
+    policy = configured_policy()
+    policy = policy._replace(**{name: value for name, value in (
+            ('max_age_days', max_age_days), ('unvoted_only', unvoted_only),
+            ('below_rank', below_rank)) if value is not None})
+    if dry_run:
+        count = db.session.scalar(select(db.func.count()).select_from(
+                expired_posts(policy).subquery()))
+        click.echo(f'{count} posts would be archived')
+        return
+    with metrics_store.job('archive') as run:
+        result = archive_posts(policy, batch_size=batch_size, limit=limit)
+        run['items'] = result.archived
+    # the web workers only prune vote changes while someone watches live counts
+    pruned = prune_changes(current_app.config['LIVE_CHANGES_KEPT'])
+    click.echo(f'Archived {result.archived} posts in {result.batches} batches, '
+            f'pruned {pruned} vote changes')
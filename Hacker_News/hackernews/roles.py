@@ -0,0 +1,57 @@
+'''Per-process cache of each user's role names. Every change to users or their roles
+stores a new role version in app_state within the same transaction, and a cached entry
+is only used while the version matches, so one primary key lookup replaces the
+user_roles join on each admin request and changes still apply on the next request'''
+import secrets
+import time
+from sqlalchemy import event, inspect
+from hackernews import db
+from hackernews.models import AppState, Role, User, UserRoles
+
+ROLE_VERSION = 'roles.version'
+ROLE_TTL = 300
+ROLE_CACHE_SIZE = 1024
+
+_cached = {}
+
+def role_version():
+    '''the version stamp of the roles table, '0' until roles first change'''
+    return AppState.get(ROLE_VERSION, '0')
+
+def bump_role_version():
+    '''stores a new version stamp; committed with the caller's transaction'''
+    AppState.set(ROLE_VERSION, secrets.token_hex(8))
+
+def user_roles(user_id):
+    '''the set of role names of user_id, read from the cache if the version stamp has
+    not changed and the entry is younger than ROLE_TTL seconds'''
+    version = role_version()
+    now = time.monotonic()
+    cached = _cached.get(user_id)
+    if cached and cached[0] == version and cached[1] > now:
+        return cached[2]
+    names = frozenset(name for name, in db.session.query(Role.name)
+            .join(UserRoles, UserRoles.role_id == Role.id).filter(UserRoles.user_id == user_id))
+    if len(_cached) >= ROLE_CACHE_SIZE:
+        _cached.clear()
+    _cached[user_id] = (version, now + ROLE_TTL, names)
+    return names
+
+def clear_role_cache():
+    '''forgets every cached entry of this process'''
+    _cached.clear()
+
+def _roles_changed(session):
+    '''True if the pending flush adds or deletes users, roles or role grants'''
+    for obj in session.new | session.deleted:
+        if isinstance(obj, (User, Role, UserRoles)):
+            return True
+    return any(isinstance(obj, User) and inspect(obj).attrs.roles.history.has_changes()
+            for obj in session.dirty)
+
+@event.listens_for(db.session, 'before_flush')
+def _bump_on_role_change(session, flush_context, instances): # pylint: disable=unused-argument
+    '''keeps the version stamp in step with every role change made through the ORM'''
+    if _roles_changed(session):
+        with session.no_autoflush:
+            bump_role_version()
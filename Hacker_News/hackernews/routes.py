@@ -1,330 +1,252 @@
 '''Routes for hackernews website'''
-from urllib.parse import quote_plus, urlencode
-
 import traceback
 import datetime
-import secrets
-from functools import wraps
-from flask import redirect, render_template, session, url_for, jsonify, request, abort
-from hackernews import app, db, oauth, env
-from hackernews.models import User, Post, Like, Dislike, Role
+from flask import (Blueprint, current_app, render_template, session, jsonify, request, abort,
+        make_response, Response)
+from hackernews import db, page_cache
+from hackernews.auth import is_authenticated
+from hackernews.models import Post, Vote
+from hackernews.feed import load_snapshot
+from hackernews.instrumentation import query_budget
+from hackernews.live import (HEARTBEAT, MAX_POSTS, POLL_RETRY, RETRY, current_counts, live_counts,
+        poll_events, stream_events)
+from hackernews.pagination import approximate_count, decode_cursor, keyset_paginate
+from hackernews.search import RANGES, search_posts
+from hackernews.threads import thread_comments
+from hackernews.votes import toggle_vote, viewer_votes
+
+bp = Blueprint('main', __name__)
 
 #URL = "https://hacker-news.firebaseio.com/v0/topstories.json"
-nonce_val =secrets.token_urlsafe(32)
-def is_authenticated(func):
-    '''Checks if user is logged in'''
-    @wraps(func)
-    def decorated_function(*args, **kwargs):
-        if not session:
-            session['next'] = request.url
-            return redirect(url_for('login'))  # Redirect to login page if access token is not found
-        # Further validation can be performed using Auth0's token validation methods
-        return func(*args, **kwargs)
-    return decorated_function
-
-def admin_required(func):
-    '''Checks if user has admin role'''
-    @wraps(func)
-    def decorated_function(*args, **kwargs):
-        if not session:
-            return redirect(url_for('login'))
-        userid = session.get('user').get('userinfo').get('sub')
-        with app.app_context():
-            user_roles = db.session.query(User).filter_by(id=userid).first().roles
-        role_names = [role.name for role in user_roles]
-        #print(role_names, file=open('/home/olives/Hacker_News/hackernews/output.txt', 'a'))
-        if 'admin' not in role_names:
-            return abort(403)
-        return func(*args, **kwargs)
-    return decorated_function
-
-@app.after_request
+# keyset ordering of the home page, backed by ix_post_rank_id
+HOME_ORDER = (Post.rank, Post.id)
+
+def invalidate_post_pages(post_id, reordered):
+    '''Drops cached pages after a vote: all of them if the post moved past another
+    post, otherwise only the pages showing it or starting next to it'''
+    if reordered:
+        page_cache.invalidate()
+    else:
+        page_cache.invalidate_tag(post_id)
+
+@bp.after_app_request
 def add_security_headers(response):
     '''Adding CSP Headers to increase security'''
     response.headers['Content-Security-Policy'] = (
             "default-src 'none';"
-            "form-action 'none';"
+            "form-action 'self';"
             "connect-src 'self';"
             "base-uri 'self';"
             "style-src 'self'  https://cdnjs.cloudflare.com https://cdn.jsdelivr.net;"
-            "script-src 'self' https://cdn.jsdelivr.net "
-            f"https://cdnjs.cloudflare.com 'nonce-{nonce_val}';"
+            "script-src 'self' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com;"
             "font-src 'self' https://cdnjs.cloudflare.com;"
             "img-src 'self' https://lh3.googleusercontent.com;"
             "frame-ancestors 'self'"
             )
     return response
 
-@app.route("/login")
-def login():
-    '''Calls Auth0 to handle login, which redirects to callback'''
-    return oauth.auth0.authorize_redirect(
-        redirect_uri=url_for("callback", _external=True)
-    )
-
-@app.route("/")
-@app.route("/home")
+@bp.route("/")
+@bp.route("/home")
+@query_budget(3)
 def home():
-    '''Renders the home page'''
+    '''Renders the home page. Pages for logged out visitors are served from the shared
+    page cache'''
+    cursor = request.args.get('cursor')
+    cache_key = f"home:{cursor or ''}"
+    cacheable = not session
+    generation = None
+    if cacheable:
+        cached, generation = page_cache.lookup(cache_key)
+        if cached is not None:
+            response = make_response(cached)
+            response.headers['X-Cache'] = 'HIT'
+            return response
     posts = []
-    with app.app_context():
-        page = request.args.get('page', 1, type=int)
-        all_posts = db.session.query(Post).order_by(Post.popularity.desc(),
-                Post.time.desc()).paginate(page=page, per_page=5)
+    all_posts = keyset_paginate(db.session.query(Post).filter(Post.hidden.is_(False)),
+            HOME_ORDER,
+            cursor=cursor, per_page=5)
+    total = approximate_count(Post)
+    votes = {}
+    if session.get('user'):
+        votes = viewer_votes(session['user']['userinfo']['sub'],
+                [i.id for i in all_posts.items])
     for i in all_posts.items:
-        num_likes = Like.query.filter_by(post_id=i.id).count()
-        num_dislikes = Dislike.query.filter_by(post_id=i.id).count()
-        user_likes = Like.query.filter_by(post_id=i.id).all()
-        user_dislikes = Dislike.query.filter_by(post_id=i.id).all()
         entry = {
                     'by': i.author,
                     'descendants': i.descendants,
                     'id': i.id,
-                    'kids': i.kids,
                     'score': i.score,
                     'title': i.title,
                     'type': i.posttype,
                     'time': datetime.datetime.fromtimestamp(i.time),
                     'url': i.url,
-                    'likes': num_likes,
-                    'dislikes': num_dislikes,
-                    'likedby': user_likes,
-                    'dislikedby': user_dislikes
+                    'likes': i.likes_count,
+                    'dislikes': i.dislikes_count
                 }
         posts.append(entry)
-    return render_template('home.html', posts=posts, page=page,
-            pages=list(all_posts.iter_pages(left_edge=1, right_edge=1, left_current=1,
-                right_current=2)), nonce_val=nonce_val)
-
-@app.route("/callback", methods=["GET", "POST"])
-def callback():
-    '''Redirect from Auth0. Collects session information after login'''
-    token = oauth.auth0.authorize_access_token()
-    session["user"] = token
-    profile = token.get('userinfo')
-    if profile:
-        user_id = profile.get('sub')
-        existing_user = db.session.query(User).filter_by(id=user_id).first()
-        #print(existing_user, file=open('/home/olives/Hacker_News/hackernews/output.txt', 'a'))
-        if not existing_user:
-            curr_user = User(id=user_id, username=profile.get('name'),
-                    email=profile.get('email'), image_file=profile.get('picture'))
-            with app.app_context():
-                db.session.add(curr_user)
-                db.session.flush()
-
-                member_role = Role.query.filter_by(name='member').first()
-                if member_role:
-                    curr_user.roles.append(member_role)
-                db.session.commit()
-        user_roles = db.session.query(User).filter_by(id=user_id).first().roles
-        role_names = [role.name for role in user_roles]
-        session['roles'] = role_names
-
-    if "next" in session:
-        next_url = session['next']
-        session.pop('next', None)
-        return redirect(next_url)
-
-    return redirect("/")
+    html = render_template('home.html', posts=posts, votes=votes, total=total,
+            next_cursor=all_posts.next_cursor, prev_cursor=all_posts.prev_cursor)
+    if not cacheable:
+        return html
+    # a page starting after (or before) a post changes when that post's rank does
+    position = decode_cursor(cursor, len(HOME_ORDER))
+    tags = [post['id'] for post in posts] + ([position[1][-1]] if position else [])
+    page_cache.store(cache_key, html, generation, tags=tags)
+    response = make_response(html)
+    response.headers['X-Cache'] = 'MISS'
+    return response
 
-@app.route("/logout")
-def logout():
-    '''Logout functionality handled by Auth0'''
-    session.clear()
-    return redirect(
-        "https://" + env.get("AUTH0_DOMAIN")
-        + "/v2/logout?"
-        + urlencode(
-            {
-                "returnTo": url_for("home", _external=True),
-                "client_id": env.get("AUTH0_CLIENT_ID"),
-            },
-            quote_via=quote_plus,
-        )
-    )
+@bp.route("/search")
+def search():
+    '''Renders the posts matching the q parameter, best match first, optionally only
+    those posted in the last day, week, month or year (the since parameter)'''
+    terms = request.args.get('q', '').strip()
+    since = request.args.get('since') if request.args.get('since') in RANGES else None
+    results = search_posts(terms, cursor=request.args.get('cursor'), since=since)
+    posts = [{
+                'by': post.author,
+                'descendants': post.descendants,
+                'id': post.id,
+                'title': post.title,
+                'time': datetime.datetime.fromtimestamp(post.time or 0),
+                'url': post.url,
+            } for post in results.items]
+    return render_template('search.html', posts=posts, terms=terms, since=since,
+            ranges=list(RANGES), next_cursor=results.next_cursor,
+            prev_cursor=results.prev_cursor, title='Search')
+
+@bp.route("/item/<int:post_id>")
+@query_budget(3)
+def item(post_id):
+    '''Renders a post and its comment thread. The thread is read in one indexed query
+    and pages for logged out visitors are cached until the thread is recrawled'''
+    cache_key = f"item:{post_id}"
+    cacheable = not session
+    generation = None
+    if cacheable:
+        cached, generation = page_cache.lookup(cache_key)
+        if cached is not None:
+            response = make_response(cached)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+    post = db.session.get(Post, post_id)
+    if post is None or post.hidden:
+        return abort(404)
+    entry = {
+                'by': post.author,
+                'descendants': post.descendants,
+                'id': post.id,
+                'score': post.score,
+                'title': post.title,
+                'time': datetime.datetime.fromtimestamp(post.time or 0),
+                'url': post.url,
+                'likes': post.likes_count,
+                'dislikes': post.dislikes_count
+            }
+    comments = [{
+                'id': c.id,
+                'by': c.author,
+                'text': c.text,
+                'time': datetime.datetime.fromtimestamp(c.time) if c.time else None,
+                'deleted': c.deleted,
+                'depth': c.depth
+            } for c in thread_comments(post_id)]
+    html = render_template('item.html', title=entry['title'], post=entry, comments=comments)
+    if not cacheable:
+        return html
+    page_cache.store(cache_key, html, generation, tags=[post_id])
+    response = make_response(html)
+    response.headers['X-Cache'] = 'MISS'
+    return response
 
-@app.route("/about")
+@bp.route("/about")
 def about():
     '''Gets and renders about page for website'''
     return render_template('about.html', title='About')
 
-@app.route("/account")
-@is_authenticated
-def account():
-    '''Renders the user profile page, only if logged in'''
-    return render_template('account.html', title='Account')
-
-@app.route('/newsfeed', methods=['GET'])
+@bp.route('/newsfeed', methods=['GET'])
 def get_posts():
-    '''Returns json for the 30 most recent posts from the hacker news api'''
-    posts = []
-    with app.app_context():
-        all_posts = db.session.query(Post).order_by(Post.time.desc()).limit(30).all()
-    for i in all_posts:
-        entry = {
-                    'by': i.author,
-                    'descendants': i.descendants,
-                    'id': i.id,
-                    'kids': i.kids,
-                    'score': i.score,
-                    'title': i.title,
-                    'type': i.posttype,
-                    'time': i.time,
-                    'url': i.url
-                }
-        posts.append(entry)
-    return jsonify({"news_items": posts})
-
-@app.route("/like-post/<post_id>", methods=['POST'])
+    '''Returns json for the 30 most recent posts from the hacker news api. Served from
+    the pre-serialized snapshot, compressed when the client accepts it, and answered
+    with 304 Not Modified when the client already has the current snapshot'''
+    snapshot = load_snapshot()
+    encoding = request.accept_encodings.best_match(
+            [name for name in ('br', 'gzip') if name in snapshot.bodies]) or 'identity'
+    response = Response(snapshot.bodies[encoding], mimetype='application/json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    # a strong validator names one representation, so each encoding gets its own
+    response.set_etag(snapshot.etag if encoding == 'identity' else f'{snapshot.etag}-{encoding}')
+    response.last_modified = snapshot.last_modified
+    return response.make_conditional(request)
+
+@bp.route("/like-post/<int:post_id>", methods=['POST'])
 @is_authenticated
+@query_budget(5)
 def like(post_id):
     '''Post request to like a post'''
-    with app.app_context():
-        userid = session.get('user').get('userinfo').get('sub')
-        post = db.session.query(Post).filter_by(id=post_id).first()
-        curr_like = db.session.query(Like).filter_by(author=userid, post_id=post_id).first()
-    if post:
-        if curr_like:
-            with app.app_context():
-                db.session.delete(curr_like)
-                if post.popularity > 0:
-                    post.popularity -= 1
-                    db.session.add(post)
-                db.session.commit()
-            liked = False
-        else:
-            curr_like = Like(author=userid, post_id=post_id)
-            with app.app_context():
-                curr_dislike = db.session.query(Dislike).filter_by(author=userid,
-                        post_id=post_id).first()
-                if curr_dislike:
-                    db.session.delete(curr_dislike)
-                else:
-                    post.popularity += 1
-                    db.session.add(post)
-                db.session.add(curr_like)
-                db.session.commit()
-            liked = True
-    with app.app_context():
-        numlikes = Like.query.filter_by(post_id=post_id).count()
-        numdislikes = Dislike.query.filter_by(post_id=post_id).count()
-    #return redirect(url_for('home'))
+    userid = session.get('user').get('userinfo').get('sub')
+    result = toggle_vote(userid, post_id, Vote.LIKE)
+    if result is None:
+        abort(404)
+    numlikes, numdislikes, liked, reordered = result
+    invalidate_post_pages(post_id, reordered)
+    #return redirect(url_for('main.home'))
     return jsonify({"likes": numlikes, "liked": liked, "dislikes": numdislikes})
 
-@app.route("/dislike-post/<post_id>", methods=['POST'])
+@bp.route("/dislike-post/<int:post_id>", methods=['POST'])
 @is_authenticated
+@query_budget(5)
 def dislike(post_id):
     '''Post request to dislike a post'''
-    with app.app_context():
-        userid = session.get('user').get('userinfo').get('sub')
-        post = db.session.query(Post).filter_by(id=post_id).first()
-        curr_dislike = db.session.query(Dislike).filter_by(author=userid, post_id=post_id).first()
-    if post:
-        if curr_dislike:
-            with app.app_context():
-                db.session.delete(curr_dislike)
-                if post.popularity > 0:
-                    post.popularity -= 1
-                    db.session.add(post)
-                db.session.commit()
-            disliked = False
-        else:
-            curr_dislike = Dislike(author=userid, post_id=post_id)
-            with app.app_context():
-                curr_like = db.session.query(Like).filter_by(author=userid, post_id=post_id).first()
-                if curr_like:
-                    db.session.delete(curr_like)
-                else:
-                    post.popularity += 1
-                    db.session.add(post)
-                db.session.add(curr_dislike)
-                db.session.commit()
-            disliked = True
-    with app.app_context():
-        numdislikes = Dislike.query.filter_by(post_id=post_id).count()
-        numlikes = Like.query.filter_by(post_id=post_id).count()
-    #return redirect(url_for('home'))
+    userid = session.get('user').get('userinfo').get('sub')
+    result = toggle_vote(userid, post_id, Vote.DISLIKE)
+    if result is None:
+        abort(404)
+    numlikes, numdislikes, disliked, reordered = result
+    invalidate_post_pages(post_id, reordered)
+    #return redirect(url_for('main.home'))
     return jsonify({"dislikes": numdislikes, "disliked": disliked, "likes": numlikes})
 
-@app.route('/get_admin')
-@is_authenticated
-def get_admin():
-    '''assign current user an admin role'''
-    with app.app_context():
-        userid = session.get('user').get('userinfo').get('sub')
-        u = db.session.query(User).filter_by(id=userid).first()
-        if u:
-            role = db.session.query(Role).filter_by(name='admin').first()
-            if role:
-                user_roles = u.roles
-                role_names = [role.name for role in user_roles]
-                if 'admin' not in role_names:
-                    u.roles.append(role)
-                    db.session.commit()
-    return redirect(url_for('home'))
-
-@app.route('/admin_post')
-@admin_required
-def admin_dashboard():
-    '''Admin dashboard to view and delete all posts'''
-    posts = []
-    with app.app_context():
-        page = request.args.get('page', 1, type=int)
-        all_posts = db.session.query(Post).order_by(Post.time.desc()).paginate(page=page,
-                per_page=5)
-    for i in all_posts.items:
-        num_likes = Like.query.filter_by(post_id=i.id).count()
-        num_dislikes = Dislike.query.filter_by(post_id=i.id).count()
-
-        entry = {
-                    'by': i.author,
-                    'descendants': i.descendants,
-                    'id': i.id,
-                    'kids': i.kids,
-                    'score': i.score,
-                    'title': i.title,
-                    'type': i.posttype,
-                    'time': datetime.datetime.fromtimestamp(i.time),
-                    'url': i.url,
-                    'likes': num_likes,
-                    'dislikes': num_dislikes
-                }
-        posts.append(entry)
-    return render_template('admin_posts.html',title='Admin', posts=posts, page=page,
-            pages=list(all_posts.iter_pages(left_edge=1, right_edge=1, left_current=1,
-                right_current=2)))
-
-@app.route('/admin_user')
-@admin_required
-def admin_user_dashboard():
-    '''Admin dashboard to view and delete all users'''
-    with app.app_context():
-        all_users = User.query.all()
-
-    return render_template('admin_users.html', title='Admin', users=all_users)
-
-@app.route("/delete-user/<user_id>", methods=['GET'])
-@admin_required
-def delete_user(user_id):
-    '''Request that handles the admin deleting the user'''
-    with app.app_context():
-        user_to_delete = db.session.get(User, user_id)
-        db.session.delete(user_to_delete)
-        db.session.commit()
-    return redirect(url_for('admin_user_dashboard'))
-
-@app.route("/delete-post/<post_id>", methods=['GET'])
-@admin_required
-def delete_post(post_id):
-    '''Request that handles the admin deleting a post'''
-    with app.app_context():
-        post_to_delete = db.session.get(Post, post_id)
-        db.session.delete(post_to_delete)
-        db.session.commit()
-    return redirect(url_for('admin_dashboard'))
+@bp.route("/live/counts")
+@query_budget(2)
+def live_counts_stream():
+    '''Server-sent events with the like and dislike counts of the posts in the posts
+    parameter (comma separated ids): their current counts, then each change. Every
+    worker holds at most LIVE_MAX_STREAMS streams so pages can still be served; past
+    that the counts are sent once and the browser polls every POLL_RETRY milliseconds'''
+    try:
+        post_ids = {int(i) for i in request.args.get('posts', '').split(',') if i}
+    except ValueError:
+        return abort(400)
+    if not post_ids or len(post_ids) > MAX_POSTS:
+        return abort(400)
+    subscription = live_counts.subscribe(post_ids, current_app.config['LIVE_MAX_STREAMS'])
+    if subscription is None:
+        # every stream slot is taken: send the counts now and let the browser poll
+        response = Response(poll_events(current_counts(post_ids)[1], POLL_RETRY),
+                mimetype='text/event-stream')
+        response.cache_control.no_cache = True
+        return response
+    try:
+        seq, initial = current_counts(post_ids)
+    except BaseException:
+        live_counts.unsubscribe(subscription)
+        raise
+    live_counts.follow_from(seq)
+    live_counts.start(current_app._get_current_object()) # pylint: disable=protected-access
+    response = Response(stream_events(subscription, initial,
+            current_app.config['LIVE_STREAM_SECONDS'], HEARTBEAT, RETRY),
+            mimetype='text/event-stream')
+    # the WSGI server closes the response however the stream ends
+    response.call_on_close(lambda: live_counts.unsubscribe(subscription))
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     '''Handles Internal Server Errors and logs it to error.txt'''
     with open('/home/olives/Hacker_News/errors.txt', 'a', encoding='utf-8') as file:
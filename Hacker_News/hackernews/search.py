@@ -0,0 +1,122 @@
+'''Full-text search over stored stories. On sqlite the post_search FTS5 table indexes
+the title, author and url domain of every post; triggers on post keep it in step with
+every insert, delete and edit, including the batched upserts of the ingest jobs, and
+results are ranked with bm25. Other databases fall back to a LIKE scan by time'''
+import re
+import time
+from sqlalchemy import column, func, literal_column, or_, select, table, text
+from hackernews import db
+from hackernews.models import Post
+from hackernews.pagination import KeysetPage, keyset_paginate
+
+SEARCH_TABLE = 'post_search'
+SEARCH_BATCH = 2000
+MAX_TERMS = 8
+# bm25 weights of the title, author and domain columns
+WEIGHTS = (10.0, 3.0, 5.0)
+# the time ranges the search page offers, in seconds
+RANGES = {'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400, 'year': 365 * 86400}
+
+post_search = table(SEARCH_TABLE, column('rowid'), column('title'), column('author'),
+        column('domain'))
+
+_available = {}
+
+def domain_sql(url):
+    '''SQL expression of the host part of the url column expression url, so the
+    triggers need no python function'''
+    rest = (f"CASE WHEN instr({url}, '://') > 0 "
+            f"THEN substr({url}, instr({url}, '://') + 3) ELSE coalesce({url}, '') END")
+    return f"CASE WHEN instr({rest}, '/') > 0 THEN substr({rest}, 1, instr({rest}, '/') - 1) " \
+            f"ELSE {rest} END"
+
+SEARCH_DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    "title, author, domain, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON post BEGIN "
+    f"INSERT INTO {SEARCH_TABLE} (rowid, title, author, domain) "
+    f"VALUES (new.id, new.title, new.author, {domain_sql('new.url')}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON post BEGIN "
+    f"DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id; END",
+    # refreshes only touch score and descendants, so they never rewrite the index
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF title, author, url "
+    f"ON post BEGIN UPDATE {SEARCH_TABLE} SET title = new.title, author = new.author, "
+    f"domain = {domain_sql('new.url')} WHERE rowid = new.id; END",
+)
+
+def fts_available():
+    '''True if the database is sqlite with FTS5 compiled in, checked once per engine'''
+    engine = db.engine
+    if engine.url not in _available:
+        available = engine.dialect.name == 'sqlite'
+        if available:
+            options = {row[0] for row in db.session.execute(text('PRAGMA compile_options'))}
+            available = 'ENABLE_FTS5' in options
+        _available[engine.url] = available
+    return _available[engine.url]
+
+def create_search_index():
+    '''Creates post_search and its triggers if they are missing. Returns True if the
+    table is new and needs rebuild_search_index; the caller commits'''
+    if not fts_available():
+        return False
+    exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {'name': SEARCH_TABLE}).first()
+    for statement in SEARCH_DDL:
+        db.session.execute(text(statement))
+    return exists is None
+
+def rebuild_search_index(batch_size=SEARCH_BATCH):
+    '''Indexes every stored post again, batch_size posts per transaction in id order, so
+    the write lock is released between batches. Returns the number of posts indexed'''
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    db.session.commit()
+    indexed = 0
+    last_id = 0
+    while True:
+        post_ids = db.session.scalars(select(Post.id).where(Post.id > last_id)
+                .order_by(Post.id).limit(batch_size)).all()
+        if not post_ids:
+            break
+        db.session.execute(text(f"INSERT INTO {SEARCH_TABLE} (rowid, title, author, domain) "
+                f"SELECT id, title, author, {domain_sql('url')} FROM post "
+                "WHERE id > :first AND id <= :last"),
+                {'first': last_id, 'last': post_ids[-1]})
+        db.session.commit()
+        indexed += len(post_ids)
+        last_id = post_ids[-1]
+    return indexed
+
+def match_query(terms):
+    '''FTS5 query for the words of what a visitor typed: every word must match, the
+    last one as a prefix, and quoting keeps FTS5 operators out. None if there are
+    no words'''
+    words = re.findall(r'\w+', terms or '')[:MAX_TERMS]
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+def search_posts(terms, cursor=None, per_page=10, since=None, now=None):
+    '''Returns a KeysetPage of the visible posts matching terms, best match first on
+    sqlite and newest first elsewhere. since is a key of RANGES that limits results to
+    recent posts; cursor is a token from a previous page'''
+    query = match_query(terms)
+    if query is None:
+        return KeysetPage(items=[], next_cursor=None, prev_cursor=None)
+    posts = db.session.query(Post).filter(Post.hidden.is_(False))
+    if since in RANGES:
+        posts = posts.filter(Post.time >= (now or time.time()) - RANGES[since])
+    if not fts_available():
+        like = [f'%{word}%' for word in re.findall(r'\w+', terms)[:MAX_TERMS]]
+        posts = posts.filter(*[or_(Post.title.ilike(word), Post.author.ilike(word),
+                Post.url.ilike(word)) for word in like])
+        return keyset_paginate(posts, (Post.time, Post.id), cursor=cursor, per_page=per_page)
+    matches = select(post_search.c.rowid.label('post_id'),
+            func.bm25(literal_column(SEARCH_TABLE), *WEIGHTS).label('relevance')) \
+            .where(literal_column(SEARCH_TABLE).op('MATCH')(query)).subquery()
+    posts = posts.join(matches, matches.c.post_id == Post.id) \
+            .add_columns(matches.c.relevance, matches.c.post_id)
+    # bm25 is lower for better matches, so the order is ascending
+    page = keyset_paginate(posts, (matches.c.relevance, matches.c.post_id), cursor=cursor,
+            per_page=per_page, descending=False)
+    return page._replace(items=[row.Post for row in page.items])
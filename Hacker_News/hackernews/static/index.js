@@ -15,11 +15,32 @@ document.addEventListener("DOMContentLoaded", function() {
             dislike(postId);
         });
     });
+
+    followCounts();
 });
 
+// keeps the like and dislike counts of the posts on the page current while it is open
+function followCounts() {
+	const counts = document.querySelectorAll("[id^='likes-count-']");
+	if(counts.length === 0 || !window.EventSource)
+		return;
+	const postIds = Array.from(counts, (count) => count.id.split("-")[2]);
+	const source = new EventSource('/live/counts?posts=' + postIds.join(','));
+	source.addEventListener("counts", function(event) {
+		JSON.parse(event.data).forEach((post) => {
+			document.getElementById('likes-count-' + post.post_id).innerHTML = post.likes;
+			document.getElementById('dislikes-count-' + post.post_id).innerHTML = post.dislikes;
+		});
+	});
+}
+
+// set by the page: "member" when logged in, "anonymous" otherwise
+function loggedIn() {
+	return document.body.dataset.viewer === "member";
+}
+
 function like(postId) {
-	//console.log(sessionData);
-	if(!sessionData.hasOwnProperty('user'))
+	if(!loggedIn())
 		alert('Please log in to like this post');
 	else {
 	const likeCount = document.getElementById('likes-count-' + postId);
@@ -45,7 +66,7 @@ function like(postId) {
 }
 
 function dislike(postId) {
-	if(!sessionData.hasOwnProperty('user'))
+	if(!loggedIn())
                 alert('Please log in to dislike this post');
         else {
         const dislikeCount = document.getElementById('dislikes-count-' + postId);
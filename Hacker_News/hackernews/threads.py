@@ -0,0 +1,182 @@
+'''Crawls comment threads from the hacker news api into the comment table and reads
+them back for the thread page'''
+import html
+from collections import defaultdict, namedtuple
+from html.parser import HTMLParser
+from sqlalchemy import or_, update
+from hackernews import db
+from hackernews.ingest import UPSERT_BATCH, delete_comments, is_story
+from hackernews.models import Comment, Post, dialect_insert
+
+DEFAULT_MAX_DEPTH = 8
+DEFAULT_MAX_COMMENTS = 1000
+DEFAULT_THREADS = 30
+# the columns a crawl can change; id and post_id never do
+COMMENT_COLUMNS = ('parent_id', 'position', 'author', 'text', 'time', 'deleted', 'path', 'depth')
+ALLOWED_TAGS = {'p', 'i', 'b', 'em', 'strong', 'pre', 'code'}
+
+Thread = namedtuple('Thread', ['rows', 'known_kids'])
+ThreadResult = namedtuple('ThreadResult', ['post_id', 'written', 'deleted'])
+
+class _CommentCleaner(HTMLParser):
+    '''keeps the handful of tags hacker news uses in comments and escapes the rest.
+    Tags are kept balanced, so nothing a comment leaves open reaches the markup after it'''
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.open_tags = []
+
+    def _close_through(self, tag):
+        '''closes the innermost open tag and every tag opened inside it'''
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.parts.append(f'</{open_tag}>')
+            if open_tag == tag:
+                return
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('p', 'pre') and 'p' in self.open_tags:
+            # like a browser: a new paragraph or block ends the open paragraph
+            self._close_through('p')
+        if tag in ALLOWED_TAGS:
+            self.parts.append(f'<{tag}>')
+            self.open_tags.append(tag)
+        elif tag == 'a':
+            href = dict(attrs).get('href') or ''
+            if href.startswith(('http://', 'https://')):
+                self.parts.append(f'<a href="{html.escape(href)}" rel="nofollow">')
+                self.open_tags.append('a')
+
+    def handle_endtag(self, tag):
+        # end tags without a matching open tag are dropped
+        if tag in self.open_tags:
+            self._close_through(tag)
+
+    def handle_data(self, data):
+        self.parts.append(html.escape(data))
+
+    def close(self):
+        super().close()
+        self._close_through(None)
+
+def clean_comment_html(text):
+    '''comment html from the api, reduced to balanced markup that is safe to render
+    as is'''
+    if not text:
+        return text
+    cleaner = _CommentCleaner()
+    cleaner.feed(text)
+    cleaner.close()
+    return ''.join(cleaner.parts)
+
+def comment_row(item, post_id, parent_id, position, path, depth):
+    '''maps an api comment onto the columns of the comment table'''
+    deleted = bool(item.get('deleted') or item.get('dead'))
+    return {
+        'id': item['id'],
+        'post_id': post_id,
+        'parent_id': parent_id,
+        'position': position,
+        'author': item.get('by'),
+        'text': None if deleted else clean_comment_html(item.get('text')),
+        'time': item.get('time'),
+        'deleted': deleted,
+        'path': path,
+        'depth': depth,
+    }
+
+def crawl_thread(client, story, max_depth=DEFAULT_MAX_DEPTH, max_comments=DEFAULT_MAX_COMMENTS):
+    '''Walks the kids tree of story one level at a time; every level is fetched
+    concurrently by the client's bounded pool. Stops below max_depth levels or after
+    max_comments comments, keeping the upper levels. Returns a Thread with the rows
+    and the complete kids list of every item that was fetched'''
+    post_id = story['id']
+    known_kids = {None: story.get('kids') or []}
+    level = [(kid, None, Comment.path_for(kid), position)
+            for position, kid in enumerate(known_kids[None])]
+    rows = []
+    depth = 0
+    while level and depth < max_depth and len(rows) < max_comments:
+        level = level[:max_comments - len(rows)]
+        items = {item['id']: item for item in client.items(entry[0] for entry in level)}
+        next_level = []
+        for comment_id, parent_id, path, position in level:
+            item = items.get(comment_id)
+            if item is None:
+                continue
+            rows.append(comment_row(item, post_id, parent_id, position, path, depth))
+            known_kids[comment_id] = item.get('kids') or []
+            next_level.extend((kid, comment_id, Comment.path_for(kid, path), kid_position)
+                    for kid_position, kid in enumerate(known_kids[comment_id]))
+        level = next_level
+        depth += 1
+    return Thread(rows=rows, known_kids=known_kids)
+
+def store_thread(story, thread):
+    '''Writes a crawled thread incrementally: stored comments are read with one query,
+    only new or changed rows are upserted, and comments no longer listed under a parent
+    that was fetched are deleted with their replies. Records the story's descendants so
+    the thread is skipped until it changes. Returns a ThreadResult; the caller commits'''
+    post_id = story['id']
+    stored = {row.id: row for row in db.session.query(Comment.id,
+            *[getattr(Comment, column) for column in COMMENT_COLUMNS]).filter_by(post_id=post_id)}
+    changed = [row for row in thread.rows if row['id'] not in stored
+            or any(getattr(stored[row['id']], column) != row[column] for column in COMMENT_COLUMNS)]
+    listed = {parent: set(kids) for parent, kids in thread.known_kids.items()}
+    dropped = [row.id for row in stored.values()
+            if row.parent_id in listed and row.id not in listed[row.parent_id]]
+    delete_comments(dropped)
+    for start in range(0, len(changed), UPSERT_BATCH):
+        stmt = dialect_insert(Comment.__table__).values(changed[start:start + UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(index_elements=[Comment.__table__.c.id],
+                set_={column: stmt.excluded[column] for column in COMMENT_COLUMNS})
+        db.session.execute(stmt)
+    db.session.execute(update(Post).where(Post.id == post_id)
+            .values(crawled_descendants=story.get('descendants') or 0))
+    return ThreadResult(post_id=post_id, written=len(changed), deleted=len(dropped))
+
+def stale_threads(limit=DEFAULT_THREADS):
+    '''ids of the newest stored posts whose comment count changed since their last crawl'''
+    rows = db.session.query(Post.id).filter(or_(Post.crawled_descendants.is_(None),
+            Post.crawled_descendants != Post.descendants)) \
+            .order_by(Post.time.desc()).limit(limit)
+    return [row.id for row in rows]
+
+def refresh_threads(client, post_ids=None, max_depth=DEFAULT_MAX_DEPTH,
+        max_comments=DEFAULT_MAX_COMMENTS):
+    '''Crawls and stores the threads of post_ids (by default the stale ones),
+    committing after each thread. Stories whose descendants did not change since
+    the last crawl are skipped. Returns the ThreadResult of every crawled thread'''
+    if post_ids is None:
+        post_ids = stale_threads()
+    crawled = dict(db.session.query(Post.id, Post.crawled_descendants)
+            .filter(Post.id.in_(post_ids)))
+    results = []
+    for story in client.items(post_ids):
+        if not is_story(story) or story['id'] not in crawled:
+            continue
+        if crawled[story['id']] == (story.get('descendants') or 0):
+            continue
+        thread = crawl_thread(client, story, max_depth=max_depth, max_comments=max_comments)
+        db.session.execute(update(Post).where(Post.id == story['id'])
+                .values(descendants=story.get('descendants'), score=story.get('score')))
+        results.append(store_thread(story, thread))
+        db.session.commit()
+    return results
+
+def thread_comments(post_id):
+    '''Every stored comment of post_id, read in one range scan of ix_comment_post_path,
+    in the order hacker news shows them: depth first, replies by their position'''
+    comments = db.session.query(Comment).filter_by(post_id=post_id).order_by(Comment.path).all()
+    replies = defaultdict(list)
+    for comment in comments:
+        replies[comment.parent_id].append(comment)
+    for siblings in replies.values():
+        siblings.sort(key=lambda comment: comment.position)
+    ordered = []
+    stack = list(reversed(replies[None]))
+    while stack:
+        comment = stack.pop()
+        ordered.append(comment)
+        stack.extend(reversed(replies[comment.id]))
+    return ordered
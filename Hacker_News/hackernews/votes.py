@@ -0,0 +1,128 @@
+'''Vote service: every change to votes and post counters goes through here so that
+concurrent gunicorn workers never lose an update'''
+import time
+from collections import namedtuple
+from sqlalchemy import case, delete, func, insert, select, tuple_, union_all, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from hackernews import db
+from hackernews.models import Post, Vote, VoteChange
+from hackernews.ranking import epoch_subquery, rank_expression
+
+RETRIES = 5
+RETRY_DELAY = 0.05
+
+# reordered is True when the post's new rank moved it past another visible post, so
+# it may have changed pages; otherwise only the pages showing it are out of date
+VoteResult = namedtuple('VoteResult', ['likes', 'dislikes', 'voted', 'reordered'])
+
+def viewer_votes(user_id, post_ids, session=None):
+    '''Returns {post_id: 'like' or 'dislike'} for the posts in post_ids the user voted
+    on, using one indexed query no matter how many votes those posts have'''
+    if not post_ids:
+        return {}
+    session = session or db.session
+    names = {Vote.LIKE: 'like', Vote.DISLIKE: 'dislike'}
+    votes = session.execute(select(Vote.post_id, Vote.value)
+            .where(Vote.user_id == user_id, Vote.post_id.in_(post_ids)))
+    return {post_id: names[value] for post_id, value in votes}
+
+def retract_user_votes(user_id, session=None):
+    '''Takes the user's votes off the like and dislike counters of the posts they voted
+    on with one UPDATE, without loading the votes. Run it in the transaction that
+    deletes the user; the vote rows themselves go with the user (ON DELETE CASCADE)'''
+    session = session or db.session
+    def count(value):
+        return select(func.count()).where(Vote.post_id == Post.id, Vote.user_id == user_id,
+                Vote.value == value).scalar_subquery()
+    likes = Post.likes_count - count(Vote.LIKE)
+    dislikes = Post.dislikes_count - count(Vote.DISLIKE)
+    voted = select(Vote.post_id).where(Vote.user_id == user_id)
+    session.execute(update(Post)
+            .where(Post.id.in_(voted))
+            .values(likes_count=likes, dislikes_count=dislikes,
+                rank=rank_expression(Post.score, likes, dislikes, Post.time, epoch_subquery())))
+    session.execute(insert(VoteChange).from_select(['post_id', 'likes', 'dislikes'],
+            select(Post.id, Post.likes_count, Post.dislikes_count).where(Post.id.in_(voted))))
+
+def _places(session, posts, post_id):
+    '''(rank, id) of the post and of the visible posts just above and below it in the
+    home page order, as (own, above, below); above and below are None at the ends'''
+    place = tuple_(posts.c.rank, posts.c.id)
+    own = tuple_(select(posts.c.rank).where(posts.c.id == post_id).scalar_subquery(), post_id)
+    visible = posts.c.hidden.is_(False) & (posts.c.id != post_id)
+    parts = [select(posts.c.rank, posts.c.id).where(posts.c.id == post_id),
+            select(posts.c.rank, posts.c.id).where(visible, place > own)
+                .order_by(posts.c.rank, posts.c.id).limit(1),
+            select(posts.c.rank, posts.c.id).where(visible, place < own)
+                .order_by(posts.c.rank.desc(), posts.c.id.desc()).limit(1)]
+    rows = session.execute(union_all(*[select(part.subquery()) for part in parts])).all()
+    own = next((tuple(row) for row in rows if row.id == post_id), None)
+    others = [tuple(row) for row in rows if row.id != post_id]
+    return (own, next((row for row in others if row > own), None),
+            next((row for row in others if row < own), None))
+
+def _toggle(session, user_id, post_id, value):
+    '''one attempt at toggle_vote, inside the caller's transaction'''
+    votes = Vote.__table__
+    posts = Post.__table__
+    key = (votes.c.user_id == user_id) & (votes.c.post_id == post_id)
+    # Deleting first makes the opening statement a write, so the transaction holds the
+    # write lock (sqlite) or the row lock (postgresql) before the previous vote is known
+    previous = session.execute(delete(votes).where(key).returning(votes.c.value)).scalar()
+    # where the post stood before the vote, to tell whether it moves past a neighbour
+    own, above, below = _places(session, posts, post_id)
+    new = None if previous == value else value
+    if new is not None:
+        session.execute(insert(votes).values(user_id=user_id, post_id=post_id, value=new))
+    likes = int(new == Vote.LIKE) - int(previous == Vote.LIKE)
+    dislikes = int(new == Vote.DISLIKE) - int(previous == Vote.DISLIKE)
+    change = int(new is not None) - int(previous is not None)
+    # SET expressions see the old row, so the rank is computed from the new counts
+    # spelled out again; it is measured at the rank epoch like every other stored rank
+    counts = session.execute(update(posts).where(posts.c.id == post_id).values(
+                likes_count=posts.c.likes_count + likes,
+                dislikes_count=posts.c.dislikes_count + dislikes,
+                popularity=case((posts.c.popularity + change < 0, 0),
+                    else_=posts.c.popularity + change),
+                rank=rank_expression(posts.c.score, posts.c.likes_count + likes,
+                    posts.c.dislikes_count + dislikes, posts.c.time, epoch_subquery()))
+            .returning(posts.c.likes_count, posts.c.dislikes_count, posts.c.rank)).first()
+    if counts is not None:
+        # committed with the vote, so the live streams never see a count that was rolled back
+        session.execute(insert(VoteChange.__table__).values(post_id=post_id,
+                likes=counts.likes_count, dislikes=counts.dislikes_count))
+    reordered = counts is not None and own is not None and (
+            (above is not None and (counts.rank, post_id) > above)
+            or (below is not None and (counts.rank, post_id) < below))
+    return counts, new, reordered
+
+def toggle_vote(user_id, post_id, value, session=None):
+    '''Casts value (Vote.LIKE or Vote.DISLIKE) for the user, replacing an opposite
+    vote, or takes it back if the user had already cast it. The vote and the post
+    counters are changed SQL-side in one transaction, which is retried when the
+    database is locked by another writer.
+    Returns a VoteResult, or None if the post does not exist'''
+    session = session or db.session
+    for attempt in range(RETRIES):
+        try:
+            counts, new, reordered = _toggle(session, user_id, post_id, value)
+            if counts is None:
+                session.rollback()
+                return None
+            session.commit()
+            return VoteResult(counts.likes_count, counts.dislikes_count, new is not None,
+                    reordered)
+        except IntegrityError:
+            # either the post is gone (foreign key) or a concurrent toggle inserted
+            # the same vote first (postgresql)
+            session.rollback()
+            if session.get(Post, post_id) is None:
+                return None
+            if attempt == RETRIES - 1:
+                raise
+        except OperationalError as error:
+            session.rollback()
+            if 'database is locked' not in str(error) or attempt == RETRIES - 1:
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+    return None
@@ -1,5 +1,7 @@
 '''Runs the hackernews app'''
-from hackernews import app
+from hackernews import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
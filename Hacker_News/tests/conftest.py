@@ -0,0 +1,40 @@
+'''Shared fixtures for the hackernews tests'''
+from contextlib import contextmanager
+import pytest
+
+from hackernews import db, page_cache
+from hackernews.instrumentation import count_queries
+from hackernews.migrations import upgrade_schema
+from tests.testapp import app
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    '''brings the test database up to the current schema once per run'''
+    with app.app_context():
+        upgrade_schema()
+
+@pytest.fixture(autouse=True)
+def empty_page_cache():
+    '''tests write to the db directly, so no page may outlive a test'''
+    page_cache.invalidate()
+
+@pytest.fixture
+def queries():
+    '''list of every SQL statement executed while the test runs'''
+    with app.app_context():
+        engine = db.engine
+    with count_queries(engine) as statements:
+        yield statements
+
+@pytest.fixture
+def max_queries():
+    '''with max_queries(n): fails the test if the block runs more than n statements'''
+    with app.app_context():
+        engine = db.engine
+    @contextmanager
+    def check(limit):
+        with count_queries(engine) as statements:
+            yield statements
+        assert len(statements) <= limit, \
+                f'{len(statements)} queries, expected at most {limit}:\n' + '\n'.join(statements)
+    return check
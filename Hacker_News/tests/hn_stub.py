@@ -0,0 +1,124 @@
+'''Local stand-in for the hacker news firebase api, used by tests and benchmarks'''
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ITEM_PATH = re.compile(r'^/v0/item/(\d+)\.json$')
+
+def make_story(item_id, **fields):
+    '''returns a story item shaped like the real api'''
+    story = {
+        'by': f'author{item_id}',
+        'descendants': 0,
+        'id': item_id,
+        'kids': [],
+        'score': 1,
+        'time': 1700000000 + item_id % 100000,
+        'title': f'Story {item_id}',
+        'type': 'story',
+        'url': f'https://example.com/{item_id}',
+    }
+    story.update(fields)
+    return story
+
+def make_comment(item_id, parent, **fields):
+    '''returns a comment item shaped like the real api'''
+    comment = {
+        'by': f'commenter{item_id}',
+        'id': item_id,
+        'kids': [],
+        'parent': parent,
+        'text': f'Comment {item_id}',
+        'time': 1700000000 + item_id % 100000,
+        'type': 'comment',
+    }
+    comment.update(fields)
+    return comment
+
+class _Server(ThreadingHTTPServer):
+    '''threaded server with a backlog deep enough for a burst of concurrent connects'''
+    daemon_threads = True
+    request_queue_size = 128
+
+class HNStub:
+    '''Serves topstories.json, updates.json, maxitem.json and item/<id>.json from memory
+    on a local port. `latency` seconds are slept before each response to mimic a remote
+    api.'''
+    def __init__(self, items=(), top=None, latency=0.0):
+        self.items = {item['id']: item for item in items}
+        self.top = list(top) if top is not None else list(self.items)
+        self.updates = {'items': [], 'profiles': []}
+        self.latency = latency
+        self.requests = []
+        self.connections = set()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        '''base url to hand to HNClient'''
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v0'
+
+    def add(self, *items):
+        '''adds (or replaces) items served by the stub'''
+        for item in items:
+            self.items[item['id']] = item
+
+    def item_requests(self):
+        '''ids of every item requested so far'''
+        return [int(ITEM_PATH.match(path).group(1)) for path in self.requests
+                if ITEM_PATH.match(path)]
+
+    def route(self, path):
+        '''returns the payload for path, or None for a 404'''
+        if path == '/v0/topstories.json':
+            return self.top
+        if path == '/v0/updates.json':
+            return self.updates
+        if path == '/v0/maxitem.json':
+            return max(self.items, default=0)
+        match = ITEM_PATH.match(path)
+        if match:
+            return self.items.get(int(match.group(1)))
+        return None
+
+    def start(self):
+        '''starts serving in a background thread'''
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            '''keep-alive handler that answers from the stub'''
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            def do_GET(self): # pylint: disable=invalid-name
+                '''answers a single GET request'''
+                stub.requests.append(self.path)
+                stub.connections.add(self.client_address)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                payload = stub.route(self.path)
+                body = json.dumps(payload).encode() if payload is not None else b'null'
+                self.send_response(200 if payload is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''stops serving'''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
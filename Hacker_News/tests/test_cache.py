@@ -0,0 +1,86 @@
+'''Tests the cache.py module'''
+import sqlite3
+import time
+from hackernews.cache import PageCache
+
+def test_lookup_and_store(tmp_path):
+    '''a stored page is a hit until it expires'''
+    cache = PageCache(str(tmp_path / 'cache.db'), ttl=0.2)
+    body, generation = cache.lookup('home:')
+    assert body is None
+    cache.store('home:', '<html>', generation)
+    assert cache.lookup('home:')[0] == '<html>'
+    time.sleep(0.25)
+    assert cache.lookup('home:')[0] is None
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 2)
+
+def test_least_recently_used_is_evicted(tmp_path):
+    '''past max_entries the page read longest ago goes first'''
+    cache = PageCache(str(tmp_path / 'cache.db'), max_entries=2)
+    generation = cache.lookup('a')[1]
+    cache.store('a', 'A', generation)
+    cache.store('b', 'B', generation)
+    time.sleep(0.01)
+    cache.lookup('a')
+    cache.store('c', 'C', generation)
+    assert [cache.lookup(key)[0] for key in 'abc'] == ['A', None, 'C']
+
+def test_invalidation(tmp_path):
+    '''tags drop single pages and a page rendered before invalidate() is never stored'''
+    cache = PageCache(str(tmp_path / 'cache.db'))
+    other_worker = PageCache(cache.path)
+    generation = cache.lookup('p1')[1]
+    cache.store('p1', 'one', generation, tags=[1, 2])
+    cache.store('p2', 'two', generation, tags=[12])
+    other_worker.invalidate_tag(1)
+    assert cache.lookup('p1')[0] is None
+    assert cache.lookup('p2')[0] == 'two'
+
+    stale_generation = cache.lookup('p3')[1]
+    other_worker.invalidate()
+    cache.store('p3', 'stale', stale_generation)
+    assert cache.lookup('p3')[0] is None
+    assert cache.lookup('p2')[0] is None
+
+def test_lookups_do_not_write(tmp_path):
+    '''hits and misses are counted in memory and written by flush'''
+    cache = PageCache(str(tmp_path / 'cache.db'))
+    generation = cache.lookup('home:')[1]
+    cache.store('home:', '<html>', generation)
+    other_worker = PageCache(cache.path)
+    before = other_worker.stats()
+    for _ in range(3):
+        cache.lookup('home:')
+    cache.lookup('item:1')
+    assert other_worker.stats()['hits'] == before['hits']
+    cache.flush()
+    after = other_worker.stats()
+    assert (after['hits'], after['misses']) == (before['hits'] + 3, before['misses'] + 1)
+
+def test_broken_file_is_a_miss(tmp_path):
+    '''a cache file that is not a database serves every page as a miss'''
+    path = tmp_path / 'cache.db'
+    path.write_bytes(b'not a database' * 100)
+    cache = PageCache(str(path))
+    body, generation = cache.lookup('home:')
+    cache.store('home:', '<html>', generation)
+    assert (body, generation) == (None, None)
+    assert cache.lookup('home:')[0] is None
+
+def test_failed_invalidation(tmp_path):
+    '''an invalidation that can not be written turns caching off in this process until
+    a later lookup gets it through'''
+    cache = PageCache(str(tmp_path / 'cache.db'))
+    generation = cache.lookup('home:')[1]
+    cache.store('home:', 'old', generation, tags=[1])
+    locker = sqlite3.connect(cache.path, isolation_level=None)
+    locker.execute('BEGIN IMMEDIATE')
+    cache._db().execute('PRAGMA busy_timeout = 0') # pylint: disable=protected-access
+    cache.invalidate_tag(1)
+    cache.invalidate()
+    assert cache.lookup('home:') == (None, None)
+    locker.execute('ROLLBACK')
+    body, generation = cache.lookup('home:')
+    cache.store('home:', 'new', generation)
+    assert body is None and generation is not None
+    assert cache.lookup('home:')[0] == 'new'
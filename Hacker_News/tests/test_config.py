@@ -0,0 +1,31 @@
+'''Tests for reading the database settings from the environment'''
+from hackernews import db
+from hackernews.config import DEFAULT_DATABASE_URI, database_settings
+from tests.testapp import app
+
+def test_database_defaults():
+    '''without DATABASE_URL the app keeps using the sqlite file, in WAL mode'''
+    settings = database_settings({})
+    assert settings['SQLALCHEMY_DATABASE_URI'] == DEFAULT_DATABASE_URI
+    assert settings['SQLITE_PRAGMAS']['journal_mode'] == 'WAL'
+    assert settings['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] == 5
+
+def test_database_from_environment():
+    '''DATABASE_URL and the pool settings come from the environment'''
+    settings = database_settings({'DATABASE_URL': 'postgres://hn:secret@db/hackernews',
+            'DB_POOL_SIZE': '20', 'SQLITE_BUSY_TIMEOUT': '100'})
+    assert settings['SQLALCHEMY_DATABASE_URI'] == 'postgresql://hn:secret@db/hackernews'
+    assert settings['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] == 20
+    assert settings['SQLALCHEMY_ENGINE_OPTIONS']['pool_pre_ping']
+    assert settings['SQLITE_PRAGMAS']['busy_timeout'] == 100
+    assert 'pool_size' not in database_settings(
+            {'DATABASE_URL': 'sqlite://'})['SQLALCHEMY_ENGINE_OPTIONS']
+
+def test_sqlite_pragmas_applied():
+    '''every connection the app opens has the configured pragmas'''
+    with app.app_context():
+        with db.engine.connect() as conn:
+            journal_mode = conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+            busy_timeout = conn.exec_driver_sql('PRAGMA busy_timeout').scalar()
+    assert journal_mode == 'wal'
+    assert busy_timeout == app.config['SQLITE_PRAGMAS']['busy_timeout']
@@ -1,14 +1,171 @@
 '''Tests the data.py module'''
+import time
+from sqlalchemy import event
 import data
-from hackernews import app
-from hackernews.models import Post
+from hackernews import db
+from hackernews.ingest import (SYNC_TIME, SYNC_WINDOW, HNClient, refresh_posts, sync_updates,
+        upsert_posts)
+from hackernews.models import AppState, Comment, Post
+from tests.hn_stub import HNStub, make_story
+from tests.testapp import app
 
 def test_fetch_and_store_stories():
     '''Tests the fetcha_and _store_stories function'''
     with app.app_context():
         total_posts = Post.query.count()
-    new_stories = data.fetch_and_store_stories()
+        new_stories = data.fetch_and_store_stories()
 
     with app.app_context():
         new_total_posts = Post.query.count()
     assert new_total_posts == total_posts+new_stories
+
+def test_fetch_and_store_stories_stub():
+    '''Fetches from a local stub api and skips stories that are already stored'''
+    ids = list(range(990000001, 990000021))
+    items = [make_story(i) for i in ids]
+    items[0] = make_story(ids[0], type='job')
+    with HNStub(items) as stub, app.app_context():
+        saved = data.fetch_and_store_stories(depth=20, workers=4, base_url=stub.url)
+        assert saved == 19
+        assert sorted(stub.item_requests()) == ids
+        assert len(stub.connections) <= 4
+
+        stub.requests.clear()
+        saved_again = data.fetch_and_store_stories(depth=20, workers=4, base_url=stub.url)
+        assert saved_again == 0
+        assert stub.item_requests() == [ids[0]]
+
+    with app.app_context():
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+
+def test_client_items_keeps_order():
+    '''Concurrent fetches come back in the order they were asked for'''
+    ids = list(range(1, 31))
+    with HNStub([make_story(i) for i in ids], latency=0.01) as stub:
+        with HNClient(base_url=stub.url, workers=8) as client:
+            fetched = client.items(ids + [999])
+    assert [item['id'] for item in fetched] == ids
+
+def test_upsert_posts_refreshes_existing_rows():
+    '''One INSERT ... ON CONFLICT writes new rows and refreshes stored ones'''
+    ids = list(range(990000101, 990000111))
+    statements = []
+    def count(conn, cursor, statement, *args): # pylint: disable=unused-argument
+        statements.append(statement)
+    with app.app_context():
+        upsert_posts([make_story(ids[0], score=5)])
+        stored = db.session.get(Post, ids[0])
+        stored.popularity = 3
+        db.session.commit()
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        written = upsert_posts([make_story(i, score=50, descendants=7, kids=[i * 10, i * 10 + 1])
+                for i in ids])
+        event.remove(db.engine, 'before_cursor_execute', count)
+        assert written == 10
+        assert len([s for s in statements if s.startswith('INSERT INTO post')]) == 1
+        assert len([s for s in statements if s.startswith('INSERT INTO comment')]) == 1
+
+        db.session.expire_all()
+        refreshed = db.session.get(Post, ids[0])
+        assert (refreshed.score, refreshed.descendants, refreshed.kids) == \
+                (50, 7, [ids[0] * 10, ids[0] * 10 + 1])
+        assert refreshed.popularity == 3
+        assert Post.query.filter(Post.id.in_(ids)).count() == 10
+        Comment.query.filter(Comment.post_id.in_(ids)).delete()
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+
+def test_kids_are_kept_in_order():
+    '''Changed kids are rewritten in their new order and dropped ones are deleted'''
+    post_id = 990000151
+    kids = [post_id * 10 + i for i in range(3)]
+    with app.app_context():
+        upsert_posts([make_story(post_id, kids=kids)])
+        unchanged = refresh_posts([make_story(post_id, kids=kids)])
+        changed = refresh_posts([make_story(post_id, kids=[kids[2], kids[0]])])
+        db.session.commit()
+        stored = db.session.get(Post, post_id).kids
+        remaining = Comment.query.filter(Comment.id.in_(kids)).count()
+        db.session.delete(db.session.get(Post, post_id))
+        db.session.commit()
+        orphans = Comment.query.filter(Comment.id.in_(kids)).count()
+    assert (unchanged, changed) == (0, 1)
+    assert stored == [kids[2], kids[0]]
+    assert (remaining, orphans) == (2, 0)
+
+def test_fetch_and_store_stories_refresh():
+    '''Refreshing fetches stored stories again and updates their score'''
+    ids = list(range(990000201, 990000206))
+    with HNStub([make_story(i) for i in ids]) as stub, app.app_context():
+        assert data.fetch_and_store_stories(depth=5, base_url=stub.url) == 5
+        stub.add(*[make_story(i, score=99) for i in ids])
+        assert data.fetch_and_store_stories(depth=5, base_url=stub.url, refresh=True) == 0
+    with app.app_context():
+        assert {p.score for p in Post.query.filter(Post.id.in_(ids))} == {99}
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+
+def test_sync_stories():
+    '''Only stored stories in the updates feed are fetched, and the cursor is saved'''
+    ids = list(range(990000301, 990000306))
+    with HNStub([make_story(i) for i in ids]) as stub, app.app_context():
+        data.fetch_and_store_stories(depth=5, base_url=stub.url)
+        AppState.set(SYNC_TIME, int(time.time()))
+        db.session.commit()
+        stub.add(make_story(ids[0], score=40), make_story(990000399))
+        stub.updates['items'] = [ids[0], ids[1], 990000399]
+        stub.requests.clear()
+        result = data.sync_stories(base_url=stub.url)
+        assert sorted(stub.item_requests()) == [ids[0], ids[1]]
+    assert result == (2, 1, 990000399, False)
+    with app.app_context():
+        assert db.session.get(Post, ids[0]).score == 40
+        assert AppState.get('sync.maxitem') == '990000399'
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+
+def test_sync_after_downtime():
+    '''a cursor older than the updates feed reaches makes the sync refresh every stored
+    story on the front page, not only those in the feed'''
+    ids = list(range(990000311, 990000316))
+    with HNStub([make_story(i) for i in ids]) as stub, app.app_context():
+        data.fetch_and_store_stories(depth=5, base_url=stub.url)
+        AppState.set(SYNC_TIME, int(time.time()) - SYNC_WINDOW - 60)
+        db.session.commit()
+        stub.add(*[make_story(i, score=70) for i in ids])
+        stub.updates['items'] = [ids[0]]
+        stub.requests.clear()
+        result = data.sync_stories(base_url=stub.url)
+        assert sorted(stub.item_requests()) == ids
+        again = data.sync_stories(base_url=stub.url)
+    assert (result.refreshed, result.full) == (5, True)
+    assert not again.full
+    with app.app_context():
+        assert {p.score for p in Post.query.filter(Post.id.in_(ids))} == {70}
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+
+def test_sync_after_feed_outage():
+    '''a run that can not read the updates feed keeps the old cursor, so the run after
+    the outage catches up on the front page'''
+    ids = list(range(990000321, 990000326))
+    synced = int(time.time())
+    with HNStub([make_story(i) for i in ids]) as stub, app.app_context(), \
+            HNClient(base_url=stub.url) as client:
+        data.fetch_and_store_stories(depth=5, base_url=stub.url)
+        AppState.set(SYNC_TIME, synced)
+        db.session.commit()
+        stub.updates = None
+        down = sync_updates(client, now=synced + 300)
+        cursor = AppState.get(SYNC_TIME)
+        stub.updates = {'items': [], 'profiles': []}
+        stub.add(*[make_story(i, score=80) for i in ids])
+        back = sync_updates(client, now=synced + SYNC_WINDOW + 60)
+    assert (down.fetched, down.full) == (0, False)
+    assert cursor == str(synced)
+    assert (back.refreshed, back.full) == (5, True)
+    with app.app_context():
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
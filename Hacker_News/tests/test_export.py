@@ -0,0 +1,23 @@
+'''Tests the export.py module'''
+import json
+from hackernews import db
+from hackernews.models import Post
+from tests.testapp import app
+
+def test_export_posts_command():
+    '''the cli writes the same NDJSON as the endpoint'''
+    with app.app_context():
+        db.session.add(Post(id=990001501, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000, kids=[990001503, 990001502]))
+        db.session.commit()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['export-posts', '--since-id', '990001500', '--limit', '1',
+            '--fields', 'id,kids,title'])
+    bad = runner.invoke(args=['export-posts', '--fields', 'nope'])
+    with app.app_context():
+        db.session.delete(db.session.get(Post, 990001501))
+        db.session.commit()
+    assert result.exit_code == 0
+    assert json.loads(result.output) == {'id': 990001501, 'kids': [990001503, 990001502],
+            'title': 'test title'}
+    assert bad.exit_code != 0
@@ -0,0 +1,33 @@
+'''Tests the app factories in hackernews/__init__.py'''
+import subprocess
+import sys
+from hackernews import create_app, create_ingest_app
+from tests.testapp import app
+
+def test_ingest_app_leaves_out_the_website():
+    '''the cron entry point loads neither the views nor authlib'''
+    script = ('import sys, data; data.create_ingest_app(); '
+            'print(sorted(name for name in ("hackernews.routes", "hackernews.auth", '
+            '"hackernews.instrumentation", "authlib") if name in sys.modules))')
+    loaded = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+            check=True).stdout.strip()
+    assert loaded == '[]'
+
+def test_factories_take_config():
+    '''each app gets its own settings, and the website its blueprints and commands'''
+    ingest = create_ingest_app({**app.config, 'RANK_GRAVITY': 2.5})
+    assert ingest.config['RANK_GRAVITY'] == 2.5
+    assert not ingest.blueprints
+    assert {'archive-posts', 'recompute-ranks', 'upgrade-db'} <= set(ingest.cli.commands)
+    assert set(app.blueprints) == {'main', 'auth', 'admin'}
+    assert {'main.home', 'auth.login', 'admin.metrics'} <= set(app.view_functions)
+
+def test_auth0_client_is_created_on_first_use():
+    '''building the website does not register the Auth0 client; the first login does'''
+    website = create_app(dict(app.config))
+    assert 'auth0' not in website.extensions
+    with website.test_request_context():
+        from hackernews.auth import auth0 # pylint: disable=import-outside-toplevel
+        client = auth0()
+        assert auth0() is client
+    assert website.extensions['auth0'] is client
@@ -0,0 +1,68 @@
+'''Tests the instrumentation.py module'''
+import logging
+import re
+import pytest
+from hackernews import db
+from hackernews.models import Post, Role, User
+from tests.testapp import app
+
+IDS = list(range(990007001, 990007006))
+
+@pytest.fixture
+def admin_client():
+    '''a logged in admin and a page of posts'''
+    test_client = app.test_client()
+    with test_client.session_transaction() as sess:
+        sess['user'] = {'userinfo': {'name': 'Timed', 'email': 'timed@example.com',
+                'sub': 'timed', 'picture': ''}}
+    with app.app_context():
+        user = User(id='timed', username='Timed', email='timed@example.com')
+        user.roles.append(db.session.query(Role).filter_by(name='admin').first())
+        db.session.add(user)
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000, rank=5000) for i in IDS])
+        db.session.commit()
+    yield test_client
+    with app.app_context():
+        Post.query.filter(Post.id.in_(IDS)).delete()
+        db.session.delete(db.session.get(User, 'timed'))
+        db.session.commit()
+
+def test_server_timing_header(admin_client):
+    '''every response reports its queries, database, render and total time'''
+    admin_client.get("/home")
+    # the second request finds the approximate post count cached
+    response = admin_client.get("/home")
+    header = response.headers['Server-Timing']
+    match = re.fullmatch(r'db;dur=([\d.]+);desc="(\d+) queries", render;dur=([\d.]+), '
+            r'total;dur=([\d.]+)', header)
+    assert match is not None
+    assert int(match.group(2)) == 2
+    assert float(match.group(4)) >= float(match.group(1)) + float(match.group(3))
+
+def test_route_query_budgets(admin_client, max_queries):
+    '''the main pages and the vote endpoints stay within a fixed number of statements'''
+    with max_queries(1):
+        app.test_client().get("/home")
+    with max_queries(2):
+        admin_client.get("/home")
+    with max_queries(3):
+        admin_client.get("/admin_post")
+    with max_queries(5):
+        admin_client.post(f"/like-post/{IDS[0]}")
+    with max_queries(5):
+        admin_client.post(f"/dislike-post/{IDS[0]}")
+
+def test_budget_warning(admin_client, caplog):
+    '''a route over its budget is logged, one within it is not'''
+    budget = app.config['QUERY_BUDGET']
+    app.config['QUERY_BUDGET'] = 0
+    try:
+        with caplog.at_level(logging.WARNING, logger=app.logger.name):
+            admin_client.get("/admin_cache")
+            admin_client.get("/home")
+    finally:
+        app.config['QUERY_BUDGET'] = budget
+    warnings = [record.getMessage() for record in caplog.records]
+    assert len(warnings) == 1
+    assert warnings[0].startswith('GET /admin_cache ran')
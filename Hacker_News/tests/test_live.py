@@ -0,0 +1,138 @@
+'''Tests the live.py module and the /live/counts stream'''
+import json
+import pytest
+from hackernews import db
+from hackernews.live import LiveCounts, live_counts, prune_changes
+from hackernews.models import Post, User, VoteChange
+from tests.testapp import app
+
+IDS = [990008001, 990008002]
+
+@pytest.fixture
+def voter():
+    '''a logged in user and two posts to vote on'''
+    test_client = app.test_client()
+    with test_client.session_transaction() as sess:
+        sess['user'] = {'userinfo': {'name': 'Live', 'email': 'live@example.com',
+                'sub': 'live', 'picture': ''}}
+    with app.app_context():
+        db.session.add(User(id='live', username='Live', email='live@example.com'))
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000) for i in IDS])
+        db.session.commit()
+    yield test_client
+    with app.app_context():
+        Post.query.filter(Post.id.in_(IDS)).delete()
+        db.session.delete(db.session.get(User, 'live'))
+        db.session.commit()
+
+def events(chunks):
+    '''the data of every counts event in the chunks, in order'''
+    return [json.loads(line[len('data: '):]) for chunk in chunks
+            for line in chunk.decode().splitlines() if line.startswith('data: ')]
+
+def test_bursts_are_coalesced():
+    '''a stream holds only the newest counts per post, and streams are capped'''
+    hub = LiveCounts()
+    first = hub.subscribe({1, 2}, limit=2)
+    second = hub.subscribe({2}, limit=2)
+    assert hub.subscribe({3}, limit=2) is None
+    hub.publish([(1, n, 0) for n in range(1000)] + [(2, 5, 1), (3, 9, 9)])
+    assert first.take(0) == {1: (999, 0), 2: (5, 1)}
+    assert second.take(0) == {2: (5, 1)}
+    assert first.take(0) == {}
+    hub.unsubscribe(first)
+    hub.unsubscribe(first)
+    hub.publish([(1, 1000, 0)])
+    assert first.take(0) == {}
+    assert hub.subscribe({3}, limit=2) is not None
+
+def test_stream_pushes_votes(voter):
+    '''a vote by anyone reaches the open streams showing the post'''
+    stream_seconds, interval = app.config['LIVE_STREAM_SECONDS'], app.config['LIVE_POLL_INTERVAL']
+    app.config.update(LIVE_STREAM_SECONDS=5, LIVE_POLL_INTERVAL=0.02)
+    try:
+        response = app.test_client().get(f'/live/counts?posts={IDS[0]},{IDS[1]}',
+                buffered=False)
+        chunks = iter(response.response)
+        opening = [next(chunks), next(chunks)]
+        voter.post(f'/like-post/{IDS[0]}')
+        voter.post(f'/dislike-post/{IDS[1]}')
+        pushed = {}
+        for chunk in chunks:
+            for event in events([chunk]):
+                pushed.update({post['post_id']: post for post in event})
+            if len(pushed) == 2:
+                break
+        response.close()
+    finally:
+        app.config.update(LIVE_STREAM_SECONDS=stream_seconds, LIVE_POLL_INTERVAL=interval)
+    assert response.mimetype == 'text/event-stream'
+    assert opening[0] == b'retry: 3000\n'
+    assert events(opening) == [[{'post_id': IDS[0], 'likes': 0, 'dislikes': 0},
+            {'post_id': IDS[1], 'likes': 0, 'dislikes': 0}]]
+    assert pushed == {IDS[0]: {'post_id': IDS[0], 'likes': 1, 'dislikes': 0},
+            IDS[1]: {'post_id': IDS[1], 'likes': 0, 'dislikes': 1}}
+    # the closed stream gave its slot back
+    subscription = live_counts.subscribe(IDS, limit=1)
+    assert subscription is not None
+    live_counts.unsubscribe(subscription)
+    with app.app_context():
+        assert VoteChange.query.filter(VoteChange.post_id.in_(IDS)).count() == 2
+
+def test_stream_rejects_bad_requests():
+    '''the posts parameter is required and must be a short list of ids'''
+    client = app.test_client()
+    assert client.get('/live/counts').status_code == 400
+    assert client.get('/live/counts?posts=1,x').status_code == 400
+    many = ','.join(str(i) for i in range(31))
+    assert client.get(f'/live/counts?posts={many}').status_code == 400
+
+def test_late_commits_are_not_skipped():
+    '''a change committed after changes with a higher seq is still published once'''
+    hub = LiveCounts()
+    subscription = hub.subscribe({IDS[0], IDS[1]}, limit=1)
+    with app.app_context():
+        base = (db.session.scalar(db.select(db.func.max(VoteChange.seq))) or 0) + 100
+        hub.follow_from(base)
+        db.session.add(VoteChange(seq=base + 2, post_id=IDS[0], likes=1, dislikes=0))
+        db.session.commit()
+        first = hub.poll(lag=5)
+        # seq base + 1 was handed out earlier but commits only now
+        db.session.add(VoteChange(seq=base + 1, post_id=IDS[1], likes=0, dislikes=1))
+        db.session.commit()
+        late = hub.poll(lag=5)
+        again = hub.poll(lag=5)
+        VoteChange.query.filter(VoteChange.seq > base).delete()
+        db.session.commit()
+    assert (first, late, again) == (1, 1, 0)
+    assert subscription.take(0) == {IDS[0]: (1, 0), IDS[1]: (0, 1)}
+
+def test_retention_prunes_vote_changes():
+    '''the retention job trims vote_change even when no stream is open'''
+    with app.app_context():
+        db.session.add_all([VoteChange(post_id=IDS[0], likes=n, dislikes=0) for n in range(5)])
+        db.session.commit()
+        kept = app.config['LIVE_CHANGES_KEPT']
+        app.config['LIVE_CHANGES_KEPT'] = 2
+        try:
+            output = app.test_cli_runner().invoke(args=['archive-posts', '--limit', '0']).output
+        finally:
+            app.config['LIVE_CHANGES_KEPT'] = kept
+        left = [change.likes for change in VoteChange.query.order_by(VoteChange.seq)]
+        assert prune_changes(0) == 2
+    assert left == [3, 4]
+    assert 'vote changes' in output
+
+def test_full_worker_falls_back_to_polling(voter):
+    '''past LIVE_MAX_STREAMS the counts are sent once and the browser polls'''
+    limit = app.config['LIVE_MAX_STREAMS']
+    app.config['LIVE_MAX_STREAMS'] = 0
+    try:
+        response = app.test_client().get(f'/live/counts?posts={IDS[0]}')
+    finally:
+        app.config['LIVE_MAX_STREAMS'] = limit
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.data.startswith(b'retry: 10000\n')
+    assert events([response.data]) == [[{'post_id': IDS[0], 'likes': 0, 'dislikes': 0}]]
@@ -0,0 +1,77 @@
+'''Tests the metrics.py module and the /metrics endpoint'''
+import pytest
+from hackernews import metrics_store
+from hackernews.metrics import MetricsStore
+from tests.testapp import app
+
+def test_workers_add_up(tmp_path):
+    '''counters and histograms of two processes sharing the file are summed'''
+    path = str(tmp_path / 'metrics.db')
+    workers = [MetricsStore(path), MetricsStore(path)]
+    for worker, seconds in zip(workers, (0.003, 0.2)):
+        worker.inc('hackernews_requests_total', (('route', 'home'), ('method', 'GET'),
+                ('status', 200)))
+        worker.observe('hackernews_request_duration_seconds', seconds, (('route', 'home'),))
+    assert workers[1].samples() == {}
+    for worker in workers:
+        worker.flush()
+    text = workers[0].render()
+    assert '# TYPE hackernews_requests_total counter' in text
+    assert 'hackernews_requests_total{route="home",method="GET",status="200"} 2' in text
+    assert 'hackernews_request_duration_seconds_bucket{route="home",le="0.005"} 1' in text
+    assert 'hackernews_request_duration_seconds_bucket{route="home",le="0.1"} 1' in text
+    assert 'hackernews_request_duration_seconds_bucket{route="home",le="0.25"} 2' in text
+    assert 'hackernews_request_duration_seconds_bucket{route="home",le="+Inf"} 2' in text
+    assert 'hackernews_request_duration_seconds_count{route="home"} 2' in text
+    buckets = [line for line in text.splitlines() if '_bucket' in line]
+    assert buckets[-1].endswith('le="+Inf"} 2')
+
+def test_job_runs(tmp_path):
+    '''a job records its run, items and duration, and failures separately'''
+    store = MetricsStore(str(tmp_path / 'metrics.db'))
+    with store.job('fetch') as run:
+        run['items'] = 3
+    with pytest.raises(RuntimeError):
+        with store.job('fetch'):
+            raise RuntimeError('api down')
+    samples = store.samples()
+    assert samples[('hackernews_job_runs_total', 'job="fetch"')] == 2
+    assert samples[('hackernews_job_failures_total', 'job="fetch"')] == 1
+    assert samples[('hackernews_job_items_total', 'job="fetch"')] == 3
+    assert ('hackernews_job_last_run_timestamp_seconds', 'job="fetch"') in samples
+
+def test_unwritable_file(tmp_path):
+    '''a metrics file that can not be opened never fails a job or a flush'''
+    path = tmp_path / 'metrics.db'
+    path.write_bytes(b'not a database' * 100)
+    store = MetricsStore(str(path))
+    with store.job('fetch') as run:
+        run['items'] = 3
+    store.inc('hackernews_requests_total', (('route', 'home'),))
+    store.flush()
+    path.unlink()
+    store.flush()
+    assert store.samples()[('hackernews_job_items_total', 'job="fetch"')] == 3
+    assert store.samples()[('hackernews_requests_total', 'route="home"')] == 1
+
+def test_metrics_endpoint():
+    '''requests show up per route, and only admins or the export token may read them'''
+    metrics_store.clear()
+    token = app.config['EXPORT_TOKEN']
+    app.config['EXPORT_TOKEN'] = 'metrics-token'
+    client = app.test_client()
+    try:
+        client.get("/about")
+        client.get("/no-such-page")
+        anonymous = client.get("/metrics")
+        response = client.get("/metrics", headers={'Authorization': 'Bearer metrics-token'})
+    finally:
+        app.config['EXPORT_TOKEN'] = token
+    text = response.data.decode()
+    assert anonymous.status_code == 302
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'hackernews_requests_total{route="main.about",method="GET",status="200"} 1' in text
+    assert 'hackernews_requests_total{route="unmatched",method="GET",status="404"} 1' in text
+    assert 'hackernews_db_queries_total{route="main.about"} 0' in text
+    assert '# TYPE hackernews_page_cache_hit_ratio gauge' in text
@@ -0,0 +1,59 @@
+'''Tests the migrations.py module'''
+import pickle
+from sqlalchemy import inspect, text
+from hackernews import db
+from hackernews.migrations import upgrade_schema
+from hackernews.models import Comment, Post, User, Vote
+from tests.testapp import app
+
+def test_legacy_votes_are_migrated():
+    '''rows of the old like and dislike tables become votes and the counters are backfilled'''
+    with app.app_context():
+        db.session.add(Post(id=990002001, author="test author", title="test title",
+                url="https://www.lipsum.com/"))
+        db.session.add_all([User(id=f'legacy{i}', username=f'Legacy {i}',
+                email=f'legacy{i}@gmail.com') for i in range(3)])
+        for table in ('like', 'dislike'):
+            db.session.execute(text(f'CREATE TABLE "{table}" (id INTEGER PRIMARY KEY, '
+                    'author VARCHAR NOT NULL, post_id INTEGER NOT NULL)'))
+        db.session.execute(text('INSERT INTO "like" (author, post_id) '
+                "VALUES ('legacy0', 990002001), ('legacy1', 990002001)"))
+        db.session.execute(text('INSERT INTO dislike (author, post_id) '
+                "VALUES ('legacy2', 990002001)"))
+        db.session.commit()
+
+        upgrade_schema()
+
+        tables = inspect(db.engine).get_table_names()
+        votes = {v.user_id: v.value for v in Vote.query.filter_by(post_id=990002001)}
+        post = db.session.get(Post, 990002001)
+        counts = (post.likes_count, post.dislikes_count)
+        db.session.delete(post)
+        User.query.filter(User.id.like('legacy%')).delete()
+        db.session.commit()
+    assert 'like' not in tables and 'dislike' not in tables
+    assert votes == {'legacy0': Vote.LIKE, 'legacy1': Vote.LIKE, 'legacy2': Vote.DISLIKE}
+    assert counts == (2, 1)
+
+def test_pickled_kids_are_migrated():
+    '''the pickled kids column becomes rows of the comment table and is dropped'''
+    with app.app_context():
+        db.session.add(Post(id=990002101, author="test author", title="test title",
+                url="https://www.lipsum.com/"))
+        db.session.commit()
+        db.session.execute(text('ALTER TABLE post ADD COLUMN kids BLOB'))
+        db.session.execute(text('UPDATE post SET kids = :kids WHERE id = 990002101'),
+                {'kids': pickle.dumps([990002103, 990002102])})
+        db.session.commit()
+
+        upgrade_schema()
+
+        columns = {column['name'] for column in inspect(db.engine).get_columns('post')}
+        post = db.session.get(Post, 990002101)
+        kids = post.kids
+        db.session.delete(post)
+        db.session.commit()
+        remaining = Comment.query.filter_by(post_id=990002101).count()
+    assert 'kids' not in columns
+    assert kids == [990002103, 990002102]
+    assert remaining == 0
@@ -0,0 +1,65 @@
+'''Tests the size of the home page and the assets.py and compression.py modules'''
+import gzip
+import re
+import pytest
+from hackernews import db
+from hackernews.models import Post
+from tests.testapp import app
+
+IDS = list(range(990009001, 990009006))
+# one post of the home page, with its icons and voting buttons
+MAX_POST_BYTES = 1200
+
+@pytest.fixture
+def posts():
+    '''a full first page of posts'''
+    with app.app_context():
+        db.session.add_all([Post(id=i, author="test author",
+                title="A fairly typical story title here", url="https://www.example.com/some/path",
+                time=2000000000, rank=9000) for i in IDS])
+        db.session.commit()
+    yield IDS
+    with app.app_context():
+        Post.query.filter(Post.id.in_(IDS)).delete()
+        db.session.commit()
+
+def test_home_page_size(posts):
+    '''each post costs about a kilobyte and the session is not written into the page'''
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user'] = {'userinfo': {'name': 'Test User', 'email': 'test.user@gmail.com',
+                'sub': 'testid', 'picture': ''}, 'id_token': 'secret-id-token'}
+    page = client.get('/home').data
+    articles = re.findall(rb'<article.*?</article>', page, re.S)
+    assert [int(i) for i in re.findall(rb'id="like-button-(\d+)"', page)] == posts[::-1]
+    assert max(len(article) for article in articles) < MAX_POST_BYTES
+    assert page.count(b'<symbol') == 2
+    assert b'secret-id-token' not in page and b'sessionData' not in page
+    assert not re.search(rb'<script(?![^>]*\bsrc=)', page)
+    assert b'data-viewer="member"' in page
+
+def test_compressed_home_page(posts):
+    '''clients that accept gzip get a third of the bytes or less'''
+    client = app.test_client()
+    plain = client.get('/home')
+    packed = client.get('/home', headers={'Accept-Encoding': 'gzip'})
+    assert len(posts) == plain.data.count(b'<article')
+    assert 'Content-Encoding' not in plain.headers
+    assert packed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in packed.headers['Vary']
+    assert len(packed.data) * 3 < len(plain.data)
+    assert gzip.decompress(packed.data) == plain.data
+
+def test_versioned_static_files():
+    '''static URLs carry the hash of the file, and only the current hash is cached long'''
+    client = app.test_client()
+    page = client.get('/about').data
+    css = re.search(rb'/static/main\.css\?v=([0-9a-f]{12})', page)
+    assert css is not None
+    assert re.search(rb'/static/index\.js\?v=[0-9a-f]{12}', page)
+    current = client.get(f'/static/main.css?v={css.group(1).decode()}')
+    stale = client.get('/static/main.css?v=000000000000')
+    assert current.cache_control.max_age == 31536000 and current.cache_control.immutable
+    assert stale.cache_control.max_age != 31536000
+    current.close()
+    stale.close()
@@ -0,0 +1,126 @@
+'''Tests the ranking.py module'''
+import re
+import sqlite3
+import pytest
+from hackernews import db
+from hackernews.models import AppState, Post, User, Vote
+from hackernews.ranking import (RANK_EPOCH, configured_formula, rank_value,
+        recompute_ranks)
+from hackernews.votes import toggle_vote
+from tests.testapp import app
+
+EPOCH = 2100000000
+IDS = [990005001, 990005002, 990005003]
+
+@pytest.fixture
+def ranked_posts():
+    '''three posts: an old popular one, a fresh one and a fresh heavily disliked one'''
+    with app.app_context():
+        db.session.add(User(id='ranking', username='Ranking', email='ranking@example.com'))
+        db.session.add_all([
+            Post(id=IDS[0], author="a", title="t", url="https://www.lipsum.com/",
+                    time=EPOCH - 48 * 3600, score=500),
+            Post(id=IDS[1], author="a", title="t", url="https://www.lipsum.com/",
+                    time=EPOCH - 3600, score=50),
+            Post(id=IDS[2], author="a", title="t", url="https://www.lipsum.com/",
+                    time=EPOCH - 3600, score=50, dislikes_count=60),
+        ])
+        db.session.commit()
+    yield IDS
+    with app.app_context():
+        Post.query.filter(Post.id.in_(IDS)).delete()
+        db.session.delete(db.session.get(User, 'ranking'))
+        db.session.commit()
+
+def stored_ranks():
+    '''{post id: rank} of the test posts'''
+    return dict(db.session.query(Post.id, Post.rank).filter(Post.id.in_(IDS)))
+
+def test_recompute_ranks(ranked_posts):
+    '''ranks match the python formula at the epoch and decay with age'''
+    with app.app_context():
+        recompute_ranks(batch_size=1, now=EPOCH)
+        ranks = stored_ranks()
+        epoch = AppState.get(RANK_EPOCH)
+        formula = configured_formula()
+        expected = {post.id: rank_value(post.score, post.likes_count, post.dislikes_count,
+                post.time, EPOCH, formula) for post in Post.query.filter(Post.id.in_(IDS))}
+    assert float(epoch) == EPOCH
+    assert ranks == pytest.approx(expected)
+    assert ranks[ranked_posts[1]] > ranks[ranked_posts[0]] > ranks[ranked_posts[2]]
+
+def test_vote_updates_rank_at_epoch(ranked_posts):
+    '''a vote recomputes its post's rank against the stored epoch, not the clock'''
+    with app.app_context():
+        recompute_ranks(now=EPOCH)
+        before = stored_ranks()[ranked_posts[0]]
+        result = toggle_vote('ranking', ranked_posts[0], Vote.LIKE)
+        after = stored_ranks()[ranked_posts[0]]
+        expected = rank_value(500, 1, 0, EPOCH - 48 * 3600, EPOCH, configured_formula())
+    assert result.likes == 1
+    assert after > before
+    assert after == pytest.approx(expected)
+
+def test_vote_reordered_past_neighbour(ranked_posts):
+    '''a vote only reorders the feed when it moves the post past another one'''
+    leader, follower = 990005011, 990005012
+    with app.app_context():
+        # the follower is one second older, so one like lifts it past the leader
+        db.session.add_all([
+            Post(id=leader, author="a", title="t", url="https://www.lipsum.com/",
+                    time=EPOCH - 3600, score=1000),
+            Post(id=follower, author="a", title="t", url="https://www.lipsum.com/",
+                    time=EPOCH - 3601, score=1000),
+        ])
+        db.session.commit()
+        recompute_ranks(now=EPOCH)
+        ahead = toggle_vote('ranking', leader, Vote.LIKE)
+        back = toggle_vote('ranking', leader, Vote.LIKE)
+        past = toggle_vote('ranking', follower, Vote.LIKE)
+        ranks = dict(db.session.query(Post.id, Post.rank).filter(
+                Post.id.in_([leader, follower])))
+        Post.query.filter(Post.id.in_([leader, follower])).delete()
+        db.session.commit()
+    assert not ahead.reordered and not back.reordered
+    assert past.reordered
+    assert ranks[follower] > ranks[leader]
+
+def test_home_ordered_by_rank(ranked_posts):
+    '''the home page lists posts by their stored rank'''
+    with app.app_context():
+        recompute_ranks(now=EPOCH)
+        db.session.query(Post).filter(Post.id.in_(IDS)).update(
+                {Post.rank: Post.rank + 100000}, synchronize_session=False)
+        db.session.commit()
+    page = app.test_client().get("/home").data
+    order = [int(i) for i in re.findall(rb'id="like-button-(\d+)"', page)]
+    assert order[:3] == [ranked_posts[1], ranked_posts[0], ranked_posts[2]]
+
+def test_recompute_command_drops_cached_pages(ranked_posts):
+    '''pages cached before the cron job recomputes ranks are not served after it'''
+    client = app.test_client()
+    client.get("/home")
+    cached = client.get("/home").headers['X-Cache']
+    result = app.test_cli_runner().invoke(args=['recompute-ranks'])
+    after = client.get("/home").headers['X-Cache']
+    assert result.output.startswith('Ranked ')
+    assert (cached, after) == ('HIT', 'MISS')
+
+def test_compare_ranking(ranked_posts, tmp_path):
+    '''the comparison runs on a read only copy and reports every formula'''
+    with app.app_context():
+        source = db.engine.url.database
+    snapshot = tmp_path / 'copy.db'
+    # the live database is in WAL mode, so it is copied with the backup api
+    with sqlite3.connect(source) as live, sqlite3.connect(snapshot) as copy:
+        live.backup(copy)
+    result = app.test_cli_runner().invoke(args=['compare-ranking', str(snapshot),
+            '--formula', '1.8:1:1', '--formula', 'popularity', '--top', '3'])
+    bad = app.test_cli_runner().invoke(args=['compare-ranking', str(snapshot),
+            '--formula', 'steep'])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert 'overlap@3' in lines[0]
+    assert lines[1].split()[:2] == ['1.8:1:1', '3']
+    assert lines[2].split()[0] == 'popularity'
+    assert bad.exit_code != 0
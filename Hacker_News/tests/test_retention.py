@@ -0,0 +1,85 @@
+'''Tests the retention.py module'''
+import data
+from hackernews import db
+from hackernews.models import Comment, Post, PostArchive, User, Vote
+from hackernews.retention import RetentionPolicy, archive_posts
+from tests.testapp import app
+from tests.hn_stub import HNStub, make_story
+
+OLD = list(range(990004001, 990004006))
+NEW = 990004010
+
+def add_posts():
+    '''five old posts, the first one voted on and commented, and one new post'''
+    with app.app_context():
+        db.session.add(User(id='retention', username='Retention', email='retention@example.com'))
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=1000 + i % 10, rank=i % 10)
+                for i in OLD])
+        db.session.add(Post(id=NEW, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=4000000000))
+        db.session.flush()
+        db.session.get(Post, OLD[0]).kids = [OLD[0] * 10]
+        db.session.add(Vote(user_id='retention', post_id=OLD[0], value=Vote.LIKE))
+        Post.recount_votes(OLD[:1])
+        db.session.commit()
+
+def remove_posts():
+    '''deletes everything the tests added'''
+    with app.app_context():
+        ids = OLD + [NEW]
+        Post.query.filter(Post.id.in_(ids)).delete()
+        PostArchive.query.filter(PostArchive.id.in_(ids)).delete()
+        db.session.delete(db.session.get(User, 'retention'))
+        db.session.commit()
+
+def test_archive_posts_in_batches():
+    '''old posts move to the archive a batch at a time with their votes and comments
+    removed, and the policy's conditions are honoured'''
+    add_posts()
+    with app.app_context():
+        unvoted = archive_posts(RetentionPolicy(max_age_days=30, unvoted_only=True,
+                below_rank=4), batch_size=2, pause=0)
+        rest = archive_posts(RetentionPolicy(max_age_days=30, unvoted_only=False,
+                below_rank=None), batch_size=2, pause=0)
+        remaining = {post.id for post in Post.query.filter(Post.id.in_(OLD + [NEW]))}
+        archived = {post.id: post.likes_count for post in
+                PostArchive.query.filter(PostArchive.id.in_(OLD))}
+        votes = Vote.query.filter_by(user_id='retention').count()
+        comments = Comment.query.filter_by(post_id=OLD[0]).count()
+    remove_posts()
+    assert (unvoted.archived, unvoted.batches) == (2, 1)
+    assert (rest.archived, rest.batches) == (3, 2)
+    assert remaining == {NEW}
+    assert archived == {**{i: 0 for i in OLD}, OLD[0]: 1}
+    assert (votes, comments) == (0, 0)
+
+def test_archive_posts_command():
+    '''the cli counts without archiving on a dry run and archives up to the limit'''
+    add_posts()
+    runner = app.test_cli_runner()
+    dry = runner.invoke(args=['archive-posts', '--dry-run'])
+    limited = runner.invoke(args=['archive-posts', '--limit', '3', '--batch-size', '2'])
+    with app.app_context():
+        left = Post.query.filter(Post.id.in_(OLD)).count()
+    remove_posts()
+    assert dry.output.startswith('5 posts')
+    assert limited.output.startswith('Archived 3 posts in 2 batches, pruned ')
+    assert left == 2
+
+def test_archived_stories_are_not_fetched_again():
+    '''a story that was archived is skipped while it is still a top story'''
+    with app.app_context():
+        db.session.add(PostArchive(id=OLD[0], author="test author", title="test title",
+                url="https://www.lipsum.com/", archived_at=1))
+        db.session.commit()
+    with HNStub([make_story(OLD[0]), make_story(OLD[1])]) as stub, app.app_context():
+        saved = data.fetch_and_store_stories(depth=2, base_url=stub.url)
+        requested = stub.item_requests()
+    with app.app_context():
+        stored = Post.query.filter(Post.id.in_(OLD)).count()
+        Post.query.filter(Post.id.in_(OLD)).delete()
+        PostArchive.query.filter(PostArchive.id.in_(OLD)).delete()
+        db.session.commit()
+    assert (saved, stored) == (1, 1)
+    assert requested == [OLD[1]]
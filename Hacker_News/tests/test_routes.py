@@ -1,8 +1,13 @@
 '''Testing the routes.py module'''
+import base64
+import gzip
+import json
 import re
 import pytest
-from hackernews import app, db
-from hackernews.models import User, Post, Role
+from hackernews import db
+from hackernews.feed import write_snapshot
+from hackernews.models import User, Post, Role, Vote
+from tests.testapp import app
 
 @pytest.fixture()
 def client():
@@ -288,3 +293,336 @@ def test_delete_post(authenticated_client):
     assert response.status_code == 302
     assert admin_user is None
     assert deleted_post is None
+
+def test_feed_query_counts(authenticated_client, queries):
+    '''vote counts are read from the post row instead of counted per post'''
+    new_user = User(id='testid', username="Test User", email="test.user@gmail.com",
+            image_file="https://images.app.goo.gl/mzUFQFSnSQPp7sZ76")
+    ids = list(range(990001001, 990001006))
+    posts = [Post(id=i, author="test author", title="test title", url="https://www.lipsum.com/",
+            time=2000000000 + i, rank=1000) for i in ids]
+    with app.app_context():
+        db.session.add(new_user)
+        db.session.add_all(posts)
+        db.session.commit()
+        role = db.session.query(Role).filter_by(name='admin').first()
+        db.session.get(User, 'testid').roles.append(role)
+        db.session.commit()
+
+    authenticated_client.post('/like-post/990001001')
+    authenticated_client.post('/dislike-post/990001002')
+    # warm the cached approximate total so only per-page queries are counted
+    authenticated_client.get("/home")
+    queries.clear()
+    response = authenticated_client.get("/admin_post")
+    assert response.status_code == 200
+    admin_queries = len(queries)
+    queries.clear()
+    response = authenticated_client.get("/home")
+    assert response.status_code == 200
+    home_queries = list(queries)
+
+    with app.app_context():
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.commit()
+
+    assert b'<span id="likes-count-990001001" class="ms-2">1</span>' in response.data
+    assert b'<span id="dislikes-count-990001002" class="ms-2">1</span>' in response.data
+    # user and roles lookup and one keyset page select
+    assert admin_queries == 3
+    assert not [q for q in home_queries
+            if 'count(' in q and ('FROM "like"' in q or 'FROM dislike' in q)]
+    # one keyset page select and one lookup of the viewer's votes
+    assert len(home_queries) == 2
+    assert b'id="like-button-990001001" data-toggle="button" aria-pressed="true"' in response.data
+    assert b'id="dislike-button-990001002" data-toggle="button" aria-pressed="true"' \
+            in response.data
+    assert b'id="like-button-990001003" data-toggle="button" aria-pressed="false"' in response.data
+
+def test_vote_toggle_statements(authenticated_client, queries):
+    '''a toggle is a delete by primary key, a read of the post's rank, an insert unless
+    the vote is taken back, one counter UPDATE and the vote_change row the live streams
+    follow'''
+    new_user = User(id='testid', username="Test User", email="test.user@gmail.com",
+            image_file="https://images.app.goo.gl/mzUFQFSnSQPp7sZ76")
+    new_post = Post(id=1, author="test author", title="test title",
+            url="https://www.lipsum.com/")
+    with app.app_context():
+        db.session.add(new_user)
+        db.session.add(new_post)
+        db.session.commit()
+
+    counts = []
+    for path in ('/like-post/1', '/dislike-post/1', '/dislike-post/1'):
+        queries.clear()
+        response = authenticated_client.post(path)
+        assert response.status_code == 200
+        counts.append(len(queries))
+    response = authenticated_client.post('/like-post/2')
+    assert response.status_code == 404
+
+    with app.app_context():
+        remaining = Vote.query.filter_by(user_id='testid').count()
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.delete(db.session.get(Post, 1))
+        db.session.commit()
+    assert counts == [5, 5, 4]
+    assert remaining == 0
+
+def test_home_cursor_pages(client):
+    '''next and previous cursors walk the feed without skipping or repeating posts'''
+    ids = list(range(990001101, 990001117))
+    with app.app_context():
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000, rank=2000) for i in ids])
+        db.session.commit()
+
+    seen = []
+    cursors = []
+    cursor = None
+    for _ in range(3):
+        response = client.get("/home", query_string={'cursor': cursor} if cursor else {})
+        page = re.findall(rb'id="like-button-(\d+)"', response.data)
+        seen.extend(int(i) for i in page)
+        cursor = re.search(rb'cursor=([\w-]+)">Next', response.data).group(1).decode()
+        cursors.append(re.search(rb'cursor=([\w-]+)">Previous', response.data))
+    back = client.get("/home", query_string={'cursor': cursors[2].group(1).decode()})
+    bad = client.get("/home", query_string={'cursor': 'not-a-cursor'})
+
+    with app.app_context():
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+    assert seen == sorted(ids, reverse=True)[:15]
+    assert cursors[0] is None and cursors[1] is not None
+    assert [int(i) for i in re.findall(rb'id="like-button-(\d+)"', back.data)] == seen[5:10]
+    assert bad.status_code == 200
+
+def test_home_page_cache(client, authenticated_client):
+    '''logged out visitors get cached pages until a vote changes them'''
+    new_user = User(id='testid', username="Test User", email="test.user@gmail.com",
+            image_file="https://images.app.goo.gl/mzUFQFSnSQPp7sZ76")
+    new_post = Post(id=990001201, author="test author", title="test title",
+            url="https://www.lipsum.com/", time=2000000000, score=100000, rank=3000)
+    with app.app_context():
+        db.session.add(new_user)
+        db.session.add(new_post)
+        db.session.commit()
+
+    first = client.get("/home")
+    second = client.get("/home")
+    logged_in = authenticated_client.get("/home")
+    authenticated_client.post('/like-post/990001201')
+    after_vote = client.get("/home")
+
+    with app.app_context():
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.delete(db.session.get(Post, 990001201))
+        db.session.commit()
+    assert (first.headers['X-Cache'], second.headers['X-Cache']) == ('MISS', 'HIT')
+    assert first.data == second.data
+    assert 'X-Cache' not in logged_in.headers
+    assert after_vote.headers['X-Cache'] == 'MISS'
+    assert b'<span id="likes-count-990001201" class="ms-2">1</span>' in after_vote.data
+
+def test_newsfeed_snapshot(client):
+    '''the feed carries validators, answers 304 and is regenerated after ingestion'''
+    first = client.get("/newsfeed")
+    etag = first.headers['ETag']
+    not_modified = client.get("/newsfeed", headers={'If-None-Match': etag})
+    since = client.get("/newsfeed",
+            headers={'If-Modified-Since': first.headers['Last-Modified']})
+    compressed = client.get("/newsfeed", headers={'Accept-Encoding': 'gzip'})
+    compressed_again = client.get("/newsfeed", headers={'Accept-Encoding': 'gzip',
+            'If-None-Match': compressed.headers['ETag']})
+
+    with app.app_context():
+        db.session.add(Post(id=990001301, author="test author", title="snapshot title",
+                url="https://www.lipsum.com/", time=2100000000))
+        db.session.commit()
+        write_snapshot()
+    changed = client.get("/newsfeed", headers={'If-None-Match': etag})
+    with app.app_context():
+        db.session.delete(db.session.get(Post, 990001301))
+        db.session.commit()
+        write_snapshot()
+
+    assert first.status_code == 200 and 'news_items' in first.json
+    assert (not_modified.status_code, not_modified.data) == (304, b'')
+    assert since.status_code == 304
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'] not in (etag, etag.replace('"', 'W/"', 1))
+    assert compressed_again.status_code == 304
+    assert json.loads(gzip.decompress(compressed.data)) == first.json
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert changed.json['news_items'][0]['title'] == 'snapshot title'
+
+def test_export_ndjson(client):
+    '''the export streams filtered NDJSON to holders of the export token only'''
+    ids = list(range(990001401, 990001406))
+    with app.app_context():
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000 + i, likes_count=2)
+                for i in ids])
+        db.session.commit()
+    app.config['EXPORT_TOKEN'] = 'export-secret'
+    auth = {'Authorization': 'Bearer export-secret'}
+    def export(headers, **args):
+        # a streamed response keeps its request context until it is read and closed
+        with client.get('/export.ndjson', headers=headers, query_string=args) as response:
+            streamed = response.is_streamed
+            return response, response.get_data(as_text=True), streamed
+    response, body, streamed = export(auth, since_id=ids[0], limit=3, fields='id,likes')
+    _, by_time, _ = export(auth, since_time=2000000000 + ids[2], fields='id')
+    bad_field, _, _ = export(auth, fields='password')
+    wrong_token, _, _ = export({'Authorization': 'Bearer nope'})
+    app.config['EXPORT_TOKEN'] = None
+    with app.app_context():
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.commit()
+
+    assert response.status_code == 200
+    assert streamed
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in body.splitlines()]
+    assert lines == [{'id': i, 'likes': 2} for i in ids[1:4]]
+    assert [json.loads(line)['id'] for line in by_time.splitlines()] == ids[3:]
+    assert bad_field.status_code == 400
+    assert wrong_token.status_code == 302
+
+def test_admin_role_cache(authenticated_client, queries):
+    '''roles are checked against the cached version stamp without a join, and granting
+    or revoking them takes effect on the next request'''
+    new_user = User(id='testid', username="Test User", email="test.user@gmail.com",
+            image_file="https://images.app.goo.gl/mzUFQFSnSQPp7sZ76")
+    with app.app_context():
+        db.session.add(new_user)
+        db.session.commit()
+
+    before = authenticated_client.get("/admin_cache")
+    authenticated_client.get("/get_admin")
+    granted = authenticated_client.get("/admin_cache")
+    queries.clear()
+    cached = authenticated_client.get("/admin_cache")
+    cached_queries = list(queries)
+    with app.app_context():
+        user = db.session.get(User, 'testid')
+        user.roles.clear()
+        db.session.commit()
+    revoked = authenticated_client.get("/admin_cache")
+
+    with app.app_context():
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.commit()
+    assert (before.status_code, granted.status_code, cached.status_code) == (403, 200, 200)
+    assert len(cached_queries) == 1 and 'user_roles' not in cached_queries[0]
+    assert revoked.status_code == 403
+
+def make_admin():
+    '''adds the logged in test user with the admin role'''
+    with app.app_context():
+        user = User(id='testid', username="Test User", email="test.user@gmail.com",
+                image_file="https://images.app.goo.gl/mzUFQFSnSQPp7sZ76")
+        user.roles.append(db.session.query(Role).filter_by(name='admin').first())
+        db.session.add(user)
+        db.session.commit()
+
+def test_admin_user_search(authenticated_client):
+    '''the user dashboard pages through users matching a username or email prefix'''
+    make_admin()
+    with app.app_context():
+        db.session.add_all([User(id=f'search{i:02d}', username=f'Searched {i:02d}',
+                email=f'searched{i:02d}@example.com') for i in range(25)])
+        db.session.commit()
+
+    first = authenticated_client.get("/admin_user", query_string={'q': 'Searched'})
+    cursor = re.search(rb'cursor=([\w-]+)[^"]*">Next', first.data).group(1).decode()
+    second = authenticated_client.get("/admin_user",
+            query_string={'q': 'Searched', 'cursor': cursor})
+    by_email = authenticated_client.get("/admin_user",
+            query_string={'q': 'searched07@', 'field': 'email'})
+
+    with app.app_context():
+        User.query.filter(User.id.like('search%')).delete()
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.commit()
+    def names(response):
+        return re.findall(rb'Name: (Searched \d+)', response.data)
+    assert names(first) == [f'Searched {i:02d}'.encode() for i in range(20)]
+    assert names(second) == [f'Searched {i:02d}'.encode() for i in range(20, 25)]
+    assert b'>Next<' not in second.data and b'>Previous<' in second.data
+    assert names(by_email) == [b'Searched 07']
+
+def test_crafted_cursors(client, authenticated_client):
+    '''cursors holding anything but numbers and strings are treated as malformed'''
+    make_admin()
+    crafted = [base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            for values in (['after', {'a': 1}, 2], ['before', 1, [2]], ['after', 1, 2])]
+    responses = [client.get(path, query_string={'q': 'test', 'cursor': cursor})
+            for path in ('/home', '/search') for cursor in crafted]
+    responses += [authenticated_client.get(path, query_string={'cursor': cursor})
+            for path in ('/admin_post', '/admin_user') for cursor in crafted]
+
+    with app.app_context():
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.commit()
+    assert [response.status_code for response in responses] == [200] * 12
+
+def test_delete_user_with_votes(authenticated_client, queries):
+    '''deleting a user removes their votes in the database without loading them and
+    takes them off the post counters'''
+    make_admin()
+    ids = list(range(990001701, 990001706))
+    with app.app_context():
+        db.session.add(User(id='voter', username='Voter', email='voter@example.com'))
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000, likes_count=2) for i in ids])
+        db.session.add_all([Vote(user_id='voter', post_id=i, value=Vote.LIKE) for i in ids])
+        db.session.commit()
+
+    queries.clear()
+    response = authenticated_client.get("/delete-user/voter")
+    statements = list(queries)
+
+    with app.app_context():
+        votes = Vote.query.filter_by(user_id='voter').count()
+        likes = {post.likes_count for post in Post.query.filter(Post.id.in_(ids))}
+        Post.query.filter(Post.id.in_(ids)).delete()
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.commit()
+    assert response.status_code == 302
+    assert not [s for s in statements if s.startswith('SELECT') and 'FROM vote' in s]
+    assert len([s for s in statements if s.startswith('DELETE')]) == 1
+    assert votes == 0
+    assert likes == {1}
+
+def test_bulk_moderation(authenticated_client, client):
+    '''selected posts are hidden from the feed, shown again, or deleted in one request'''
+    make_admin()
+    ids = list(range(990001801, 990001804))
+    with app.app_context():
+        db.session.add_all([Post(id=i, author="test author", title="test title",
+                url="https://www.lipsum.com/", time=2000000000, rank=4000) for i in ids])
+        db.session.commit()
+
+    hide = authenticated_client.post("/admin_post/bulk",
+            data={'action': 'hide', 'post_id': [str(i) for i in ids[:2]]})
+    hidden_home = client.get("/home").data
+    hidden_item = client.get(f"/item/{ids[0]}")
+    authenticated_client.post("/admin_post/bulk", data={'action': 'unhide', 'post_id': ids[0]})
+    shown_home = client.get("/home").data
+    authenticated_client.post("/admin_post/bulk",
+            data={'action': 'delete', 'post_id': [str(i) for i in ids]})
+    bad = authenticated_client.post("/admin_post/bulk", data={'action': 'drop'})
+
+    with app.app_context():
+        left = Post.query.filter(Post.id.in_(ids)).count()
+        db.session.delete(db.session.get(User, 'testid'))
+        db.session.commit()
+    assert hide.status_code == 302
+    assert [f'like-button-{i}'.encode() in hidden_home for i in ids] == [False, False, True]
+    assert hidden_item.status_code == 404
+    assert [f'like-button-{i}'.encode() in shown_home for i in ids] == [True, False, True]
+    assert left == 0
+    assert bad.status_code == 400
@@ -0,0 +1,78 @@
+'''Tests the search.py module and the search page'''
+import re
+import pytest
+from hackernews import db
+from hackernews.models import Post
+from hackernews.search import match_query, rebuild_search_index, search_posts
+from tests.testapp import app
+
+NOW = 2200000000
+IDS = list(range(990006001, 990006013))
+
+@pytest.fixture
+def searchable_posts():
+    '''twelve posts about a made up word, one titled with it twice, one hidden and one
+    only found by its site'''
+    with app.app_context():
+        db.session.add_all([Post(id=i, author="searcher", title=f"Zorblax story {i}",
+                url=f"https://example.com/{i}", time=NOW - (i - IDS[0]) * 86400) for i in IDS])
+        db.session.get(Post, IDS[5]).title = "Zorblax zorblax release"
+        db.session.get(Post, IDS[6]).hidden = True
+        db.session.get(Post, IDS[7]).title = "Unrelated"
+        db.session.get(Post, IDS[7]).url = "https://zorblax.dev/post"
+        db.session.commit()
+    yield IDS
+    with app.app_context():
+        Post.query.filter(Post.id.in_(IDS)).delete()
+        db.session.commit()
+
+def test_match_query():
+    '''only words reach FTS5, the last one as a prefix'''
+    assert match_query('rust "OR" NEAR(') == '"rust" "OR" "NEAR"*'
+    assert match_query('  --  ') is None
+
+def test_search_ranks_and_pages(searchable_posts):
+    '''the best match comes first, hidden posts are left out and the cursors walk every
+    result exactly once'''
+    seen = []
+    cursor = None
+    with app.app_context():
+        while True:
+            page = search_posts('zorbl', cursor=cursor, per_page=4)
+            seen.extend(post.id for post in page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        site = [post.id for post in search_posts('zorblax dev').items]
+        recent = [post.id for post in search_posts('zorblax', since='week', now=NOW).items]
+    assert seen[0] == searchable_posts[5]
+    assert sorted(seen) == sorted(set(searchable_posts) - {searchable_posts[6]})
+    assert site == [searchable_posts[7]]
+    assert sorted(recent) == sorted(set(searchable_posts[:8]) - {searchable_posts[6]})
+
+def test_index_follows_edits(searchable_posts):
+    '''the triggers update and delete index rows, and a rebuild gives the same results'''
+    with app.app_context():
+        db.session.get(Post, searchable_posts[0]).title = "Renamed quuxly"
+        db.session.delete(db.session.get(Post, searchable_posts[1]))
+        db.session.commit()
+        renamed = [post.id for post in search_posts('quuxly').items]
+        before = {post.id for post in search_posts('zorblax', per_page=20).items}
+        rebuild_search_index(batch_size=3)
+        after = {post.id for post in search_posts('zorblax', per_page=20).items}
+    assert renamed == [searchable_posts[0]]
+    assert searchable_posts[0] not in before and searchable_posts[1] not in before
+    assert before == after
+
+def test_search_page(searchable_posts):
+    '''the page lists results with a link to the next page and handles empty queries'''
+    client = app.test_client()
+    response = client.get("/search", query_string={'q': 'zorblax'})
+    found = [int(i) for i in re.findall(rb'id="result-(\d+)"', response.data)]
+    next_page = re.search(rb'cursor=([\w-]+)">Next', response.data)
+    empty = client.get("/search")
+    assert response.status_code == 200
+    assert found[0] == searchable_posts[5] and len(found) == 10
+    assert next_page is not None
+    assert empty.status_code == 200
+    assert b'id="result-' not in empty.data
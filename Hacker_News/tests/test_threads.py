@@ -0,0 +1,110 @@
+'''Tests the threads.py module and the thread page'''
+import data
+from hackernews import db
+from hackernews.models import Comment, Post
+from hackernews.threads import clean_comment_html, thread_comments
+from tests.testapp import app
+from tests.hn_stub import HNStub, make_comment, make_story
+
+POST_ID = 990003001
+
+def thread_items(**story_fields):
+    '''a story with two top level comments, one of which has a reply with a reply'''
+    base = POST_ID * 10
+    return [
+        make_story(POST_ID, kids=[base + 2, base + 1], descendants=4, **story_fields),
+        make_comment(base + 1, POST_ID, kids=[base + 3]),
+        make_comment(base + 2, POST_ID, text='<p>see <a href="https://example.com">this</a>'),
+        make_comment(base + 3, base + 1, kids=[base + 4]),
+        make_comment(base + 4, base + 3),
+    ]
+
+def remove_thread():
+    '''deletes the test post and its comments'''
+    with app.app_context():
+        Comment.query.filter_by(post_id=POST_ID).delete()
+        Post.query.filter_by(id=POST_ID).delete()
+        db.session.commit()
+
+def test_crawl_threads():
+    '''the kids tree is stored with paths, limits are honoured and unchanged threads
+    are not crawled again'''
+    base = POST_ID * 10
+    with HNStub(thread_items()) as stub, app.app_context():
+        data.fetch_and_store_stories(depth=1, base_url=stub.url)
+        shallow = data.crawl_threads(base_url=stub.url, max_depth=2)
+        with app.app_context():
+            db.session.execute(db.update(Post).values(crawled_descendants=None)
+                    .where(Post.id == POST_ID))
+            db.session.commit()
+        full = data.crawl_threads(base_url=stub.url)
+        stub.requests.clear()
+        again = data.crawl_threads(base_url=stub.url)
+        requested = stub.item_requests()
+    with app.app_context():
+        ordered = [(c.id, c.parent_id, c.depth) for c in thread_comments(POST_ID)]
+        deepest = db.session.get(Comment, base + 4)
+        path = deepest.path
+    remove_thread()
+    assert [(r.written, r.deleted) for r in shallow] == [(3, 0)]
+    assert [(r.written, r.deleted) for r in full] == [(1, 0)]
+    assert not again and not requested
+    assert ordered == [(base + 2, None, 0), (base + 1, None, 0), (base + 3, base + 1, 1),
+            (base + 4, base + 3, 2)]
+    assert path == f'{base + 1:010d}/{base + 3:010d}/{base + 4:010d}'
+
+def test_removed_comments_are_deleted():
+    '''comments dropped from their parent's kids go away with their replies'''
+    base = POST_ID * 10
+    items = thread_items()
+    with HNStub(items) as stub, app.app_context():
+        data.fetch_and_store_stories(depth=1, base_url=stub.url)
+        data.crawl_threads(base_url=stub.url)
+        stub.add(make_story(POST_ID, kids=[base + 2, base + 1], descendants=3),
+                make_comment(base + 3, base + 1))
+        data.fetch_and_store_stories(depth=1, base_url=stub.url, refresh=True)
+        reply, = data.crawl_threads(base_url=stub.url)
+        stub.add(make_story(POST_ID, kids=[base + 2], descendants=1))
+        data.fetch_and_store_stories(depth=1, base_url=stub.url, refresh=True)
+        data.crawl_threads(base_url=stub.url)
+    with app.app_context():
+        remaining = [c.id for c in Comment.query.filter_by(post_id=POST_ID)]
+    remove_thread()
+    assert reply.deleted == 1
+    assert remaining == [base + 2]
+
+def test_thread_page(queries):
+    '''the thread page is rendered from two queries and then served from the cache'''
+    client = app.test_client()
+    with HNStub(thread_items()) as stub, app.app_context():
+        data.fetch_and_store_stories(depth=1, base_url=stub.url)
+        data.crawl_threads(base_url=stub.url)
+    queries.clear()
+    first = client.get(f"/item/{POST_ID}")
+    selects = [q for q in queries if q.startswith('SELECT')]
+    second = client.get(f"/item/{POST_ID}")
+    missing = client.get("/item/990003999")
+    home = client.get("/home")
+    remove_thread()
+    assert first.status_code == 200 and first.headers['X-Cache'] == 'MISS'
+    assert second.headers['X-Cache'] == 'HIT'
+    assert len(selects) == 2
+    assert b'<a href="https://example.com" rel="nofollow">this</a>' in first.data
+    assert first.data.index(b'Comment 9900030011') < first.data.index(b'Comment 9900030013')
+    assert missing.status_code == 404
+    assert f'/item/{POST_ID}'.encode() in home.data
+
+def test_clean_comment_html():
+    '''only harmless markup from the api survives'''
+    dirty = '<p>hi <script>alert(1)</script><a href="javascript:x()" onclick="y">x</a>' \
+            '<i onmouseover="z">i</i>'
+    assert clean_comment_html(dirty) == '<p>hi alert(1)x<i>i</i></p>'
+    assert clean_comment_html('<a href="https://a.b/?q=1&amp;r=2">l') == \
+            '<a href="https://a.b/?q=1&amp;r=2" rel="nofollow">l</a>'
+
+def test_clean_comment_html_balances_tags():
+    '''a comment cannot leave tags open for, or close tags of, the markup around it'''
+    assert clean_comment_html('<i>open <pre><code>x') == '<i>open <pre><code>x</code></pre></i>'
+    assert clean_comment_html('</pre></a></i>stray') == 'stray'
+    assert clean_comment_html('<b><i>x</b>y</i>') == '<b><i>x</i></b>y'
+    assert clean_comment_html('a<p>b<p>c<pre>d</pre>') == 'a<p>b</p><p>c</p><pre>d</pre>'
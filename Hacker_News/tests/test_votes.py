@@ -0,0 +1,52 @@
+'''Tests the votes.py module'''
+import multiprocessing
+import random
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+from hackernews import db
+from hackernews.models import Post, User, Vote
+from hackernews.votes import toggle_vote
+
+PROCESSES = 4
+TOGGLES = 100
+USERS = [f'user{i}' for i in range(5)]
+POSTS = [1, 2]
+
+def toggle_many(url, seed):
+    '''runs TOGGLES random likes and dislikes against the db at url'''
+    rng = random.Random(seed)
+    engine = create_engine(url)
+    with Session(engine) as session:
+        for _ in range(TOGGLES):
+            toggle_vote(rng.choice(USERS), rng.choice(POSTS),
+                    rng.choice([Vote.LIKE, Vote.DISLIKE]), session=session)
+    engine.dispose()
+
+def test_concurrent_toggles_keep_counters_consistent(tmp_path):
+    '''hundreds of toggles from several processes leave counters equal to the votes'''
+    url = f"sqlite:///{tmp_path / 'votes.db'}"
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all([User(id=u, username=u, email=f'{u}@gmail.com') for u in USERS])
+        session.add_all([Post(id=p, author='author', title='title', url='https://www.lipsum.com/',
+                popularity=0) for p in POSTS])
+        session.commit()
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=toggle_many, args=(url, seed)) for seed in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+    assert [worker.exitcode for worker in workers] == [0] * PROCESSES
+
+    with Session(engine) as session:
+        for post in session.scalars(select(Post)):
+            def count(value, post_id=post.id):
+                return session.scalar(select(func.count()).select_from(Vote)
+                        .where(Vote.post_id == post_id, Vote.value == value))
+            assert post.likes_count == count(Vote.LIKE)
+            assert post.dislikes_count == count(Vote.DISLIKE)
+            assert post.popularity == post.likes_count + post.dislikes_count
+    engine.dispose()
@@ -0,0 +1,20 @@
+'''The app under test, built once per run against a throwaway database, page cache,
+metrics file and newsfeed snapshot'''
+import os
+import tempfile
+
+DIRECTORY = tempfile.mkdtemp(prefix='hackernews-')
+# read before hackernews loads .env, so only the shell can point the tests elsewhere
+DATABASE_URL = (os.environ.get('DATABASE_URL')
+        or f"sqlite:///{os.path.join(DIRECTORY, 'site.db')}")
+
+# pylint: disable=wrong-import-position
+from hackernews import create_app
+from hackernews.config import database_settings
+
+app = create_app({
+    **database_settings({**os.environ, 'DATABASE_URL': DATABASE_URL}),
+    'PAGE_CACHE_PATH': os.path.join(DIRECTORY, 'page_cache.db'),
+    'METRICS_PATH': os.path.join(DIRECTORY, 'metrics.db'),
+    'NEWSFEED_SNAPSHOT_PATH': os.path.join(DIRECTORY, 'newsfeed.json'),
+})